@@ -11,10 +11,12 @@ try:
     from epac.argparse import ArgumentParser
     from epac.config import EpacConfig,EpacClassifierConfig
     from epac.raxml_util import RaxmlWrapper, FileUtils
-    from epac.json_util import RefJsonParser, RefJsonChecker, EpaJsonParser
+    from epac.json_util import RefJsonParser, RefJsonChecker, EpaJsonParser, EpaJsonStreamParser, EpaJsonMerger
     from epac.msa import muscle, hmmer
     from epac.taxonomy_util import Taxonomy
     from epac.classify_util import TaxClassifyHelper,TaxTreeHelper
+    from epac.cache_util import RefArtifactCache
+    from epac.placement_util import PlacementStore, PlacementStoreWriter
 except ImportError, e:
     print("Some packages are missing, please re-downloand EPA-classifier")
     print e
@@ -33,11 +35,16 @@ class EpaClassifier:
         self.tmpquery = config.tmp_fname("%NAME%.tmpquery")
         self.noalign = config.tmp_fname("%NAME%.noalign")
         self.seqs = None
+        self.bid_node_map = None
+        self.bid_min_rank_lvl = None
         
+        self.out_prefix = os.path.join(args.output_dir, args.output_name)
         assign_fname = args.output_name + ".assignment.txt"
         self.out_assign_fname = os.path.join(args.output_dir, assign_fname)
         jplace_fname = args.output_name + ".jplace"
         self.out_jplace_fname = os.path.join(args.output_dir, jplace_fname)
+        self.out_plstore_fname = self.out_prefix + PlacementStore.SUFFIX
+        self.placement_store = None
 
         try:
             self.refjson = RefJsonParser(config.refjson_fname)
@@ -45,22 +52,32 @@ class EpaClassifier:
             self.cfg.exit_user_error("Invalid json file format: %s" % config.refjson_fname)
         #validate input json format 
         self.refjson.validate()
-        self.reftree = self.refjson.get_reftree()
-        self.rate = self.refjson.get_rate()
-        self.node_height = self.refjson.get_node_height()
+        if self.cfg.ref_cache_dir:
+            self.ref_cache = RefArtifactCache(self.cfg, config.refjson_fname, self.refjson)
+            snapshot = self.ref_cache.get_snapshot()
+        else:
+            self.ref_cache = None
+            snapshot = None
+        
+        # parsed trees and maps are loaded from snapshot, if available
+        refdata = snapshot if snapshot else self.refjson
+        self.reftree = refdata.get_reftree()
+        self.rate = refdata.get_rate()
+        self.node_height = refdata.get_node_height()
         self.cfg.compress_patterns = self.refjson.get_pattern_compression()
 
-        self.bid_taxonomy_map = self.refjson.get_branch_tax_map()
+        self.bid_taxonomy_map = refdata.get_branch_tax_map()
         if not self.bid_taxonomy_map:
             # old file format (before 1.6), need to rebuild this map from scratch
-            th = TaxTreeHelper(self.cfg, self.refjson.get_origin_taxonomy())
-            th.set_mf_rooted_tree(self.refjson.get_tax_tree())
-            th.set_bf_unrooted_tree(self.refjson.get_reftree())
+            th = TaxTreeHelper(self.cfg, refdata.get_origin_taxonomy())
+            th.set_mf_rooted_tree(refdata.get_tax_tree())
+            th.set_bf_unrooted_tree(refdata.get_reftree())
             self.bid_taxonomy_map = th.get_bid_taxonomy_map()        
         
         self.cfg.log.info("Loaded reference tree with %d taxa\n" % len(self.reftree.get_leaves()))
 
-        self.classify_helper = TaxClassifyHelper(self.cfg, self.bid_taxonomy_map, self.rate, self.node_height)
+        rank_index = refdata.get_branch_rank_index(self.bid_taxonomy_map)
+        self.classify_helper = TaxClassifyHelper(self.cfg, self.bid_taxonomy_map, self.rate, self.node_height, rank_index)
         
     def require_muscle(self):
         basepath = os.path.dirname(os.path.abspath(__file__))
@@ -78,9 +95,19 @@ class EpaClassifier:
                      "and specify path to your installation in the config file (sativa.cfg)\n"
             self.cfg.exit_user_error(errmsg)
 
+    def get_ref_alignment_fname(self):
+        if self.ref_cache:
+            return self.ref_cache.get_alignment()
+        else:
+            return self.refjson.get_alignment(fout = self.tmp_refaln)
+
     def align_to_refenence(self, noalign, minp = 0.9):
-        refaln = self.refjson.get_alignment(fout = self.tmp_refaln)
-        fprofile = self.refjson.get_hmm_profile(self.hmmprofile)
+        refaln = self.get_ref_alignment_fname()
+        if self.ref_cache:
+            build_profile = lambda aln_fname, out_fname: hmmer(self.cfg, aln_fname, refprofile=out_fname).build_hmm_profile()
+            fprofile = self.ref_cache.get_hmm_profile(build_profile)
+        else:
+            fprofile = self.refjson.get_hmm_profile(self.hmmprofile)
         
         # if there is no hmmer profile in json file, build it from scratch          
         if not fprofile:
@@ -91,20 +118,21 @@ class EpaClassifier:
         self.epa_alignment = hm.align()
 
     def merge_alignment(self, query_seqs):
-        refaln = self.refjson.get_alignment_list()
         with open(self.epa_alignment, "w") as fout:
-            for seq in refaln:
-                fout.write(">" + seq[0] + "\n" + seq[1] + "\n")
+            for ref_name, ref_seq in self.refjson.iter_alignment():
+                fout.write(">" + ref_name + "\n" + ref_seq + "\n")
             for name, seq, comment, sid in query_seqs.iter_entries():
                 fout.write(">" + name + "\n" + seq + "\n")
 
 
     def write_combined_alignment(self):
         self.query_count = 0
+        name_index = self.refjson.get_name_index()
+        entries = list(self.seqs.iter_entries())
+        ref_names = name_index.get_corr_seqids([EpacConfig.REF_SEQ_PREFIX + e[0] for e in entries])
         with open(self.epa_alignment, "w") as fout:
-            for name, seq, comment, sid in self.seqs.iter_entries():
-                ref_name = self.refjson.get_corr_seqid(EpacConfig.REF_SEQ_PREFIX + name)
-                if ref_name in self.refjson.get_sequences_names():
+            for (name, seq, comment, sid), ref_name in zip(entries, ref_names):
+                if name_index.has_seq(ref_name):
                     seq_name = ref_name
                 else:
                     seq_name = EpacConfig.QUERY_SEQ_PREFIX + name
@@ -152,7 +180,7 @@ class EpaClassifier:
             else:
                 self.cfg.log.info("Merging query alignment with reference alignment using MUSCLE")
                 self.require_muscle()
-                refaln = self.refjson.get_alignment(fout = self.tmp_refaln)
+                refaln = self.get_ref_alignment_fname()
                 m = muscle(self.cfg)
                 self.epa_alignment = m.merge(refaln, self.tmpquery)
         else:
@@ -161,32 +189,38 @@ class EpaClassifier:
             self.require_hmmer()
             self.align_to_refenence(self.noalign, minp = minp)
 
-    def print_ranks(self, rks, confs, minlw = 0.0):
-        uncorr_ranks = self.refjson.get_uncorr_ranks(rks)
-        ss = ""
-        css = ""
-        for i in range(len(uncorr_ranks)):
+    def get_assigned_ranks(self, rks, confs, minlw = 0.0):
+        ass_confs = []
+        for i in range(len(rks)):
             conf = confs[i]
             if conf == confs[0] and confs[0] >=0.99:
                 conf = 1.0
             if conf >= minlw:
-                ss = ss + uncorr_ranks[i] + ";"
-                css = css + "{0:.3f}".format(conf) + ";"
+                ass_confs.append(conf)
             else:
                 break
-        if ss == "":
+        ass_ranks = self.refjson.get_uncorr_ranks(rks[:len(ass_confs)])
+        return ass_ranks, ass_confs
+
+    def print_ranks(self, rks, confs, minlw = 0.0):
+        ass_ranks, ass_confs = self.get_assigned_ranks(rks, confs, minlw)
+        if len(ass_ranks) == 0:
             return None
         else:
-            return ss[:-1] + "\t" + css[:-1]
+            return ";".join(ass_ranks) + "\t" + ";".join(["{0:.3f}".format(conf) for conf in ass_confs])
 
 
     def run_epa(self):
         self.cfg.log.info("Running RAxML-EPA to place %d query sequences...\n" % self.query_count)
         raxml = RaxmlWrapper(config)
-        reftree_fname = self.cfg.tmp_fname("ref_%NAME%.tre")
-        self.refjson.get_raxml_readable_tree(reftree_fname)
-        optmod_fname = self.cfg.tmp_fname("%NAME%.opt")
-        self.refjson.get_binary_model(optmod_fname)
+        if self.ref_cache:
+            reftree_fname = self.ref_cache.get_reftree()
+            optmod_fname = self.ref_cache.get_binary_model()
+        else:
+            reftree_fname = self.cfg.tmp_fname("ref_%NAME%.tre")
+            self.refjson.get_raxml_readable_tree(reftree_fname)
+            optmod_fname = self.cfg.tmp_fname("%NAME%.opt")
+            self.refjson.get_binary_model(optmod_fname)
         job_name = self.cfg.subst_name("epa_%NAME%")
 
         reftree_str = self.refjson.get_raxml_readable_tree()
@@ -202,11 +236,61 @@ class EpaClassifier:
 
         reduced_align_fname = raxml.reduce_alignment(self.epa_alignment)
 
-        jp = raxml.run_epa(job_name, reduced_align_fname, reftree_fname, optmod_fname)
+        shard_count = min(self.cfg.epa_shards, self.query_count)
+        if shard_count > 1:
+            return self.run_epa_sharded(raxml, job_name, reduced_align_fname, reftree_fname, optmod_fname, shard_count)
+
+        raxml.run_epa(job_name, reduced_align_fname, reftree_fname, optmod_fname, stream=True)
         
         raxml.copy_epa_jplace(job_name, self.out_jplace_fname, move=True)
         
-        return jp
+        return EpaJsonStreamParser(self.out_jplace_fname)
+
+    def split_query_alignment(self, align_fname, shard_count):
+        """Splits queries into shard_count contiguous chunks (to preserve the input order), and writes
+           a separate alignment with all reference sequences for each of them"""
+        aln = None
+        for fmt in ["phylip_relaxed", "fasta"]:
+            try:
+                aln = SeqGroup(sequences=align_fname, format=fmt)
+                break
+            except:
+                self.cfg.log.debug("Guessing alignment format: not " + fmt)
+        if aln == None:
+            self.cfg.exit_fatal_error("Could not read the EPA alignment: %s" % align_fname)
+
+        name_index = self.refjson.get_name_index()
+        refs = []
+        queries = []
+        for name, seq, comment, sid in aln.iter_entries():
+            if name_index.has_seq(name):
+                refs.append((name, seq))
+            else:
+                queries.append((name, seq))
+
+        shard_fnames = []
+        chunk_size, rest = divmod(len(queries), shard_count)
+        start = 0
+        for i in range(shard_count):
+            end = start + chunk_size + (1 if i < rest else 0)
+            shard_fname = self.cfg.tmp_fname("%NAME%.shard" + str(i) + ".afa")
+            with open(shard_fname, "w") as fout:
+                for name, seq in refs + queries[start:end]:
+                    fout.write(">" + name + "\n" + seq + "\n")
+            shard_fnames.append(shard_fname)
+            start = end
+        return shard_fnames
+
+    def run_epa_sharded(self, raxml, job_name, align_fname, reftree_fname, optmod_fname, shard_count):
+        if self.cfg.epa_shard_threads:
+            shard_threads = raxml.get_job_threads(self.cfg.epa_shard_threads)
+        else:
+            shard_threads = raxml.get_split_threads(shard_count)
+        self.cfg.log.info("Splitting queries into %d shards (RAxML threads per shard: %d)\n" % (shard_count, shard_threads))
+        shard_fnames = self.split_query_alignment(align_fname, shard_count)
+        job_names = ["%s.%d" % (job_name, i) for i in range(shard_count)]
+        jp_fnames = raxml.run_epa_concurrent(job_names, shard_fnames, reftree_fname, optmod_fname, shard_threads)
+        return EpaJsonMerger.merge(jp_fnames, self.out_jplace_fname)
         
     def run_ptp(self, jp):
         full_aln = SeqGroup(self.epa_alignment)
@@ -251,46 +335,50 @@ class EpaClassifier:
     
     def classify(self, query_fname, minp = 0.9, ptp = False):
         if self.jplace_fname:
-            jp = EpaJsonParser(self.jplace_fname)
+            jp = PlacementStore.open(self.jplace_fname)
         else:        
             self.checkinput(query_fname, minp)
             jp = self.run_epa()
             
         self.cfg.log.info("Assigning taxonomic labels based on EPA placements...\n")
  
-        placements = jp.get_placement()
-        
-        if self.out_assign_fname:
-            fo = open(self.out_assign_fname, "w")
+        if self.cfg.min_lhw_sweep:
+            self.classify_sweep(jp, self.cfg.min_lhw_sweep)
         else:
-            fo = None
-        
-        noassign_list = []
-        for place in placements:
-            taxon_name = place["n"][0]
-            origin_taxon_name = EpacConfig.strip_query_prefix(taxon_name)
-            edges = place["p"]
+            if self.out_assign_fname:
+                fo = open(self.out_assign_fname, "w")
+            else:
+                fo = None
+            
+            assignments = self.classify_helper.iter_classify(self.iter_placements(jp), num_procs=self.cfg.num_threads)
+            
+            noassign_list = []
+            for place, ranks, lws in assignments:
+                taxon_name = place["n"][0]
+                origin_taxon_name = EpacConfig.strip_query_prefix(taxon_name)
+                edges = place["p"]
 
-            ranks, lws = self.classify_helper.classify_seq(edges)
-            rankout = self.print_ranks(ranks, lws, self.cfg.min_lhw)
+                rankout = self.print_ranks(ranks, lws, self.cfg.min_lhw)
 
-            if rankout == None:
-                noassign_list.append(origin_taxon_name)
-            else:
-                output = "%s\t%s\t" % (origin_taxon_name, rankout)
-                if self.cfg.check_novelty:
-                    isnovo = self.novelty_check(place_edge = str(edges[0][0]), ranks=ranks, lws=lws)
-                    output += "*" if isnovo else "o"
+                if rankout == None:
+                    noassign_list.append(origin_taxon_name)
+                else:
+                    output = "%s\t%s\t" % (origin_taxon_name, rankout)
+                    if self.cfg.check_novelty:
+                        isnovo = self.novelty_check(place_edge = str(edges[0][0]), ranks=ranks, lws=lws)
+                        output += "*" if isnovo else "o"
+                    self.print_result_line(fo, output)
+            
+            noassign_list += self.get_noalign_list()
+                               
+            for taxon_name in noassign_list:
+                output = "%s\t\t\t?" % origin_taxon_name
                 self.print_result_line(fo, output)
-        
-        noassign_list += self.get_noalign_list()
-                           
-        for taxon_name in noassign_list:
-            output = "%s\t\t\t?" % origin_taxon_name
-            self.print_result_line(fo, output)
-        
-        if fo:
-            fo.close()
+            
+            if fo:
+                fo.close()
+
+            self.write_placement_store(jp)
 
         #############################################
         #
@@ -300,6 +388,74 @@ class EpaClassifier:
         if ptp:
             self.run_ptp(jp)
         
+    def iter_placements(self, jp):
+        """Placements from jp, which are also collected into the placement store if requested"""
+        if self.cfg.save_placements:
+            self.placement_store = PlacementStoreWriter()
+            return self.placement_store.tee(jp.iter_placements())
+        else:
+            return jp.iter_placements()
+
+    def write_placement_store(self, jp):
+        if self.placement_store != None:
+            self.placement_store.write(self.out_plstore_fname, jp)
+            self.cfg.log.info("EPA placements were saved to: %s\n", os.path.abspath(self.out_plstore_fname))
+
+    def get_sweep_fname(self, minlw):
+        return self.out_prefix + ".t%g.assignment.txt" % minlw
+
+    def classify_sweep(self, jp, thresholds):
+        """Classify placements for several min_lhw thresholds in a single pass: rank weights
+        are accumulated only once per placement. Assignments for every threshold are written to 
+        a separate file, and summary table lists how many sequences were assigned down to each 
+        rank level."""
+        fouts = [open(self.get_sweep_fname(minlw), "w") for minlw in thresholds]
+        noassign_lists = [[] for minlw in thresholds]
+        # level_cnt[i][l] = number of sequences assigned to exactly l+1 levels with i-th threshold 
+        level_cnt = [[] for minlw in thresholds]
+
+        assignments = self.classify_helper.iter_classify_multi(self.iter_placements(jp), thresholds, num_procs=self.cfg.num_threads)
+        for place, results in assignments:
+            origin_taxon_name = EpacConfig.strip_query_prefix(place["n"][0])
+            for i in range(len(thresholds)):
+                ranks, lws = results[i]
+                ass_ranks, ass_confs = self.get_assigned_ranks(ranks, lws, thresholds[i])
+                if len(ass_ranks) == 0:
+                    noassign_lists[i].append(origin_taxon_name)
+                else:
+                    output = "%s\t%s\t%s\t" % (origin_taxon_name, ";".join(ass_ranks), 
+                        ";".join(["{0:.3f}".format(conf) for conf in ass_confs]))
+                    fouts[i].write(output + "\n")
+                    cnt = level_cnt[i]
+                    lvl = len(ass_ranks) - 1
+                    if lvl >= len(cnt):
+                        cnt += [0] * (lvl - len(cnt) + 1)
+                    cnt[lvl] += 1
+
+        self.write_placement_store(jp)
+
+        noalign_list = self.get_noalign_list()
+        for i in range(len(thresholds)):
+            for taxon_name in noassign_lists[i] + noalign_list:
+                fouts[i].write("%s\t\t\t?\n" % taxon_name)
+            fouts[i].close()
+
+        num_levels = max([len(cnt) for cnt in level_cnt])
+        summary_fname = self.out_prefix + ".sweep.txt"
+        with open(summary_fname, "w") as fo:
+            fields = ["MinLHW", "Assigned", "Unassigned"] + ["Level%d" % (l+1) for l in range(num_levels)]
+            fo.write("\t".join(fields) + "\n")
+            for i in range(len(thresholds)):
+                cnt = level_cnt[i] + [0] * (num_levels - len(level_cnt[i]))
+                # number of sequences assigned *at least* down to given level
+                cum_cnt = [sum(cnt[l:]) for l in range(num_levels)]
+                vals = ["%g" % thresholds[i], str(sum(cnt)), str(len(noassign_lists[i]) + len(noalign_list))] 
+                fo.write("\t".join(vals + [str(c) for c in cum_cnt]) + "\n")
+        
+        self.cfg.log.info("Assignments for %d min likelihood weight thresholds were saved to: %s.t<MinLHW>.assignment.txt", 
+            len(thresholds), os.path.abspath(self.out_prefix))
+        self.cfg.log.info("Threshold sweep summary was saved to: %s\n", os.path.abspath(summary_fname))
+
     def novelty_check(self, place_edge, ranks, lws):
         """If the taxonomic assignment is not assigned to the genus level, 
         we need to check if it is due to the incomplete reference taxonomy or 
@@ -329,20 +485,34 @@ class EpaClassifier:
         if lowrank >= 5 and lowrank < len(ranks) and not ranks[lowrank] == "-":
             return False
         else:
-            placenode = self.reftree.search_nodes(B = place_edge)[0]
+            if not self.bid_node_map:
+                self.build_novelty_index()
+            placenode = self.bid_node_map[place_edge]
             if placenode.is_leaf():
                 return False
             else:
-                leafnodes = placenode.get_leaves()
-                flag = True
-                for leaf in leafnodes:
-                    br_num = leaf.B
-                    branks = self.bid_taxonomy_map[br_num]
-                    if lowrank >= len(branks) or branks[lowrank] == "-":
-                        flag = False
-                        break
-                        
-                return flag
+                # all leaves below the placement node have rank at level lowrank assigned?
+                return lowrank < self.bid_min_rank_lvl[place_edge]
+
+    def build_novelty_index(self):
+        """Precompute branch id -> node mapping and, for every branch, the number of rank levels
+        assigned in all leaves below it. This way, novelty_check() doesn't need to traverse the tree."""
+        self.bid_node_map = {}
+        self.bid_min_rank_lvl = {}
+        rank_index = self.classify_helper.get_rank_index()
+        node_rank_lvl = {}
+        for node in self.reftree.traverse(strategy="postorder"):
+            if node.is_leaf():
+                ranks = rank_index.get_branch_ranks(node.B)
+                lvl = 0
+                while lvl < len(ranks) and ranks[lvl] != Taxonomy.EMPTY_RANK:
+                    lvl += 1
+            else:
+                lvl = min([node_rank_lvl[child] for child in node.children])
+            node_rank_lvl[node] = lvl
+            if hasattr(node, "B"):
+                self.bid_node_map[node.B] = node
+                self.bid_min_rank_lvl[node.B] = lvl
 
 def print_options():
     print("usage: python epa_classifier.py -r example/reference.json -q example/query.fa -t 0.5 -v")
@@ -397,6 +567,10 @@ def parse_args():
             help="""Random seed to be used with RAxML. Default: current system time.""")
     parser.add_argument("-P", dest="brlen_pv", type=float, default=0.0,
             help="""P-value for branch length Erlang test. Default: 0 (filter off)\n""")
+    parser.add_argument("-sweep", dest="min_lhw_sweep", type=EpacConfig.parse_thresholds, default=None,
+            help="""Comma-separated list of min likelihood weight thresholds (e.g. 0.1,0.5,0.9): 
+                    classify placements for all of them in a single pass, writing assignments for each 
+                    threshold to a separate file plus a summary table (overrides -t).""")
     parser.add_argument("-minalign", dest="minalign", type=float, default=0.9,
             help="""Minimal percent of the sites aligned to the reference alignment.  Default: 0.9""")
     parser.add_argument("-m", dest="taxassign_method", default="1",
@@ -415,7 +589,16 @@ Run name of the previous (terminated) job must be specified via -n option.""")
     parser.add_argument("-a", dest="align_only", action="store_true",
             help="""Alignment only: Do not perform classification, just build the combined alignment (RS+QS) (default: OFF)""")
     parser.add_argument("-j", dest="jplace_fname",
-            help="""Do not call RAxML EPA, use existing .jplace file as input instead.""")
+            help="""Do not call RAxML EPA, use existing .jplace file (or placement store, s. -save-placements) as input instead.""")
+    parser.add_argument("-save-placements", dest="save_placements", action="store_true",
+            help="""Save EPA placements to a compact binary placement store (<NAME>.plstore), which can be 
+                    re-classified faster than .jplace with -j. Default: off""")
+    parser.add_argument("-shards", dest="epa_shards", type=int, default=1,
+            help="""Split queries into this many shards and place them with concurrent RAxML-EPA runs,
+                    which are merged into a single .jplace file afterwards. Default: 1 (no sharding)""")
+    parser.add_argument("-shard-threads", dest="epa_shard_threads", type=int, default=None,
+            help="""Number of RAxML threads per shard (s. -shards), at least 2. Default: number of CPUs (-T)
+                    divided by the number of shards""")
     parser.add_argument("-c", dest="config_fname", default=None,
             help="Config file name.")
     parser.add_argument("--ptp", 
@@ -426,6 +609,9 @@ Run name of the previous (terminated) job must be specified via -n option.""")
             help="Query file contains complete alignment (query+reference), so use it and ignore reference alignment from .json file.")
     parser.add_argument("-tmpdir", dest="temp_dir", default=None,
             help="""Directory for temporary files.""")
+    parser.add_argument("-refcache", dest="ref_cache_dir", default=None,
+            help="""Directory for caching files extracted from the reference (tree, model, alignment, HMM profile),
+                    which can be shared by concurrent jobs. Default: off""")
     args = parser.parse_args()
     return args
 
@@ -481,10 +667,16 @@ def print_run_info(config, args):
 
     config.log.info("\nEPA-classifier running with the following parameters:")
     config.log.info(" Reference:......................%s" % os.path.abspath(args.ref_fname))
-    config.log.info(" Query:..........................%s" % os.path.abspath(args.query_fname))
+    if args.jplace_fname:
+        config.log.info(" EPA placements:.................%s" % os.path.abspath(args.jplace_fname))
+    else:
+        config.log.info(" Query:..........................%s" % os.path.abspath(args.query_fname))
     config.log.info(" Min percent of alignment sites..%s" % args.minalign)
     config.log.info(" Model of rate heterogeneity:....%s" % config.raxml_model)
-    config.log.info(" Min likelihood weight:..........%f" % args.min_lhw)
+    if args.min_lhw_sweep:
+        config.log.info(" Min likelihood weight sweep:....%s" % ",".join(["%g" % t for t in args.min_lhw_sweep]))
+    else:
+        config.log.info(" Min likelihood weight:..........%f" % args.min_lhw)
     config.log.info(" Assignment method:..............%s" % args.taxassign_method)
     config.log.info(" P-value for Erlang test:........%f" % args.brlen_pv)
     config.log.info(" Number of threads:..............%d" % config.num_threads)
@@ -511,6 +703,8 @@ if __name__ == "__main__":
     
     check_args(args)
     config = EpacClassifierConfig(args)
+    # terminate RAxML & co. if we are killed (e.g. job time limit on a cluster)
+    config.get_scheduler().install_signal_handler()
     print_run_info(config, args)
     
     start_time = time.time()
@@ -520,7 +714,8 @@ if __name__ == "__main__":
     
     config.clean_tempdir()
     
-    config.log.info("Taxonomic assignment results were saved to: %s", os.path.abspath(ec.out_assign_fname))
+    if not config.min_lhw_sweep:
+        config.log.info("Taxonomic assignment results were saved to: %s", os.path.abspath(ec.out_assign_fname))
     config.log.info("Execution log was saved to: %s\n", os.path.abspath(config.log_fname))
 
     elapsed_time = time.time() - start_time
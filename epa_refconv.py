@@ -0,0 +1,46 @@
+#! /usr/bin/env python
+import sys
+import os
+
+from epac.argparse import ArgumentParser
+from epac.json_util import RefJsonParser, RefJsonBuilder
+
+def parse_args():
+    parser = ArgumentParser(description="Convert reference files between json and binary sectioned formats.")
+    parser.add_argument("-i", dest="in_fname", required=True,
+            help="""Input reference file (json or binary, format is detected automatically).""")
+    parser.add_argument("-o", dest="out_fname", required=True,
+            help="""Output reference file.""")
+    parser.add_argument("-f", dest="out_format", choices=["json", "bin"], default=None,
+            help="""Output format: json or bin. Default: the opposite of the input format.""")
+    args = parser.parse_args()
+    return args
+
+def convert(in_fname, out_fname, out_format=None):
+    try:
+        refjson = RefJsonParser(in_fname)
+    except ValueError:
+        print("ERROR: Invalid reference file format: %s" % in_fname)
+        sys.exit(1)
+
+    valid, err = refjson.validate()
+    if not valid:
+        print("ERROR: Invalid reference file: %s" % err)
+        sys.exit(1)
+
+    if not out_format:
+        out_format = "json" if refjson.is_binary() else "bin"
+
+    builder = RefJsonBuilder(refjson)
+    if out_format == "bin":
+        builder.dump_binary(out_fname)
+    else:
+        builder.dump(out_fname)
+    return out_format
+
+if __name__ == "__main__":
+    if len(sys.argv) == 1:
+        sys.argv.append("-h")
+    args = parse_args()
+    out_format = convert(args.in_fname, args.out_fname, args.out_format)
+    print("Reference converted to %s format: %s" % (out_format, os.path.abspath(args.out_fname)))
@@ -14,10 +14,10 @@ from epac.argparse import ArgumentParser,RawTextHelpFormatter
 from epac.config import EpacConfig,EpacTrainerConfig
 from epac.raxml_util import RaxmlWrapper, FileUtils
 from epac.taxonomy_util import Taxonomy, TaxTreeBuilder
-from epac.json_util import RefJsonBuilder
+from epac.json_util import RefJsonParser, RefJsonStreamBuilder
 from epac.erlang import tree_param 
 from epac.msa import hmmer
-from epac.classify_util import TaxTreeHelper
+from epac.classify_util import TaxTreeHelper,BranchRankIndex
 
 class InputValidator:
     def __init__(self, config, input_tax, input_seqs, verbose=True): 
@@ -344,8 +344,9 @@ class RefTreeBuilder:
         # now we can safely unroot the tree and remove internal node labels to make it suitable for raxml
         rt.write(outfile=self.reftree_mfu_fname, format=9)
         
-    def opt_model(self):
-        bfu_fname = self.raxml_wrapper.besttree_fname(self.mfresolv_job_name)
+    def opt_model(self, bfu_fname=None):
+        if not bfu_fname:
+            bfu_fname = self.raxml_wrapper.besttree_fname(self.mfresolv_job_name)
 
         # RAxML call to optimize model parameters and write them down to the binary model file
         self.cfg.log.debug("\nOptimizing model parameters: \n")
@@ -372,24 +373,29 @@ class RefTreeBuilder:
         self.reduced_refalign_fname = self.raxml_wrapper.reduce_alignment(self.refalign_fname)
         
         self.cfg.log.debug("\nConstrained ML inference: \n")
-        raxml_params = ["-s", self.reduced_refalign_fname, "-g", self.reftree_mfu_fname, "--no-seq-check", "-N", str(self.cfg.rep_num)] 
+        raxml_params = ["-s", self.reduced_refalign_fname, "-g", self.reftree_mfu_fname, "--no-seq-check"] 
         if self.cfg.mfresolv_method  == "fast":
             raxml_params += ["-D"]
         elif self.cfg.mfresolv_method  == "ultrafast":
             raxml_params += ["-f", "e"]
-        if self.cfg.restart:
-            # resuming SATIVA execution
-            if self.raxml_wrapper.besttree_exists(self.mfresolv_job_name):
-                # if we already have a resolved tree, just use it and proceed to the next step
-                self.invocation_raxml_multif = self.raxml_wrapper.get_invocation_str(self.mfresolv_job_name)
-                self.cfg.log.debug("\nUsing existing ML tree found in: %s\n", self.raxml_wrapper.result_fname(self.mfresolv_job_name))
-            else:
-                # if raxml was interrupted mid-execution, resume from the last checkpoint
-                self.invocation_raxml_multif = self.raxml_wrapper.restart_from_checkpoint(self.mfresolv_job_name, raxml_params)
+        # tree searches run as separate RAxML processes, or sequentially within a single one (-N)
+        concurrent = self.cfg.rep_num > 1 and self.cfg.rep_parallel > 1 
+        if not concurrent:
+            raxml_params += ["-N", str(self.cfg.rep_num)]
+        if self.cfg.restart and self.raxml_wrapper.besttree_exists(self.mfresolv_job_name):
+            # resuming SATIVA execution: if we already have a resolved tree, just use it and proceed to the next step
+            self.invocation_raxml_multif = self.raxml_wrapper.get_invocation_str(self.mfresolv_job_name)
+            self.cfg.log.debug("\nUsing existing ML tree found in: %s\n", self.raxml_wrapper.result_fname(self.mfresolv_job_name))
+        elif self.cfg.restart and not concurrent:
+            # if raxml was interrupted mid-execution, resume from the last checkpoint
+            self.invocation_raxml_multif = self.raxml_wrapper.restart_from_checkpoint(self.mfresolv_job_name, raxml_params)
         else:
-            # start raxml anew
-            self.invocation_raxml_multif = self.raxml_wrapper.run(self.mfresolv_job_name, raxml_params)
-#            self.invocation_raxml_multif = self.raxml_wrapper.run_multiple(self.mfresolv_job_name, raxml_params, self.cfg.rep_num)
+            # start raxml anew (in concurrent mode, finished searches are reused when resuming)
+            if concurrent:
+                self.invocation_raxml_multif = self.raxml_wrapper.run_multiple(self.mfresolv_job_name, raxml_params, 
+                    self.cfg.rep_num, concurrent=self.cfg.rep_parallel, ratehet=self.get_lh_ratehet())
+            else:
+                self.invocation_raxml_multif = self.raxml_wrapper.run(self.mfresolv_job_name, raxml_params)
             if self.cfg.mfresolv_method  == "ultrafast":
               self.raxml_wrapper.copy_result_tree(self.mfresolv_job_name, self.raxml_wrapper.besttree_fname(self.mfresolv_job_name))
               
@@ -403,18 +409,24 @@ class RefTreeBuilder:
                 self.invocation_raxml_optmod = ""
                 job_name = self.mfresolv_job_name
                     
-            if self.cfg.raxml_model.startswith("GTRCAT"):
-              mod_name = "CAT"
-            else:
-              mod_name = "GAMMA" 
-            self.reftree_loglh = self.raxml_wrapper.get_tree_lh(job_name, mod_name)
-            self.cfg.log.debug("\n%s-based logLH of the reference tree: %f\n" % (mod_name, self.reftree_loglh))
+            self.load_tree_lh(job_name)
 
         else:
             errmsg = "RAxML run failed (mutlifurcation resolution), please examine the log for details: %s" \
                     % self.raxml_wrapper.make_raxml_fname("output", self.mfresolv_job_name)
             self.cfg.exit_fatal_error(errmsg)
             
+    def get_lh_ratehet(self):
+        if self.cfg.raxml_model.startswith("GTRCAT"):
+          return "CAT"
+        else:
+          return "GAMMA" 
+
+    def load_tree_lh(self, job_name):
+        mod_name = self.get_lh_ratehet()
+        self.reftree_loglh = self.raxml_wrapper.get_tree_lh(job_name, mod_name)
+        self.cfg.log.debug("\n%s-based logLH of the reference tree: %f\n" % (mod_name, self.reftree_loglh))
+            
     def load_reduced_refalign(self):
         formats = ["fasta", "phylip_relaxed"]
         for fmt in formats:
@@ -537,9 +549,10 @@ class RefTreeBuilder:
         json_builder.set_hmm_profile(fprofile)
         
     def write_json(self):
-        jw = RefJsonBuilder()
+        jw = RefJsonStreamBuilder(self.cfg.refjson_fname, compact=self.cfg.compact_refjson)
 
         jw.set_branch_tax_map(self.bid_ranks_map)
+        jw.set_branch_rank_index(BranchRankIndex(self.bid_ranks_map))
         jw.set_tree(self.reftree_lbl_str)
         jw.set_outgroup(self.reftree_outgroup)
         jw.set_ratehet_model(self.cfg.raxml_model)
@@ -565,7 +578,7 @@ class RefTreeBuilder:
                 }
         jw.set_metadata(mdata)
 
-        seqs = self.reduced_refalign_seqs.get_entries()    
+        seqs = ((name, seq, comment) for name, seq, comment, sid in self.reduced_refalign_seqs.iter_entries())
         jw.set_sequences(seqs)
         
         if not self.cfg.no_hmmer:
@@ -615,6 +628,224 @@ class RefTreeBuilder:
         self.cfg.log.info("==========> Saving the reference JSON file: %s\n" % self.cfg.refjson_fname)
         self.write_json()
 
+class RefTreeUpdater(RefTreeBuilder):
+    """Adds new sequences to an existing reference without re-building it from scratch: new sequences
+       are placed onto the reference tree with EPA and inserted at their best-scoring branches. 
+       Branch labels, node heights and taxonomy maps are then re-computed as in a normal training run."""
+    MIN_BRLEN = 1e-6
+    # RAxML writes reduced alignment in upper case, with U replaced by T and undetermined characters by gaps
+    NORM_TRANTAB = maketrans("?NOXU", "----T")
+
+    def __init__(self, config, old_refjson_fname, reopt_model=False):
+        RefTreeBuilder.__init__(self, config)
+        self.old_refjson_fname = old_refjson_fname
+        self.reopt_model = reopt_model
+        self.epaupd_job_name = self.cfg.subst_name("epaupd_%NAME%")
+        self.evalupd_job_name = self.cfg.subst_name("evalupd_%NAME%")
+        self.updalign_fname = self.cfg.tmp_fname("%NAME%_upd.fa")
+
+    @staticmethod
+    def normalize_seq(seq):
+        return seq.upper().translate(RefTreeUpdater.NORM_TRANTAB)
+
+    @staticmethod
+    def insert_placements(tree, placements):
+        """Inserts query sequences into the EPA-labeled tree, each at its best-scoring branch. 
+           Several sequences placed on the same branch are attached along it ordered by distal length."""
+        bid_node_map = {}
+        for node in tree.traverse():
+            if hasattr(node, "B"):
+                bid_node_map[str(node.B)] = node
+        
+        branch_seqs = {}
+        for place in placements:
+            edge = max(place["p"], key=lambda e: e[2])
+            branch_seqs.setdefault(str(edge[0]), []).append((edge[3], edge[4], place["n"][0]))
+            
+        for bid, seqs in branch_seqs.iteritems():
+            node = bid_node_map[bid]
+            parent = node.up
+            brlen = node.dist
+            node.detach()
+            # distal length is measured from the lower (child) node, so go from the parent downwards
+            pos = 0.
+            for distal, pendant, seq_name in sorted(seqs, reverse=True):
+                new_pos = min(max(brlen - distal, pos), brlen)
+                parent = parent.add_child(dist=max(new_pos - pos, RefTreeUpdater.MIN_BRLEN))
+                parent.add_child(name=seq_name, dist=max(pendant, RefTreeUpdater.MIN_BRLEN))
+                pos = new_pos
+            parent.add_child(child=node, dist=max(brlen - pos, RefTreeUpdater.MIN_BRLEN))
+            
+        return tree
+
+    def load_reference(self):
+        try:
+            self.refjson = RefJsonParser(self.old_refjson_fname)
+        except ValueError:
+            self.cfg.exit_user_error("ERROR: Invalid json file format: %s" % self.old_refjson_fname)
+        (valid, err) = self.refjson.validate()
+        if not valid:
+            self.cfg.exit_user_error("ERROR: Parsing reference JSON file failed:\n%s" % err)
+            
+        # model settings must be the same as in the original reference
+        self.cfg.raxml_model = self.refjson.get_ratehet_model()
+        self.cfg.compress_patterns = self.refjson.get_pattern_compression()
+        self.cfg.taxcode_name = self.refjson.get_taxcode()
+        # json module returns unicode strings, whereas ete2 and Taxonomy expect utf-8 encoded str
+        self.old_taxonomy = {}
+        for sid, ranks in self.refjson.get_origin_taxonomy().iteritems():
+            self.old_taxonomy[sid.encode("utf-8")] = [rank.encode("utf-8") for rank in ranks]
+        self.old_metadata = self.refjson.get_metadata()
+        self.reduced_refalign_seqs = self.refjson.get_ref_alignment()
+        self.refjson.get_raxml_readable_tree(self.reftree_bfu_fname)
+        self.refjson.get_binary_model(self.optmod_fname)
+        
+        self.invocation_raxml_multif = self.old_metadata.get("invocation_raxml_multif", "")
+        self.invocation_raxml_optmod = self.old_metadata.get("invocation_raxml_optmod", "")
+        self.reftree_loglh = None
+
+    def load_new_seqs(self):
+        self.taxonomy = Taxonomy(prefix=EpacConfig.REF_SEQ_PREFIX, tax_fname=self.cfg.taxonomy_fname)
+        self.load_alignment()
+        self.merge_synonyms()
+
+        self.input_validator = InputValidator(self.cfg, self.taxonomy, self.input_seqs)
+        self.input_validator.check_seq_ids()
+        self.input_validator.check_invalid_chars()
+
+        # new sequences must be assigned to the taxa merged in the original reference, if any
+        self.input_validator.merged_ranks = self.refjson.get_merged_ranks_map()
+        merged_map = {}
+        for merged_rank_id, dup_ranks in self.input_validator.merged_ranks.iteritems():
+            for rank_id in dup_ranks:
+                merged_map[rank_id] = merged_rank_id
+        
+        self.taxonomy.close_taxonomy_gaps()
+
+        # original ids of the new sequences, as they appear in alignment
+        self.new_seq_names = {}
+        corr_seqid_reverse = dict((reversed(item) for item in self.input_validator.corr_seqid.items()))
+        tax_map = dict(self.old_taxonomy)
+        for sid, ranks in self.taxonomy.iteritems():
+            if sid not in self.old_taxonomy:
+                rank_id = Taxonomy.get_rank_uid(ranks)
+                if rank_id in merged_map:
+                    ranks = Taxonomy.split_rank_uid(merged_map[rank_id].encode("utf-8"))
+                tax_map[sid] = ranks
+                self.new_seq_names[sid] = EpacConfig.strip_ref_prefix(corr_seqid_reverse.get(sid, sid))
+
+        # refjson stores reverse maps (new name -> original name)
+        for new_name, old_name in self.refjson.get_corr_ranks_map().iteritems():
+            self.input_validator.corr_ranks.setdefault(old_name, new_name)
+        for new_name, old_name in self.refjson.get_corr_seqid_map().iteritems():
+            self.input_validator.corr_seqid.setdefault(old_name, new_name)
+
+        self.taxonomy = Taxonomy(prefix=EpacConfig.REF_SEQ_PREFIX, tax_map=tax_map)
+
+    def get_column_mask(self):
+        """Returns the list of alignment columns which have been retained in the reference alignment. 
+           RAxML removes all columns which consist of gaps/undetermined characters only (-f c), so if the 
+           new sequences come with the full original alignment, we have to remove the same columns."""
+        ref_width = self.refjson.get_alignment_length()
+        in_width = len(self.input_seqs.get_seqbyid(0))
+        if in_width == ref_width:
+            return None
+        
+        in_seqs = []
+        for name, seq, comment, sid in self.reduced_refalign_seqs.iter_entries():
+            in_name = EpacConfig.strip_ref_prefix(self.refjson.get_uncorr_seqid(name))
+            if not self.input_seqs.has_seq(in_name):
+                errmsg = "ERROR: Width of the input alignment (%d) differs from the reference alignment (%d).\n" % (in_width, ref_width) + \
+                         "Please either align new sequences to the reference alignment, or provide the full alignment including all reference sequences."
+                self.cfg.exit_user_error(errmsg)
+            in_seqs.append((seq, RefTreeUpdater.normalize_seq(self.input_seqs.get_seq(in_name))))
+        
+        cols = [i for i in range(in_width) if any(in_seq[i] != "-" for ref_seq, in_seq in in_seqs)]
+        for ref_seq, in_seq in in_seqs:
+            if "".join(in_seq[i] for i in cols) != ref_seq:
+                self.cfg.exit_user_error("ERROR: Input alignment is not compatible with the reference alignment.")
+        return cols
+        
+    def export_update_alignment(self):
+        cols = self.get_column_mask()
+        self.new_seq_ids = [sid for sid in self.new_seq_names if sid in self.reftree_ids]
+        for sid in self.new_seq_ids:
+            seq = RefTreeUpdater.normalize_seq(self.input_seqs.get_seq(self.new_seq_names[sid]))
+            if cols:
+                seq = "".join(seq[i] for i in cols)
+            self.reduced_refalign_seqs.set_seq(sid, seq)
+        self.reduced_refalign_seqs.write(format="fasta", outfile=self.updalign_fname)
+        self.reduced_refalign_fname = self.updalign_fname
+        self.load_reduced_refalign()
+        
+        # we do not need the original alignment anymore, so free its memory
+        self.input_seqs = None
+
+    def check_reftree_ids(self):
+        missing_ids = [sid for sid in self.old_taxonomy if sid not in self.reftree_ids]
+        if len(missing_ids) > 0:
+            errmsg = "ERROR: %d sequence(s) from the original reference have been excluded by taxonomy filters (see [reftree] config section)" % len(missing_ids)
+            self.cfg.exit_user_error(errmsg)
+
+    def place_new_seqs(self):
+        epa_result = self.raxml_wrapper.run_epa(self.epaupd_job_name, self.updalign_fname, self.reftree_bfu_fname, self.optmod_fname, mode="epa")
+        tree = Tree(epa_result.get_std_newick_tree())
+        RefTreeUpdater.insert_placements(tree, epa_result.iter_placements())
+        tree.write(outfile=self.reftree_bfu_fname, format=5)
+
+    def reopt_branch_lengths(self):
+        self.opt_model(self.reftree_bfu_fname)
+        self.load_tree_lh(self.optmod_job_name)
+
+    def eval_tree_lh(self):
+        """Computes logLH of the updated tree with the model parameters of the original reference, which 
+           are not re-optimized (-R). Branch lengths are optimized for the evaluation only: updated tree 
+           and model file are left unchanged."""
+        raxml_params = ["-f", "e", "-s", self.reduced_refalign_fname, "-t", self.reftree_bfu_fname, "-R", self.optmod_fname, "--no-seq-check"]
+        if self.cfg.raxml_model.startswith("GTRCAT") and not self.cfg.compress_patterns:
+            raxml_params +=  ["-H"]
+        if self.cfg.restart and self.raxml_wrapper.result_exists(self.evalupd_job_name):
+            self.cfg.log.debug("\nUsing existing tree evaluation found in: %s\n", self.raxml_wrapper.info_fname(self.evalupd_job_name))
+        else:
+            self.raxml_wrapper.run(self.evalupd_job_name, raxml_params)
+        if not self.raxml_wrapper.result_exists(self.evalupd_job_name):
+            errmsg = "RAxML run failed (tree evaluation), please examine the log for details: %s" \
+                    % self.raxml_wrapper.make_raxml_fname("output", self.evalupd_job_name)
+            self.cfg.exit_fatal_error(errmsg)
+        self.load_tree_lh(self.evalupd_job_name)
+        
+    # top-level function to update a reference tree    
+    def build_ref_tree(self):
+        self.cfg.log.info("=> Loading reference from file: %s ...\n" , self.old_refjson_fname)
+        self.load_reference()
+        self.cfg.log.info("==> Loading new sequences from files: %s, %s ...\n" , self.cfg.taxonomy_fname, self.cfg.align_fname)
+        self.load_new_seqs()
+        self.cfg.log.info("===> Building a multifurcating tree from taxonomy with %d seqs ...\n" , self.taxonomy.seq_count())
+        self.build_multif_tree()
+        self.check_reftree_ids()
+        self.export_ref_taxonomy()
+        self.export_update_alignment()
+        if len(self.new_seq_ids) == 0:
+            self.cfg.exit_user_error("ERROR: No new sequences found, reference is up-to-date.")
+        self.cfg.log.info("====> Saving the outgroup for later re-rooting ...\n")
+        self.save_rooting()
+        self.cfg.log.info("=====> Calling RAxML-EPA to place %d new sequences ...\n", len(self.new_seq_ids))
+        self.place_new_seqs()
+        if self.reopt_model:
+            self.cfg.log.info("======> Re-optimizing branch lengths and model parameters ...\n")
+            self.reopt_branch_lengths()
+        else:
+            self.cfg.log.info("======> Computing the likelihood of the updated tree ...\n")
+            self.eval_tree_lh()
+        self.cfg.log.info("=======> Calling RAxML-EPA to obtain branch labels ...\n")
+        self.epa_branch_labeling()
+        self.cfg.log.info("========> Post-processing the EPA tree (re-rooting, taxonomic labeling etc.) ...\n")
+        self.epa_post_process()
+        self.calc_node_heights()
+        
+        self.cfg.log.info("=========> Saving the reference JSON file: %s\n" % self.cfg.refjson_fname)
+        self.write_json()
+
 def parse_args():
     parser = ArgumentParser(description="Build a reference tree for EPA taxonomic placement.",
     epilog="Example: ./epa_trainer.py -t example/training_tax.txt -s example/training_seq.fa -n myref",
@@ -644,6 +875,10 @@ information needed for taxonomic placement of query sequences.""")
             ultrafast   optimize model+branch lengths only (RAxML -f e option)""")
     parser.add_argument("-N", dest="rep_num", type=int, default=1, 
             help="""Number of RAxML tree searches (with distinct random seeds). Default: 1""")
+    parser.add_argument("-Np", dest="rep_parallel", type=int, default=1, 
+            help="""Number of RAxML tree searches (-N) to run concurrently as separate processes; threads (-T)
+            are split evenly between them, but every process gets at least 2 threads (so at most T/2 searches
+            run at a time). Default: 1 (all searches are performed by a single RAxML process)""")
     parser.add_argument("-x", dest="taxcode_name", choices=["bac", "bot", "zoo", "vir"], type = str.lower,
             help="""Taxonomic code: BAC(teriological), BOT(anical), ZOO(logical), VIR(ological)""")
     parser.add_argument("-R", dest="restart", action="store_true",
@@ -672,6 +907,11 @@ Run name of the previous (terminated) job must be specified via -n option.""")
             autofix     try to guess wich ranks should be added or removed (use with caution!)""")
     parser.add_argument("-tmpdir", dest="temp_dir", default=None,
             help="""Directory for temporary files.""")
+    parser.add_argument("-update", dest="update_fname", default=None,
+            help="""Update existing reference: add sequences from -t/-s files to the reference tree
+using EPA placement, instead of building a new reference from scratch.""")
+    parser.add_argument("-update-opt", dest="update_opt", action="store_true",
+            help="""Re-optimize branch lengths and model parameters of the updated tree (RAxML -f e).""")
     
     if len(sys.argv) < 4:
         parser.print_help()
@@ -721,10 +961,18 @@ def check_args(args):
         print "Please check if directory %s exists and you have write permissions for it." % os.path.split(os.path.abspath(args.ref_fname))[0]
         sys.exit()
         
+    if args.update_fname and not os.path.isfile(args.update_fname):
+        print "ERROR: Reference file not found: %s" % args.update_fname
+        sys.exit()
+
     if args.rep_num < 1 or args.rep_num > 1000:
         print "ERROR: Number of RAxML runs must be between 1 and 1000."
         sys.exit()
 
+    if args.rep_parallel < 1:
+        print "ERROR: Number of concurrent RAxML runs must be at least 1."
+        sys.exit()
+
 def which(program, custom_path=[]):
     def is_exe(fpath):
         return os.path.isfile(fpath) and os.access(fpath, os.X_OK)
@@ -752,9 +1000,12 @@ def check_dep(config):
             print "or call this script with -no-hmmer option to skip building HMMER profile." 
             config.exit_user_error()
             
-def run_trainer(config):
+def run_trainer(config, update_fname=None, update_opt=False):
     check_dep(config)
-    builder = RefTreeBuilder(config)
+    if update_fname:
+        builder = RefTreeUpdater(config, update_fname, update_opt)
+    else:
+        builder = RefTreeBuilder(config)
     builder.invocation_epac = " ".join(sys.argv)
     builder.build_ref_tree()
         
@@ -765,13 +1016,15 @@ if __name__ == "__main__":
     args = parse_args()
     check_args(args)
     config = EpacTrainerConfig(args)
+    # terminate RAxML & co. if we are killed (e.g. job time limit on a cluster)
+    config.get_scheduler().install_signal_handler()
 
     print ""
     config.print_version("SATIVA-trainer")
 
     start_time = time.time()
 
-    run_trainer(config)
+    run_trainer(config, args.update_fname, args.update_opt)
     config.clean_tempdir()
 
     config.log.info("Reference JSON was saved to: %s", os.path.abspath(config.refjson_fname))
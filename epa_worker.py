@@ -0,0 +1,36 @@
+#! /usr/bin/env python
+import sys
+import os
+import logging
+import multiprocessing
+
+from epac.argparse import ArgumentParser
+from epac.executor import DirQueueWorker
+
+def parse_args():
+    parser = ArgumentParser(description="""Run jobs from a shared directory queue (backend=dirqueue in [cluster] section
+            of the config file). Any number of workers can be started on hosts which see the queue directory.""")
+    parser.add_argument("-d", dest="queue_dir", required=True,
+            help="""Queue directory (queue_dir in [cluster] section of the config file).""")
+    parser.add_argument("-T", dest="num_threads", type=int, default=multiprocessing.cpu_count(),
+            help="""Number of threads shared by the jobs this worker runs at the same time.
+                    Default: number of CPU cores""")
+    parser.add_argument("-exit-when-empty", dest="exit_when_empty", action="store_true", default=False,
+            help="""Exit once there are no pending or running jobs left, instead of waiting for new ones.""")
+    args = parser.parse_args()
+    return args
+
+if __name__ == "__main__":
+    if len(sys.argv) == 1:
+        sys.argv.append("-h")
+    args = parse_args()
+
+    log = logging.getLogger('epac.worker')
+    log.setLevel(logging.INFO)
+    log.addHandler(logging.StreamHandler())
+
+    worker = DirQueueWorker(os.path.abspath(args.queue_dir), args.num_threads, log)
+    # running jobs are terminated and put back into the queue if the worker is killed
+    worker.scheduler.install_signal_handler()
+    log.info("Worker started: %s, %d thread(s)\n", os.path.abspath(args.queue_dir), args.num_threads)
+    worker.run(args.exit_when_empty)
@@ -0,0 +1,233 @@
+#! /usr/bin/env python
+import os
+import hashlib
+import fcntl
+import tempfile
+import json
+import gc
+from contextlib import contextmanager
+
+from ete2 import Tree
+from classify_util import BranchRankIndex
+
+class RefSnapshot:
+    """Pre-parsed reference objects (trees, taxonomy, branch maps), which are expensive to 
+       re-create from the refjson on every run. Snapshot is stored as plain JSON (never pickled, 
+       since the cache can be shared between users): trees as flat preorder node lists, and 
+       branch rank index in its refjson format (s. BranchRankIndex.to_json)."""
+    VERSION = 2
+    BASIC_FEATURES = frozenset(["dist", "support", "name"])
+
+    @staticmethod
+    @contextmanager
+    def gc_paused():
+        """Loading creates millions of objects at once, and repeated garbage collection passes
+           over them would take more time than the loading itself"""
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            yield
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    @staticmethod
+    def flatten_tree(tree):
+        nodes = []
+        node_ids = {}
+        for node in tree.traverse("preorder"):
+            parent_id = node_ids[id(node.up)] if node.up else -1
+            node_ids[id(node)] = len(nodes)
+            extra = dict((f, getattr(node, f)) for f in node.features if f not in RefSnapshot.BASIC_FEATURES)
+            nodes.append((parent_id, node.name, node.dist, node.support, extra))
+        return nodes
+
+    @staticmethod
+    def unflatten_tree(nodes):
+        # node attributes are set directly (s. TreeNode.__init__), since the constructor and 
+        # add_child() would otherwise take most of the loading time for large trees
+        tree_nodes = []
+        with RefSnapshot.gc_paused():
+            for parent_id, name, dist, support, extra in nodes:
+                parent = tree_nodes[parent_id] if parent_id >= 0 else None
+                node = Tree.__new__(Tree)
+                node.__dict__.update(_children=[], _up=parent, _dist=dist, _support=support, _img_style=None,
+                                     features=set(RefSnapshot.BASIC_FEATURES), name=name)
+                if extra:
+                    node.__dict__.update(extra)
+                    node.features.update(extra.iterkeys())
+                if parent:
+                    parent._children.append(node)
+                tree_nodes.append(node)
+        return tree_nodes[0]
+
+    @staticmethod
+    def build(refjson):
+        bid_tax_map = refjson.get_branch_tax_map()
+        rank_index = refjson.get_branch_rank_index(bid_tax_map)
+        data = {"version": RefSnapshot.VERSION,
+                "rate": refjson.get_rate(),
+                "node_height": refjson.get_node_height(),
+                "origin_taxonomy": refjson.get_origin_taxonomy(),
+                "branch_tax_map": bid_tax_map,
+                "branch_rank_index": rank_index.to_json() if rank_index != None else None,
+                "reftree": RefSnapshot.flatten_tree(refjson.get_reftree()),
+                "raxml_reftree": RefSnapshot.flatten_tree(Tree(refjson.get_raxml_readable_tree())),
+                "tax_tree": RefSnapshot.flatten_tree(refjson.get_tax_tree())
+               }
+        return RefSnapshot(data)
+
+    @staticmethod
+    def load(fname):
+        with open(fname, "rb") as fin:
+            with RefSnapshot.gc_paused():
+                data = json.load(fin)
+        if not isinstance(data, dict) or data.get("version") != RefSnapshot.VERSION:
+            raise ValueError("Unsupported reference snapshot version: %s" % fname)
+        return RefSnapshot(data)
+
+    def __init__(self, data):
+        self.data = data
+        self.branch_rank_index = None
+
+    def save(self, fname):
+        with open(fname, "wb") as fout:
+            json.dump(self.data, fout)
+
+    def get_rate(self):
+        return self.data["rate"]
+
+    def get_node_height(self):
+        return self.data["node_height"]
+
+    def get_origin_taxonomy(self):
+        return self.data["origin_taxonomy"]
+
+    def get_branch_tax_map(self):
+        return self.data["branch_tax_map"]
+
+    def get_branch_rank_index(self, bid_tax_map=None):
+        if self.branch_rank_index is None and self.data["branch_rank_index"] != None:
+            self.branch_rank_index = BranchRankIndex.from_json(self.data["branch_rank_index"])
+        return self.branch_rank_index
+
+    def get_reftree(self):
+        return RefSnapshot.unflatten_tree(self.data["reftree"])
+
+    def get_raxml_reftree(self):
+        return RefSnapshot.unflatten_tree(self.data["raxml_reftree"])
+
+    def get_tax_tree(self):
+        return RefSnapshot.unflatten_tree(self.data["tax_tree"])
+
+class RefArtifactCache:
+    """Host-wide cache of files derived from a reference (tree, binary model, alignment etc.).
+       Artifacts are stored in a separate directory for every reference, which is keyed by
+       the hash of the reference file content, so that different jobs using the same reference
+       can share them. Artifacts are created under an exclusive file lock and published with an
+       atomic rename, so readers never see incomplete files."""
+    LOCK_SUFFIX = ".lock"
+    HASH_BLOCK_SIZE = 1024 * 1024
+
+    REFTREE = "ref.tre"
+    BINARY_MODEL = "ref.opt"
+    ALIGNMENT = "ref.afa"
+    HMM_PROFILE = "ref.hmm"
+    SNAPSHOT = "ref.v%d.snap" % RefSnapshot.VERSION
+
+    @staticmethod
+    def file_hash(fname):
+        h = hashlib.sha1()
+        with open(fname, "rb") as fin:
+            while True:
+                block = fin.read(RefArtifactCache.HASH_BLOCK_SIZE)
+                if not block:
+                    break
+                h.update(block)
+        return h.hexdigest()
+
+    def __init__(self, cfg, refjson_fname, refjson):
+        self.cfg = cfg
+        self.refjson = refjson
+        self.ref_hash = RefArtifactCache.file_hash(refjson_fname)
+        self.cache_dir = os.path.join(cfg.ref_cache_dir, self.ref_hash)
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                # directory has been created by a concurrent job
+                if not os.path.isdir(self.cache_dir):
+                    raise
+
+    @contextmanager
+    def lock(self, name):
+        """Exclusive lock for a single artifact (artifacts can depend on each other, so they are 
+           locked independently)"""
+        lock_fname = os.path.join(self.cache_dir, name + RefArtifactCache.LOCK_SUFFIX)
+        with open(lock_fname, "a") as flock:
+            fcntl.flock(flock.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(flock.fileno(), fcntl.LOCK_UN)
+
+    def get_artifact(self, name, create_func):
+        """Returns the path to the cached artifact, creating it first if needed.
+           create_func(tmp_fname) must write the artifact into tmp_fname, and return False
+           if the artifact cannot be created (e.g. corresponding field is missing in refjson)."""
+        fname = os.path.join(self.cache_dir, name)
+        if os.path.isfile(fname):
+            self.cfg.log.debug("Reference cache hit: %s", fname)
+            return fname
+
+        with self.lock(name):
+            # other job could have created the artifact while we were waiting for the lock
+            if not os.path.isfile(fname):
+                fd, tmp_fname = tempfile.mkstemp(prefix=name + ".", dir=self.cache_dir)
+                os.close(fd)
+                # cache can be shared between users
+                os.chmod(tmp_fname, 0644)
+                try:
+                    if create_func(tmp_fname) == False:
+                        return None
+                    os.rename(tmp_fname, fname)
+                    self.cfg.log.debug("Reference cache: created %s", fname)
+                finally:
+                    if os.path.isfile(tmp_fname):
+                        os.remove(tmp_fname)
+        return fname
+
+    def get_reftree(self):
+        return self.get_artifact(RefArtifactCache.REFTREE, self.refjson.get_raxml_readable_tree)
+
+    def get_binary_model(self):
+        return self.get_artifact(RefArtifactCache.BINARY_MODEL, self.refjson.get_binary_model)
+
+    def get_alignment(self):
+        return self.get_artifact(RefArtifactCache.ALIGNMENT, self.refjson.get_alignment)
+
+    def get_hmm_profile(self, build_func=None):
+        """Returns HMM profile from refjson; if there is none, it is built with build_func(aln_fname, out_fname)"""
+        def create_profile(tmp_fname):
+            if self.refjson.get_hmm_profile(tmp_fname):
+                return True
+            elif build_func:
+                build_func(self.get_alignment(), tmp_fname)
+                return os.path.isfile(tmp_fname) and os.path.getsize(tmp_fname) > 0
+            else:
+                return False
+        return self.get_artifact(RefArtifactCache.HMM_PROFILE, create_profile)
+
+    def get_snapshot(self):
+        """Returns RefSnapshot of the reference, or None if it could not be created or loaded"""
+        snapshot = []
+        def create_snapshot(tmp_fname):
+            snapshot.append(RefSnapshot.build(self.refjson))
+            snapshot[0].save(tmp_fname)
+
+        try:
+            fname = self.get_artifact(RefArtifactCache.SNAPSHOT, create_snapshot)
+            return snapshot[0] if snapshot else RefSnapshot.load(fname)
+        except ValueError, e:
+            self.cfg.log.debug("Reference snapshot could not be loaded: %s", str(e))
+            return None
@@ -2,6 +2,22 @@
 from taxonomy_util import Taxonomy
 from erlang import erlang
 import math
+import itertools
+import collections
+import multiprocessing
+
+# classifier object used by worker processes in TaxClassifyHelper.iter_classify(). 
+# It is set before the pool is created, so that workers inherit it on fork() and 
+# branch maps don't have to be pickled and sent with every chunk
+_mp_classify_helper = None
+
+def _mp_classify_chunk(args):
+    minlw, chunk = args
+    stats = _mp_classify_helper.get_stats()
+    results = [_mp_classify_helper.classify_placement(edges, minlw) for edges in chunk]
+    # return counters as well, since they are not shared with the parent process
+    new_stats = _mp_classify_helper.get_stats()
+    return results, [new - old for new, old in zip(new_stats, stats)]
 
 class TaxTreeHelper:
     def __init__(self, cfg, tax_map, tax_tree=None):
@@ -163,57 +179,308 @@ class TaxTreeHelper:
         
         return ranks[0:rank_level]   
     
+class BranchRankIndex:
+    """Branch x rank-prefix incidence matrix of the reference tree.
+    
+    Columns are rank paths ("rank uids"), rows are tree branches. Each row keeps
+    the columns a placement onto this branch contributes to, i.e. all non-empty 
+    rank prefixes ("total" weight), the lowest rank and (if the branch spans 
+    several rank levels) its parent rank ("own" weight) and the interim ranks 
+    whose total weight must be corrected. Building it once per reference saves 
+    us from splitting and re-joining rank uids for every placement edge.
+    
+    The index is stored in the refjson (s. to_json()) using integer rank path ids, 
+    so that it can be loaded without any string processing."""
+    
+    def __init__(self, bid_taxonomy_map=None):
+        self.rank_uids = []
+        self.rank_uid_ids = {}
+        self.rows = {}
+        self.branch_ranks = {}
+        if bid_taxonomy_map:
+            self.build(bid_taxonomy_map)
+
+    def __len__(self):
+        return len(self.rows)
+        
+    def __contains__(self, br_id):
+        return br_id in self.rows
+
+    def get_rank_id(self, rank_uid):
+        rank_id = self.rank_uid_ids.get(rank_uid, None)
+        if rank_id is None:
+            rank_id = len(self.rank_uids)
+            self.rank_uids.append(rank_uid)
+            self.rank_uid_ids[rank_uid] = rank_id
+        return rank_id
+        
+    def build(self, bid_taxonomy_map):
+        for br_id, br_rec in bid_taxonomy_map.iteritems():
+            self.add_branch(br_id, br_rec[0], br_rec[1])
+        
+    def add_branch(self, br_id, br_rank_id, rdiff):
+        ranks = Taxonomy.split_rank_uid(br_rank_id)
+        prefix_ids = []
+        for i in range(len(ranks)):
+            if ranks[i] != Taxonomy.EMPTY_RANK:
+                prefix_ids.append(self.get_rank_id(Taxonomy.get_rank_uid(ranks, i)))
+            else:
+                break
+
+        parent_id = None
+        if len(prefix_ids) > 0 and rdiff > 0:
+            lowest_rank_lvl = len(prefix_ids) - 1
+            parent_id = self.get_rank_id(Taxonomy.get_rank_uid(ranks, lowest_rank_lvl - rdiff))
+        
+        self.set_row(br_id, self.get_rank_id(br_rank_id), prefix_ids, rdiff, parent_id)
+        
+    def set_row(self, br_id, rank_path_id, prefix_ids, rdiff, parent_id):
+        # rows hold rank uid strings rather than column ids: they are used as dict keys in 
+        # the accumulation loop, and we want to avoid an extra lookup per edge and rank
+        uids = self.rank_uids
+        total_uids = tuple([uids[i] for i in prefix_ids])
+        own_uid = total_uids[-1] if len(total_uids) > 0 else None
+        if parent_id is not None:
+            parent_uid = uids[parent_id]
+            lowest_rank_lvl = len(prefix_ids) - 1
+            interim_uids = tuple([total_uids[lowest_rank_lvl - r] for r in range(rdiff)])
+        else:
+            parent_uid = None
+            interim_uids = ()
+        self.rows[br_id] = (uids[rank_path_id], total_uids, own_uid, parent_uid, interim_uids)
+        
+    def get_row(self, br_id):
+        return self.rows[br_id]
+        
+    def get_branch_ranks(self, br_id):
+        ranks = self.branch_ranks.get(br_id, None)
+        if ranks is None:
+            ranks = Taxonomy.split_rank_uid(self.rows[br_id][0])
+            self.branch_ranks[br_id] = ranks
+        return ranks
+
+    def to_json(self):
+        """returns index as a dict suitable for storing in the refjson: 
+              rank_paths: list of rank uids, list position serves as rank path id
+              branches:   br_id -> [rank_path_id, rank_level, rdiff, prefix_ids, parent_id]"""
+        uid_ids = self.rank_uid_ids
+        branches = {}
+        for br_id, row in self.rows.iteritems():
+            rank_path_id, total_uids, own_uid, parent_uid, interim_uids = row
+            prefix_ids = [uid_ids[uid] for uid in total_uids]
+            parent_id = uid_ids[parent_uid] if parent_uid is not None else -1
+            branches[br_id] = [uid_ids[rank_path_id], len(prefix_ids) - 1, len(interim_uids), prefix_ids, parent_id]
+        return { "rank_paths": self.rank_uids, "branches": branches }
+
+    @staticmethod
+    def from_json(jindex):
+        index = BranchRankIndex()
+        index.rank_uids = jindex["rank_paths"]
+        index.rank_uid_ids = dict((uid, i) for i, uid in enumerate(index.rank_uids))
+        for br_id, br_rec in jindex["branches"].iteritems():
+            rank_path_id, rank_level, rdiff, prefix_ids, parent_id = br_rec
+            if parent_id < 0:
+                parent_id = None
+            index.set_row(br_id, rank_path_id, prefix_ids, rdiff, parent_id)
+        return index
+            
 class TaxClassifyHelper:
-    def __init__(self, cfg, bid_taxonomy_map, sp_rate = 0., node_height = []):
+    # safety margin for floating point errors in early termination check (s. find_certain_rank)
+    EARLY_EXIT_EPS = 1e-9
+
+    def __init__(self, cfg, bid_taxonomy_map, sp_rate = 0., node_height = [], rank_index = None):
         self.cfg = cfg
         self.bid_taxonomy_map = bid_taxonomy_map
         self.sp_rate = sp_rate
         self.node_height = node_height
         self.erlang = erlang()
+        self.node_height_k = None
+        self.rank_index = rank_index
         # hardcoded for now
         self.parent_lhw_coeff = 0.49
+        # LRU cache: placement signature -> (ranks, lws)
+        self.cache = collections.OrderedDict()
+        self.cache_size = getattr(cfg, "classify_cache_size", 0)
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # number of edges skipped by early termination in assign_taxonomy_maxsum_fast()
+        self.skipped_edges = 0
+
+    def get_rank_index(self):
+        if self.rank_index is None:
+            self.rank_index = BranchRankIndex(self.bid_taxonomy_map)
+        return self.rank_index
+
+    def get_placement_signature(self, edges, minlw):
+        """Placements with the same edges and exactly the same likelihood weights
+        will get the same taxonomic assignment. Likelihoods and pendant lengths only 
+        matter if Erlang branch length test is active (s. erlang_filter)."""
+        if self.cfg.brlen_pv > 0.:
+            sig = tuple([(edge[0], edge[1], edge[2], edge[4]) for edge in edges])
+        else:
+            sig = tuple([(edge[0], edge[2]) for edge in edges])
+        return (minlw, sig)
 
     def classify_seq(self, edges, minlw = None):
-        if not minlw:
+        # explicit zero threshold must not be replaced by the config value
+        if minlw is None:
             minlw = self.cfg.min_lhw
+        
+        if self.cache_size <= 0:
+            return self.classify_edges(edges, minlw)
 
+        sig = self.get_placement_signature(edges, minlw)
+        res = self.cache.pop(sig, None)
+        if res is None:
+            self.cache_misses += 1
+            res = self.classify_edges(edges, minlw)
+            while len(self.cache) >= self.cache_size:
+                self.cache.popitem(last=False)
+        else:
+            self.cache_hits += 1
+        # (re-)insert as most recently used entry
+        self.cache[sig] = res
+        ranks, lws = res
+        return list(ranks), list(lws)
+
+    def get_stats(self):
+        return [self.cache_hits, self.cache_misses, self.skipped_edges]
+        
+    def add_stats(self, stats):
+        hits, misses, skipped = stats
+        self.cache_hits += hits
+        self.cache_misses += misses
+        self.skipped_edges += skipped
+
+    def classify_seq_multi(self, edges, minlw_list):
+        """classify placement for each of min_lhw thresholds in minlw_list, returns list of (ranks, lws)"""
         edges = self.erlang_filter(edges)
         if len(edges) > 0:
             if self.cfg.taxassign_method == "1":
-                ranks, lws = self.assign_taxonomy_maxsum(edges, minlw)
+                return self.assign_taxonomy_maxsum_multi(edges, minlw_list)
+            else:
+                ranks, lws = self.assign_taxonomy_maxlh(edges)
+                return [(list(ranks), list(lws)) for minlw in minlw_list]
+        else:
+            return [([], []) for minlw in minlw_list]
+
+    def classify_placement(self, edges, minlw):
+        if isinstance(minlw, list):
+            return self.classify_seq_multi(edges, minlw)
+        else:
+            return self.classify_seq(edges, minlw)
+        
+    def log_stats(self):
+        total = self.cache_hits + self.cache_misses
+        if total > 0:
+            self.cfg.log.info("Classification cache: %d hits, %d misses (hit rate: %.1f%%)\n", 
+                self.cache_hits, self.cache_misses, 100. * self.cache_hits / total)
+        if self.skipped_edges > 0:
+            self.cfg.log.info("Edges skipped by early termination: %d\n", self.skipped_edges)
+
+    def classify_edges(self, edges, minlw):
+        edges = self.erlang_filter(edges)
+        if len(edges) > 0:
+            if self.cfg.taxassign_method == "1":
+                ranks, lws = self.assign_taxonomy_maxsum_fast(edges, minlw)
             else:
                 ranks, lws = self.assign_taxonomy_maxlh(edges)
             return ranks, lws
         else:
             return [], []      
+
+    def classify_many(self, placements, minlw = None):
+        """classify a batch of EPA placements (as found in .jplace "placements" list),
+        returns a list of (ranks, lws) tuples in the same order"""
+        return [(ranks, lws) for place, ranks, lws in self.iter_classify(placements, minlw)]
+
+    def iter_classify(self, placements, minlw = None, num_procs = 1, chunk_size = 1000):
+        """classify EPA placements (list or any iterable, e.g. EpaJsonStreamParser.iter_placements()), 
+        yielding (placement, ranks, lws) tuples in the input order.
+        If num_procs > 1, placements are split into chunks which are classified by a 
+        pool of worker processes. At most 2 * num_procs chunks are kept in memory at once."""
+        for place, (ranks, lws) in self.iter_placement_results(placements, minlw, num_procs, chunk_size):
+            yield place, ranks, lws
+
+    def iter_classify_multi(self, placements, minlw_list, num_procs = 1, chunk_size = 1000):
+        """same as iter_classify(), but for a list of min_lhw thresholds: yields (placement, results)
+        tuples, where results is a list of (ranks, lws) - one per threshold"""
+        return self.iter_placement_results(placements, list(minlw_list), num_procs, chunk_size)
+
+    def iter_placement_results(self, placements, minlw, num_procs, chunk_size):
+        self.get_rank_index()
+        if self.cfg.brlen_pv > 0.:
+            self.get_node_height_k()
+        
+        place_iter = iter(placements)
+        first_chunk = list(itertools.islice(place_iter, chunk_size))
+        if num_procs <= 1 or len(first_chunk) < chunk_size:
+            for place in itertools.chain(first_chunk, place_iter):
+                yield place, self.classify_placement(place["p"], minlw)
+            self.log_stats()
+            return
+
+        global _mp_classify_helper
+        _mp_classify_helper = self
+        
+        pool = multiprocessing.Pool(num_procs)
+        try:
+            pending = collections.deque()
+            chunk = first_chunk
+            while chunk or pending:
+                while chunk and len(pending) < 2 * num_procs:
+                    edges_list = [place["p"] for place in chunk]
+                    pending.append((chunk, pool.apply_async(_mp_classify_chunk, [(minlw, edges_list)])))
+                    chunk = list(itertools.islice(place_iter, chunk_size))
+                places, async_res = pending.popleft()
+                results, stats = async_res.get()
+                self.add_stats(stats)
+                for place, res in zip(places, results):
+                    yield place, res
+            pool.close()
+            self.log_stats()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            _mp_classify_helper = None
             
+    def get_node_height_k(self):
+        if self.node_height_k is None:
+            self.node_height_k = dict((br_id, int(h)) for br_id, h in self.node_height.iteritems())
+        return self.node_height_k
+
+    def get_edges_pv(self, edges):
+        node_height_k = self.get_node_height_k()
+        ks = [node_height_k[str(edge[0])] for edge in edges]
+        xs = [edge[4] for edge in edges]
+        return self.erlang.one_tail_test_many(self.sp_rate, ks, xs)
+
     def erlang_filter(self, edges):
         if self.cfg.brlen_pv == 0.:
             return edges
             
         newedges = []
-        for edge in edges:
-            edge_nr = str(edge[0])
-            pendant_length = edge[4]
-            pv = self.erlang.one_tail_test(rate = self.sp_rate, k = int(self.node_height[edge_nr]), x = pendant_length)
+        for edge, pv in zip(edges, self.get_edges_pv(edges)):
             if pv >= self.cfg.brlen_pv:
-                newedges.append(edge)
+                # copy, since likelihood weights are adjusted below and caller's edges must stay unchanged
+                newedges.append(list(edge))
 #            else:
-#                self.cfg.log.debug("Edge ignored: [%s, %f], p = %.12f", edge_nr, pendant_length, pv)
+#                self.cfg.log.debug("Edge ignored: [%s, %f], p = %.12f", edge[0], edge[4], pv)
         
         if len(newedges) == 0:
             return newedges
         
         # adjust likelihood weights -> is there a better way ???        
-        sum_lh = 0
         max_lh = float(newedges[0][1])
-        for edge in newedges:
-            lh = float(edge[1])
-            sum_lh += math.exp(lh - max_lh)
+        lh_exps = [math.exp(float(edge[1]) - max_lh) for edge in newedges]
+        sum_lh = 0
+        for lh_exp in lh_exps:
+            sum_lh += lh_exp
                         
-        for edge in newedges:
-            lh = float(edge[1])
-            edge[2] = math.exp(lh - max_lh) / sum_lh
+        for edge, lh_exp in zip(newedges, lh_exps):
+            edge[2] = lh_exp / sum_lh
 
         return newedges
 
@@ -222,10 +489,7 @@ class TaxClassifyHelper:
         if self.cfg.brlen_pv == 0.:
             return edges
             
-        for edge in edges:
-            edge_nr = str(edge[0])
-            pendant_length = edge[4]
-            pv = self.erlang.one_tail_test(rate = self.sp_rate, k = int(self.node_height[edge_nr]), x = pendant_length)
+        for pv in self.get_edges_pv(edges):
             if pv >= self.cfg.brlen_pv:
                 return edges
                 
@@ -238,12 +502,14 @@ class TaxClassifyHelper:
         return ranks
     
     def assign_taxonomy_maxlh(self, edges):
+        # lineages are split only once per branch and cached in the index
+        rank_index = self.get_rank_index()
+        edge_ranks = [rank_index.get_branch_ranks(str(edge[0])) for edge in edges]
+
         #Calculate the sum of likelihood weight for each rank
         taxonmy_sumlw_map = {}
-        for edge in edges:
-            edge_nr = str(edge[0])
+        for edge, taxranks in zip(edges, edge_ranks):
             lw = edge[2]
-            taxranks = self.get_branch_ranks(edge_nr)            
             for rank in taxranks:
                 if rank == "-":
                     taxonmy_sumlw_map[rank] = -1
@@ -254,32 +520,25 @@ class TaxClassifyHelper:
                     taxonmy_sumlw_map[rank] = lw
         
         #Assignment using the max likelihood placement
-        ml_edge = edges[0]
-        edge_nr = str(ml_edge[0])
-        maxlw = ml_edge[2]
-        ml_ranks = self.get_branch_ranks(edge_nr)
-        ml_ranks_copy = []
-        for rk in ml_ranks:
-            ml_ranks_copy.append(rk)
+        ml_ranks = edge_ranks[0]
+        ml_ranks_copy = list(ml_ranks)
         lws = []
-        cnt = 0
         for rank in ml_ranks:
             lw = taxonmy_sumlw_map[rank]
             if lw > 1.0:
                 lw = 1.0
             lws.append(lw)
-            if rank == "-" and cnt > 0 :                
-                for edge in edges[1:]:
-                    edge_nr = str(edge[0])
-                    taxonomy = self.get_branch_ranks(edge_nr)
+
+        # for undefined ranks of ML placement, take the rank from the last placement 
+        # which has the same parent rank, if any
+        empty_lvls = [cnt for cnt in range(1, len(ml_ranks)) if ml_ranks[cnt] == "-"]
+        if empty_lvls:
+            for taxonomy in edge_ranks[1:]:
+                for cnt in empty_lvls:
                     newrank = taxonomy[cnt]
-                    newlw = taxonmy_sumlw_map[newrank]
-                    higherrank_old = ml_ranks[cnt -1]
-                    higherrank_new = taxonomy[cnt -1]
-                    if higherrank_old == higherrank_new and newrank!="-":
+                    if newrank != "-" and taxonomy[cnt-1] == ml_ranks[cnt-1]:
                         ml_ranks_copy[cnt] = newrank
-                        lws[cnt] = newlw
-            cnt = cnt + 1
+                        lws[cnt] = taxonmy_sumlw_map[newrank]
             
         return ml_ranks_copy, lws
 
@@ -360,4 +619,162 @@ class TaxClassifyHelper:
                 a_conf[i] = rw_total[rank_id]
 
         return a_ranks, a_conf
+
+    def assign_taxonomy_maxsum_fast(self, edges, minlw, early_exit=True):
+        """same as assign_taxonomy_maxsum(), but uses precomputed BranchRankIndex 
+        instead of splitting rank uids for every edge. Weights are accumulated in exactly the 
+        same order as in assign_taxonomy_maxsum(), so results are identical.
+        
+        With early_exit=True, full accumulation stops as soon as the remaining (unprocessed)
+        weight can't change the selected rank anymore. After this point, only weights of the 
+        selected lineage are updated (these are needed for confidence values)."""
+        rows = self.get_rank_index().rows
+        parent_coeff = self.parent_lhw_coeff
+        own_coeff = 1 - self.parent_lhw_coeff
+        
+        rw_own = {}
+        rw_total = {}
+        
+        br_rank_uid = None
+        
+        # rw_remain[i] = sum of weights of edges which come after i-th edge
+        rw_remain = [0.] * len(edges)
+        if early_exit:
+            for i in range(len(edges) - 1, 0, -1):
+                rw_remain[i-1] = rw_remain[i] + edges[i][2]
+        next_check = 0.5
+        
+        for i, edge in enumerate(edges):
+            lweight = edge[2]
+            if lweight == 0.:
+                continue
+
+            br_rank_uid, total_uids, own_uid, parent_uid, interim_uids = rows[str(edge[0])]
+            for rank_id in total_uids:
+                rw_total[rank_id] = rw_total.get(rank_id, 0) + lweight
+
+            if own_uid:
+                if parent_uid is not None:
+                    rw_own[own_uid] = rw_own.get(own_uid, 0) + lweight * own_coeff
+                    rw_own[parent_uid] = rw_own.get(parent_uid, 0) + lweight * parent_coeff
+                    for rank_id in interim_uids:
+                        rw_total[rank_id] = rw_total.get(rank_id, 0) - lweight * parent_coeff
+                else:
+                    rw_own[own_uid] = rw_own.get(own_uid, 0) + lweight
+
+            rw_rest = rw_remain[i]
+            if 0. < rw_rest < next_check:
+                next_check = rw_rest * 0.5
+                ass_rank_id, own_bound = self.find_certain_rank(rw_own, rw_total, rw_rest, minlw)
+                if ass_rank_id:
+                    rest_edges = edges[i+1:]
+                    self.accumulate_lineage(rest_edges, ass_rank_id, rw_own, rw_total)
+                    if rw_own[ass_rank_id] > own_bound and rw_total[ass_rank_id] >= minlw:
+                        self.skipped_edges += len(rest_edges)
+                        return self.select_rank_maxsum(rw_own, rw_total, minlw)
+                    else:
+                        # should never happen, but better safe than sorry
+                        return self.assign_taxonomy_maxsum_fast(edges, minlw, early_exit=False)
+
+        # if all branches have empty ranks only, just return this placement
+        if len(rw_total) == 0:
+            if br_rank_uid is not None:
+                ranks = Taxonomy.split_rank_uid(br_rank_uid)
+            else:
+                ranks = [Taxonomy.EMPTY_RANK]
+            return ranks, [1.] * len(ranks)
+        
+        return self.select_rank_maxsum(rw_own, rw_total, minlw)
+
+    def find_certain_rank(self, rw_own, rw_total, rw_rest, minlw):
+        """Return the rank which will be selected by select_rank_maxsum() no matter how the 
+        remaining weight rw_rest is distributed, if any. Each edge adds at most its weight 
+        to rw_own of any rank, and rw_own/rw_total never decrease. We require a strict 
+        margin, so that ties (which depend on dict order) are not an issue."""
+        best_rw = second_rw = 0.
+        best_rank_id = None
+        for r, rw in rw_own.iteritems():
+            if rw > best_rw:
+                second_rw = best_rw
+                best_rw = rw
+                best_rank_id = r
+            elif rw > second_rw:
+                second_rw = rw
+        
+        own_bound = second_rw + rw_rest + TaxClassifyHelper.EARLY_EXIT_EPS
+        if best_rank_id and best_rw > own_bound and rw_total[best_rank_id] >= minlw:
+            return best_rank_id, own_bound
+        else:
+            return None, None
+            
+    def accumulate_rank_weights(self, edges, rw_own, rw_total, lineage=None):
+        """same as accumulation loop in assign_taxonomy_maxsum_fast(), optionally 
+        restricted to the ranks in lineage set"""
+        rows = self.get_rank_index().rows
+        parent_coeff = self.parent_lhw_coeff
+        own_coeff = 1 - self.parent_lhw_coeff
+
+        for edge in edges:
+            lweight = edge[2]
+            if lweight == 0.:
+                continue
+
+            br_rank_uid, total_uids, own_uid, parent_uid, interim_uids = rows[str(edge[0])]
+            for rank_id in total_uids:
+                if lineage is None or rank_id in lineage:
+                    rw_total[rank_id] = rw_total.get(rank_id, 0) + lweight
+
+            if own_uid:
+                if parent_uid is not None:
+                    if lineage is None or own_uid in lineage:
+                        rw_own[own_uid] = rw_own.get(own_uid, 0) + lweight * own_coeff
+                    if lineage is None or parent_uid in lineage:
+                        rw_own[parent_uid] = rw_own.get(parent_uid, 0) + lweight * parent_coeff
+                    for rank_id in interim_uids:
+                        if lineage is None or rank_id in lineage:
+                            rw_total[rank_id] = rw_total.get(rank_id, 0) - lweight * parent_coeff
+                elif lineage is None or own_uid in lineage:
+                    rw_own[own_uid] = rw_own.get(own_uid, 0) + lweight
+
+    def accumulate_lineage(self, edges, rank_id, rw_own, rw_total):
+        ranks = Taxonomy.split_rank_uid(rank_id)
+        lineage = set([Taxonomy.get_rank_uid(ranks, i) for i in range(len(ranks)) if ranks[i] != Taxonomy.EMPTY_RANK])
+        self.accumulate_rank_weights(edges, rw_own, rw_total, lineage)
+
+    def assign_taxonomy_maxsum_multi(self, edges, minlw_list):
+        """max-sum assignment for several min_lhw thresholds at once: rank weights are 
+        accumulated only once. Returns a list of (ranks, lws), one per threshold."""
+        if len(minlw_list) == 1:
+            return [self.assign_taxonomy_maxsum_fast(edges, minlw_list[0])]
+
+        rw_own = {}
+        rw_total = {}
+        self.accumulate_rank_weights(edges, rw_own, rw_total)
+
+        if len(rw_total) == 0:
+            res = self.assign_taxonomy_maxsum_fast(edges, minlw_list[0])
+            return [(list(res[0]), list(res[1])) for minlw in minlw_list]
+
+        return [self.select_rank_maxsum(rw_own, rw_total, minlw) for minlw in minlw_list]
+        
+    def select_rank_maxsum(self, rw_own, rw_total, minlw):
+        max_rw = 0.
+        ass_rank_id = None
+        for r in rw_own.iterkeys():
+            if rw_own[r] > max_rw and rw_total[r] >= minlw:
+                ass_rank_id = r
+                max_rw = rw_own[r] 
+        if not ass_rank_id:
+            ass_rank_id = max(rw_total.iterkeys(), key=(lambda key: rw_total[key]))
+
+        a_ranks = Taxonomy.split_rank_uid(ass_rank_id)
+        
+        a_conf = [0.] * len(a_ranks)
+        for i in range(len(a_conf)):
+            rank = a_ranks[i]
+            if rank != Taxonomy.EMPTY_RANK:
+                rank_id = Taxonomy.get_rank_uid(a_ranks, i)
+                a_conf[i] = rw_total[rank_id]
+
+        return a_ranks, a_conf
     
@@ -0,0 +1,74 @@
+#! /usr/bin/env python
+import os
+import gzip
+import bz2
+import shutil
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+class CompressedIO:
+    """Transparent access to gzip/bz2/xz-compressed files. Compression format of input files
+       is detected from the magic bytes, output format is chosen based on the file extension.
+       Files are always (de)compressed as a stream."""
+    MAGIC = [("gzip", "\x1f\x8b"), ("bz2", "BZh"), ("xz", "\xfd7zXZ\x00")]
+    EXTENSIONS = {".gz": "gzip", ".bz2": "bz2", ".xz": "xz"}
+
+    @staticmethod
+    def detect_format(fname):
+        with open(fname, "rb") as fin:
+            head = fin.read(6)
+        for fmt, magic in CompressedIO.MAGIC:
+            if head.startswith(magic):
+                return fmt
+        return None
+
+    @staticmethod
+    def format_from_ext(fname):
+        ext = os.path.splitext(fname)[1].lower()
+        return CompressedIO.EXTENSIONS.get(ext)
+
+    @staticmethod
+    def is_compressed(fname):
+        return CompressedIO.detect_format(fname) != None
+
+    @staticmethod
+    def open(fname, mode="r", fmt=None):
+        """Open file for reading ("r") or writing ("w"). For reading, compression format is
+           detected automatically; for writing, it is derived from the file extension,
+           unless fmt is specified explicitly."""
+        writing = mode.startswith("w") or mode.startswith("a")
+        if not fmt:
+            fmt = CompressedIO.format_from_ext(fname) if writing else CompressedIO.detect_format(fname)
+        bmode = mode[0] + "b"
+        if not fmt:
+            return open(fname, mode)
+        elif fmt == "gzip":
+            return gzip.open(fname, bmode)
+        elif fmt == "bz2":
+            return bz2.BZ2File(fname, bmode)
+        elif fmt == "xz":
+            if not lzma:
+                raise ValueError("Cannot open %s: xz compression requires lzma module (pip install backports.lzma)" % fname)
+            return lzma.LZMAFile(fname, bmode)
+        else:
+            raise ValueError("Unknown compression format: %s" % fmt)
+
+    @staticmethod
+    def copy(src_fname, dst_fname, move=False):
+        """Copy file, compressing it on the fly if required by the extension of dst_fname"""
+        if CompressedIO.format_from_ext(dst_fname) and not CompressedIO.is_compressed(src_fname):
+            with open(src_fname, "rb") as fin:
+                with CompressedIO.open(dst_fname, "w") as fout:
+                    shutil.copyfileobj(fin, fout)
+            if move:
+                os.remove(src_fname)
+        elif move:
+            shutil.move(src_fname, dst_fname)
+        else:
+            shutil.copy(src_fname, dst_fname)
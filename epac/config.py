@@ -12,6 +12,8 @@ import multiprocessing
 import ConfigParser
 
 from epac.version import SATIVA_BUILD,SATIVA_RELEASE_DATE,SATIVA_RAXML_VER
+from epac.scheduler import JobScheduler
+from epac.executor import Executor
 
 class DefaultedConfigParser(ConfigParser.SafeConfigParser):
     def get_param(self, section, option, ctype=str, default=None):
@@ -22,7 +24,7 @@ class DefaultedConfigParser(ConfigParser.SafeConfigParser):
             sec = confdict.get(section)
             if sec:
                 if ctype == bool:
-                    ret = self.getboolean(section, option)
+                    ret = self.getboolean(section, option) if option in sec else default
                 else:
                     ret = sec.get(option, default)
             else:
@@ -54,6 +56,14 @@ By A.Kozlov and J.Zhang, the Exelixis Lab. Based on RAxML %s by A.Stamatakis.\n"
         else:
             return seq_name
         
+    @staticmethod
+    def parse_thresholds(thres_str):
+        """parse comma-separated list of thresholds between 0 and 1 (e.g. -sweep option)"""
+        thresholds = sorted(set([float(t) for t in thres_str.split(",") if t.strip()]))
+        if len(thresholds) == 0 or thresholds[0] < 0. or thresholds[-1] > 1.:
+            raise ValueError("Invalid threshold list: %s" % thres_str)
+        return thresholds
+
     @staticmethod
     def strip_ref_prefix(seq_name):
         return EpacConfig.strip_prefix(seq_name, EpacConfig.REF_SEQ_PREFIX)
@@ -137,13 +147,23 @@ By A.Kozlov and J.Zhang, the Exelixis Lab. Based on RAxML %s by A.Stamatakis.\n"
         self.raxml_model = "AUTO"
         self.raxml_remote_host = ""
         self.raxml_remote_call = False        
-        self.run_on_cluster = False
+        # where RAxML jobs are run: local, ssh, slurm, sge or dirqueue (s. Executor)
+        self.cluster_backend = "local"
+        self.ssh_hosts = []
+        self.cluster_queue_dir = ""
+        # dirqueue backend: max seconds to wait for a worker to claim a job (0 = forever), and to hear from it
+        self.cluster_queue_timeout = 0
+        self.cluster_worker_timeout = 300
         self.cluster_epac_home = self.epac_home
         self.cluster_qsub_script = ""
         self.epa_load_optmod = True
         self.epa_use_heuristic = "AUTO"
         self.epa_heur_rate = 0.01
         self.min_confidence = 0.2
+        # max number of distinct placement signatures to keep in the classification cache (0 = off)
+        self.classify_cache_size = 0
+        # directory for caching files derived from refjson (tree, model, alignment etc.), disabled if empty
+        self.ref_cache_dir = ""
         self.num_threads = multiprocessing.cpu_count()
         self.compress_patterns = False
         self.use_bfgs = False
@@ -153,6 +173,8 @@ By A.Kozlov and J.Zhang, the Exelixis Lab. Based on RAxML %s by A.Stamatakis.\n"
         self.restart = False
         self.verbose = False
         self.log = logging.getLogger('epac')
+        self.scheduler = None
+        self.executor = None
        
     def init_logger(self):
         self.log_fname = self.out_fname("%NAME%.log")
@@ -246,14 +268,48 @@ By A.Kozlov and J.Zhang, the Exelixis Lab. Based on RAxML %s by A.Stamatakis.\n"
         self.hmmer_home = self.resolve_relative_path(parser.get_param("hmmer", "hmmer_home", str, self.hmmer_home))
         self.muscle_home = self.resolve_relative_path(parser.get_param("muscle", "muscle_home", str, self.muscle_home))
         
-        self.run_on_cluster = parser.get_param("cluster", "run_on_cluster", bool, self.run_on_cluster)
-        self.cluster_epac_home = parser.get_param("cluster", "cluster_epac_home", str, self.cluster_epac_home) + "/"
+        self.cluster_backend = parser.get_param("cluster", "backend", str, self.cluster_backend).lower()
+        # old config files: SGE was the only supported batch system
+        if parser.get_param("cluster", "run_on_cluster", bool, False) and self.cluster_backend == "local":
+            self.cluster_backend = "sge"
+        if not self.cluster_backend in Executor.BACKENDS:
+            self.exit_user_error("Invalid cluster backend: %s (supported: %s)" % (self.cluster_backend, ", ".join(Executor.BACKENDS)))
+        ssh_hosts = parser.get_param("cluster", "ssh_hosts", str, "")
+        self.ssh_hosts = [host.strip() for host in ssh_hosts.split(",") if host.strip()]
+        if self.cluster_backend == "ssh" and not self.ssh_hosts and not self.raxml_remote_host:
+            self.exit_user_error("No hosts given for ssh backend, please set ssh_hosts in [cluster] section of the config file")
+        self.cluster_queue_dir = parser.get_param("cluster", "queue_dir", str, self.cluster_queue_dir)
+        if self.cluster_queue_dir:
+            self.cluster_queue_dir = self.resolve_relative_path(self.cluster_queue_dir)
+        elif self.cluster_backend == "dirqueue":
+            self.exit_user_error("No queue directory given for dirqueue backend, please set queue_dir in [cluster] section of the config file")
+        self.cluster_queue_timeout = parser.get_param("cluster", "queue_timeout", int, self.cluster_queue_timeout)
+        self.cluster_worker_timeout = parser.get_param("cluster", "worker_timeout", int, self.cluster_worker_timeout)
+        self.cluster_epac_home = parser.get_param("cluster", "cluster_epac_home", str, self.cluster_epac_home).rstrip("/") + "/"
         self.cluster_qsub_script = parser.get_param("cluster", "cluster_qsub_script", str, self.cluster_qsub_script)
 
         self.min_confidence = parser.get_param("assignment", "min_confidence", float, self.min_confidence)
+        self.classify_cache_size = parser.get_param("assignment", "classify_cache_size", int, self.classify_cache_size)
+
+        self.ref_cache_dir = parser.get_param("cache", "ref_cache_dir", str, self.ref_cache_dir)
+        if self.ref_cache_dir:
+            self.ref_cache_dir = self.resolve_relative_path(self.ref_cache_dir)
 
         return parser
 
+    def get_scheduler(self):
+        """Scheduler for external tools (RAxML, HMMER, MUSCLE), shared by all steps of the run, 
+           so that jobs running at the same time never use more than num_threads threads"""
+        if self.scheduler == None:
+            self.scheduler = JobScheduler(self.num_threads, log=self.log)
+        return self.scheduler
+
+    def get_executor(self):
+        """Executor for RAxML jobs, which runs them locally or on other hosts (s. [cluster] section of the config file)"""
+        if self.executor == None:
+            self.executor = Executor.create(self)
+        return self.executor
+
     def subst_name(self, in_str):
         """Replace %NAME% macros with an actual EPAC run name. Used to 
         generate unique run-specific identifiers (filenames, RAxML job names etc)"""
@@ -298,6 +354,7 @@ class EpacTrainerConfig(EpacConfig):
             self.mfresolv_method = args.mfresolv_method
             self.taxcode_name = args.taxcode_name
             self.rep_num = args.rep_num
+            self.rep_parallel = args.rep_parallel
             self.synonym_fname = args.synonym_fname
         
     def set_defaults(self):
@@ -311,12 +368,15 @@ class EpacTrainerConfig(EpacConfig):
         self.mfresolv_method = "thorough"
         self.taxcode_name = "bac"
         self.rep_num = 1
+        self.rep_parallel = 1
         # default settings below imply no taxonomy filtering, 
         # i.e. all sequences from taxonomy file will be included into reference tree
         self.reftree_min_rank = 0
         self.reftree_max_seqs_per_leaf = 1e6
         self.reftree_clades_to_include=[]
         self.reftree_clades_to_ignore=[]
+        # write refjson without indentation (smaller file, faster to write and load)
+        self.compact_refjson = False
         
 
     def read_from_file(self, config_fname):
@@ -328,6 +388,7 @@ class EpacTrainerConfig(EpacConfig):
         self.reftree_clades_to_include = self.parse_clades(clades_str)
         clades_str = parser.get_param("reftree", "clades_to_ignore", str, "")
         self.reftree_clades_to_ignore = self.parse_clades(clades_str)
+        self.compact_refjson = parser.get_param("reftree", "compact_json", bool, self.compact_refjson)
         
     def parse_clades(self, clades_str):
         clade_list = []
@@ -354,10 +415,20 @@ class EpacClassifierConfig(EpacConfig):
             self.taxassign_method = args.taxassign_method
             self.min_lhw = args.min_lhw
             self.brlen_pv = args.brlen_pv
+            self.min_lhw_sweep = args.min_lhw_sweep
+            self.save_placements = args.save_placements
+            self.epa_shards = args.epa_shards
+            self.epa_shard_threads = args.epa_shard_threads
+            if args.ref_cache_dir:
+                self.ref_cache_dir = args.ref_cache_dir
         else:
             self.taxassign_method = "1"
             self.min_lhw = 0.
             self.brlen_pv = 0.
+            self.min_lhw_sweep = None
+            self.save_placements = False
+            self.epa_shards = 1
+            self.epa_shard_threads = None
 
 class SativaConfig(EpacTrainerConfig):
     
@@ -374,8 +445,14 @@ class SativaConfig(EpacTrainerConfig):
         self.brlen_pv = args.brlen_pv
         self.ranktest = args.ranktest
         self.conf_cutoff = args.conf_cutoff
+        self.conf_sweep = args.conf_sweep
+        if args.ref_cache_dir:
+            self.ref_cache_dir = args.ref_cache_dir
         self.jplace_fname = args.jplace_fname
         self.final_jplace_fname = args.final_jplace_fname
+        self.save_placements = args.save_placements
+        self.l1o_shards = args.l1o_shards
+        self.l1o_shard = args.l1o_shard
         
         self.save_memory = args.save_memory
 
@@ -4,7 +4,8 @@ from ete2 import Tree
 
 class erlang:
     def __init__(self):
-        pass
+        # coefficients 1/n!, extended on demand
+        self.coeffs = []
     
     def one_tail_test(self, rate, k, x):
         """rate: estimated branching rate from reference tree
@@ -15,6 +16,42 @@ class erlang:
             p = p + (1.0/float(math.factorial(n))) * math.exp((-rate)*x) * math.pow(rate*x, n)
         return p
 
+    def get_coeffs(self, k):
+        coeffs = self.coeffs
+        for n in range(len(coeffs), k):
+            coeffs.append(1.0/float(math.factorial(n)))
+        return coeffs
+
+    def one_tail_test_many(self, rate, ks, xs):
+        """Batch version of one_tail_test(): computes p-values for lists of node 
+           heights (ks) and placement branch lengths (xs) with the same rate.
+           Within a call, partial sums are kept per x and extended as larger k are requested, 
+           so every term is only evaluated once. They are not kept between calls, since 
+           branch lengths of different queries rarely match. Results are identical to one_tail_test()."""
+        # x -> list of partial sums [P(k=1), P(k=2), ...]
+        psums_map = {}
+        pvs = []
+        for k, x in zip(ks, xs):
+            if k <= 0:
+                pvs.append(0.0)
+                continue
+            psums = psums_map.get(x, None)
+            if psums is None:
+                psums = []
+                psums_map[x] = psums
+            n = len(psums)
+            if n < k:
+                coeffs = self.get_coeffs(k)
+                ex = math.exp((-rate)*x)
+                rx = rate*x
+                p = psums[-1] if n > 0 else 0.0
+                while n < k:
+                    p = p + coeffs[n] * ex * math.pow(rx, n)
+                    psums.append(p)
+                    n += 1
+            pvs.append(psums[k-1])
+        return pvs
+
 class tree_param:
     def __init__(self, tree, origin_taxonomy):
         """tree: rooted and branch labled tree in newick format
@@ -0,0 +1,565 @@
+#! /usr/bin/env python
+import os
+import re
+import glob
+import json
+import time
+import pipes
+import socket
+from subprocess import call
+
+from scheduler import Job, JobScheduler
+from raxml_util import FileUtils
+
+class Executor:
+    """Runs external commands (e.g. independent RAxML searches or EPA shards) on local or remote compute
+       resources. submit() returns a scheduler Job, which can be waited for or cancelled. Batch backends
+       send jobs to the cluster in bulk, so submitted jobs are only guaranteed to start once wait() is called."""
+    BACKENDS = ["local", "ssh", "slurm", "sge", "dirqueue"]
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+
+    @staticmethod
+    def create(cfg):
+        """Returns the executor selected in [cluster] section of the config file (s. EpacConfig.get_executor)"""
+        backend = cfg.cluster_backend
+        if backend == "ssh" or (backend == "local" and cfg.raxml_remote_call):
+            return SshExecutor(cfg, cfg.ssh_hosts or [cfg.raxml_remote_host])
+        elif backend == "slurm":
+            return SlurmExecutor(cfg)
+        elif backend == "sge":
+            return SgeExecutor(cfg)
+        elif backend == "dirqueue":
+            return DirQueueExecutor(cfg, cfg.cluster_queue_dir)
+        else:
+            return LocalExecutor(cfg)
+
+    def submit(self, name, call_str, threads=1, out_fname=None):
+        raise NotImplementedError
+
+    def wait(self, jobs):
+        raise NotImplementedError
+
+    def cancel(self, jobs):
+        raise NotImplementedError
+
+    def run(self, name, call_str, threads=1, out_fname=None):
+        """Blocking version of submit(): returns the Job once it is done. Raises OSError if the command
+           could not be started."""
+        job = self.submit(name, call_str, threads, out_fname)
+        try:
+            self.wait([job])
+        except BaseException:
+            self.cancel([job])
+            raise
+        if job.error:
+            raise job.error
+        return job
+
+    @staticmethod
+    def finish_job(job, state, returncode=None):
+        job.state = state
+        job.returncode = returncode
+        job.end_time = time.time()
+        job.done_event.set()
+
+class LocalExecutor(Executor):
+    """Runs jobs on this machine, sharing the thread budget of the scheduler with other tools (s. EpacConfig.get_scheduler)"""
+    def __init__(self, cfg):
+        Executor.__init__(self, cfg)
+        self.scheduler = cfg.get_scheduler()
+
+    def submit(self, name, call_str, threads=1, out_fname=None):
+        return self.scheduler.submit(name, call_str, threads, out_fname)
+
+    def wait(self, jobs):
+        self.scheduler.wait(jobs)
+
+    def cancel(self, jobs):
+        self.scheduler.cancel(jobs)
+
+class SshExecutor(Executor):
+    """Runs jobs on a list of hosts via ssh, which must work without password (s. ssh-agent). Hosts are given
+       as host[:threads], every host has its own thread budget (default: -T), and each job is sent to the host
+       with the lowest load. Files are not copied, so the working directory must be shared (e.g. via NFS).
+       Remote commands run in a pseudo-terminal, so that they are hung up (SIGHUP) as soon as the local
+       ssh client is terminated, i.e. when the job is cancelled or times out."""
+    SSH_CMD = ["ssh", "-n", "-tt", "-o", "BatchMode=yes"]
+    def __init__(self, cfg, hosts):
+        Executor.__init__(self, cfg)
+        self.hosts = []
+        for host_str in hosts:
+            host, _, threads = host_str.partition(":")
+            threads = int(threads) if threads else cfg.num_threads
+            self.hosts.append((host, JobScheduler(threads, log=cfg.log)))
+        # job -> scheduler of the host it runs on
+        self.job_schedulers = {}
+
+    @staticmethod
+    def get_load(scheduler):
+        threads = sum(job.threads for job in list(scheduler.pending) + list(scheduler.running))
+        return float(threads) / scheduler.max_threads
+
+    def submit(self, name, call_str, threads=1, out_fname=None):
+        host, scheduler = min(self.hosts, key=lambda h: SshExecutor.get_load(h[1]))
+        # pseudo-terminal would translate line endings in the output
+        remote_cmd = "stty -onlcr 2>/dev/null; cd %s && %s" % (pipes.quote(os.getcwd()),
+                                                               " ".join(pipes.quote(s) for s in call_str))
+        self.cfg.log.debug("Running job %s on %s\n", name, host)
+        job = scheduler.submit(name, SshExecutor.SSH_CMD + [host, remote_cmd], threads, out_fname)
+        self.job_schedulers[job] = scheduler
+        return job
+
+    def wait(self, jobs):
+        for job in jobs:
+            scheduler = self.job_schedulers.get(job)
+            if scheduler:
+                scheduler.wait(job)
+                del self.job_schedulers[job]
+
+    def cancel(self, jobs):
+        for job in jobs:
+            scheduler = self.job_schedulers.pop(job, None)
+            if scheduler:
+                scheduler.cancel(job)
+
+class ArrayJobExecutor(Executor):
+    """Base class for batch system backends: jobs are sent to the cluster as a single array job with one task
+       per job. submit() only collects the jobs, and wait() submits them all at once and blocks until the array
+       is finished, so that e.g. all replicates of a search run at the same time. Commands and return codes
+       are passed via scripts in work_dir, which must be on a file system shared with the compute nodes.
+       Site-specific options (queue, parallel environment, modules etc.) can be given in a header script
+       (cluster_qsub_script). Paths are rebased from epac_home to cluster_epac_home. If raxml_remote_host is
+       set, array job is submitted from there."""
+    TASK_ID_VAR = None
+
+    def __init__(self, cfg, work_dir=None, header_fname=None):
+        Executor.__init__(self, cfg)
+        self.work_dir = work_dir if work_dir else cfg.temp_dir
+        self.header_fname = header_fname if header_fname != None else cfg.cluster_qsub_script
+        self.array_count = 0
+
+    def get_directives(self, name, task_count, threads, log_stem):
+        raise NotImplementedError
+
+    def get_submit_cmd(self, script_fname):
+        raise NotImplementedError
+
+    def get_cancel_cmd(self, submit_output):
+        """Command which cancels the array job, given the output of the submit command"""
+        raise NotImplementedError
+
+    def rebase(self, path):
+        return FileUtils.rebase(path, self.cfg.epac_home, self.cfg.cluster_epac_home)
+
+    def get_task_script(self, job, rc_fname):
+        cmd = " ".join(pipes.quote(self.rebase(s)) for s in job.call_str)
+        if job.out_fname:
+            cmd += " > %s 2>&1" % pipes.quote(self.rebase(job.out_fname))
+        lines = ["#!/bin/sh",
+                 "cd %s || exit 1" % pipes.quote(self.rebase(os.getcwd())),
+                 cmd,
+                 "echo $? > %s" % pipes.quote(self.rebase(rc_fname))]
+        return "\n".join(lines) + "\n"
+
+    def get_array_script(self, name, task_count, threads, task_stem):
+        lines = ["#!/bin/sh"]
+        lines += self.get_directives(name, task_count, threads, self.rebase(task_stem))
+        if self.header_fname:
+            with open(self.header_fname) as fin:
+                lines += [line.rstrip("\n") for line in fin if not line.startswith("#!")]
+        lines += ["", "sh %s.${%s}.sh" % (pipes.quote(self.rebase(task_stem)), self.TASK_ID_VAR)]
+        return "\n".join(lines) + "\n"
+
+    def write_scripts(self, jobs):
+        """Writes a script for every task plus the array job script, and returns the name of the latter"""
+        self.array_count += 1
+        name = "epa_%s" % jobs[0].name
+        task_stem = os.path.join(self.work_dir, "%s.array%d" % (jobs[0].name, self.array_count))
+        for i, job in enumerate(jobs, 1):
+            with open("%s.%d.sh" % (task_stem, i), "w") as fout:
+                fout.write(self.get_task_script(job, "%s.%d.rc" % (task_stem, i)))
+        threads = max(job.threads for job in jobs)
+        script_fname = task_stem + ".sh"
+        with open(script_fname, "w") as fout:
+            fout.write(self.get_array_script(name, len(jobs), threads, task_stem))
+        return script_fname
+
+    def submit(self, name, call_str, threads=1, out_fname=None):
+        return Job(name, call_str, threads, out_fname)
+
+    def wait(self, jobs):
+        batch = [job for job in jobs if job.state == Job.PENDING]
+        if batch:
+            self.run_array(batch)
+
+    def cancel(self, jobs):
+        for job in jobs:
+            if job.state == Job.PENDING:
+                Executor.finish_job(job, Job.CANCELLED)
+
+    def run_array(self, jobs):
+        script_fname = self.write_scripts(jobs)
+        task_stem = script_fname[:-3]
+        submit_cmd = self.get_submit_cmd(self.rebase(script_fname))
+        if self.cfg.raxml_remote_call:
+            submit_cmd = ["ssh", self.cfg.raxml_remote_host] + submit_cmd
+        submit_out_fname = task_stem + ".submit.log"
+        self.cfg.log.debug(" ".join(submit_cmd) + "\n")
+
+        for job in jobs:
+            job.state = Job.RUNNING
+            job.start_time = time.time()
+        try:
+            self.cfg.get_scheduler().run(jobs[0].name, submit_cmd, out_fname=submit_out_fname)
+        except OSError, e:
+            for job in jobs:
+                job.error = e
+                Executor.finish_job(job, Job.FAILED)
+            return
+        except BaseException:
+            # killing the submit command does not stop the array job
+            self.cancel_array(submit_out_fname)
+            for job in jobs:
+                Executor.finish_job(job, Job.CANCELLED)
+            raise
+
+        for i, job in enumerate(jobs, 1):
+            try:
+                with open("%s.%d.rc" % (task_stem, i)) as fin:
+                    Executor.finish_job(job, Job.FINISHED, int(fin.read()))
+            except (IOError, ValueError):
+                # task has been killed or did not run at all
+                Executor.finish_job(job, Job.FAILED)
+
+    def cancel_array(self, submit_out_fname):
+        try:
+            with open(submit_out_fname) as fin:
+                cancel_cmd = self.get_cancel_cmd(fin.read())
+        except IOError:
+            cancel_cmd = None
+        if cancel_cmd:
+            if self.cfg.raxml_remote_call:
+                cancel_cmd = ["ssh", self.cfg.raxml_remote_host] + cancel_cmd
+            with open(os.devnull, "w") as fnull:
+                call(cancel_cmd, stdout=fnull, stderr=fnull)
+
+class SlurmExecutor(ArrayJobExecutor):
+    TASK_ID_VAR = "SLURM_ARRAY_TASK_ID"
+
+    def get_directives(self, name, task_count, threads, log_stem):
+        return ["#SBATCH --job-name=%s" % name,
+                "#SBATCH --array=1-%d" % task_count,
+                "#SBATCH --cpus-per-task=%d" % threads,
+                "#SBATCH --output=%s.%%a.log" % log_stem]
+
+    def get_submit_cmd(self, script_fname):
+        return ["sbatch", "--wait", script_fname]
+
+    def get_cancel_cmd(self, submit_output):
+        m = re.search(r"Submitted batch job (\d+)", submit_output)
+        return ["scancel", m.group(1)] if m else None
+
+class SgeExecutor(ArrayJobExecutor):
+    """Threads per task can only be requested with a parallel environment, which is site-specific
+       and has to be set in the header script (e.g. #$ -pe smp 8)"""
+    TASK_ID_VAR = "SGE_TASK_ID"
+
+    def get_directives(self, name, task_count, threads, log_stem):
+        return ["#$ -N %s" % name,
+                "#$ -t 1-%d" % task_count,
+                "#$ -S /bin/sh",
+                "#$ -j y",
+                "#$ -o %s.$TASK_ID.log" % log_stem]
+
+    def get_submit_cmd(self, script_fname):
+        return ["qsub", "-sync", "y", script_fname]
+
+    def get_cancel_cmd(self, submit_output):
+        m = re.search(r"Your job(?:-array)? (\d+)", submit_output)
+        return ["qdel", m.group(1)] if m else None
+
+class DirQueue:
+    """Work queue in a shared directory, which needs no services and can be drained by any number of workers
+       (s. epa_worker.py) on all hosts which see the directory. Every job is a json file, which moves from
+       pending/ to running/ (claimed by a worker with an atomic rename), and then to done/ with the results.
+       Workers touch the files of running jobs in every poll interval, so that jobs of dead workers can be
+       detected. Jobs are claimed in the order of submission. Cancellation requests are left in cancelled/."""
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    CANCELLED = "cancelled"
+    STATES = [PENDING, RUNNING, DONE, CANCELLED]
+    # shared file systems are slow to poll
+    POLL_INTERVAL = 1.
+
+    def __init__(self, queue_dir):
+        self.queue_dir = queue_dir
+        self.counter = 0
+        for state in DirQueue.STATES:
+            state_dir = os.path.join(queue_dir, state)
+            try:
+                os.makedirs(state_dir)
+            except OSError:
+                # directory has been created by another process
+                if not os.path.isdir(state_dir):
+                    raise
+
+    def job_fname(self, state, job_id):
+        return os.path.join(self.queue_dir, state, job_id + ".json")
+
+    @staticmethod
+    def write_json(fname, data):
+        """Writes the file atomically, so that other processes never see it incomplete"""
+        tmp_fname = "%s.%s.%d.tmp" % (fname, socket.gethostname(), os.getpid())
+        with open(tmp_fname, "w") as fout:
+            json.dump(data, fout)
+        os.rename(tmp_fname, fname)
+
+    @staticmethod
+    def read_json(fname):
+        try:
+            with open(fname) as fin:
+                return json.load(fin)
+        except (IOError, ValueError):
+            return None
+
+    @staticmethod
+    def remove(fname):
+        try:
+            os.remove(fname)
+            return True
+        except OSError:
+            return False
+
+    def put(self, data):
+        """Adds a job to the queue and returns its id"""
+        self.counter += 1
+        job_id = "%013d-%06d-%s-%d" % (time.time() * 1000, self.counter, socket.gethostname(), os.getpid())
+        DirQueue.write_json(self.job_fname(DirQueue.PENDING, job_id), data)
+        return job_id
+
+    def claim(self):
+        """Moves the oldest pending job to running/ and returns (job_id, data), or None if there is none"""
+        for fname in sorted(glob.glob(os.path.join(self.queue_dir, DirQueue.PENDING, "*.json"))):
+            job_id = os.path.basename(fname)[:-len(".json")]
+            running_fname = self.job_fname(DirQueue.RUNNING, job_id)
+            try:
+                os.rename(fname, running_fname)
+            except OSError:
+                # job has been claimed by another worker
+                continue
+            return job_id, DirQueue.read_json(running_fname)
+        return None
+
+    def release(self, job_id):
+        """Puts a claimed job back to the queue (e.g. if worker is terminated)"""
+        os.rename(self.job_fname(DirQueue.RUNNING, job_id), self.job_fname(DirQueue.PENDING, job_id))
+
+    def complete(self, job_id, result):
+        """Stores results of a claimed job; results of cancelled jobs are discarded, since nobody waits for them"""
+        if not DirQueue.remove(self.job_fname(DirQueue.CANCELLED, job_id)):
+            DirQueue.write_json(self.job_fname(DirQueue.DONE, job_id), result)
+        DirQueue.remove(self.job_fname(DirQueue.RUNNING, job_id))
+
+    def get_result(self, job_id):
+        return DirQueue.read_json(self.job_fname(DirQueue.DONE, job_id))
+
+    def is_running(self, job_id):
+        return os.path.exists(self.job_fname(DirQueue.RUNNING, job_id))
+
+    def touch(self, job_id):
+        """Signals that the worker is still alive (s. get_heartbeat)"""
+        try:
+            os.utime(self.job_fname(DirQueue.RUNNING, job_id), None)
+        except OSError:
+            pass
+
+    def get_heartbeat(self, job_id):
+        """Returns the time a claimed job was touched by its worker last, or None if job is not running"""
+        try:
+            return os.path.getmtime(self.job_fname(DirQueue.RUNNING, job_id))
+        except OSError:
+            return None
+
+    def discard(self, job_id):
+        DirQueue.remove(self.job_fname(DirQueue.DONE, job_id))
+
+    def cancel(self, job_id):
+        """Removes a pending job; if it has been claimed already, leaves a request for the worker to terminate it"""
+        if not DirQueue.remove(self.job_fname(DirQueue.PENDING, job_id)):
+            DirQueue.write_json(self.job_fname(DirQueue.CANCELLED, job_id), {})
+            # job could have finished in the meantime
+            if DirQueue.remove(self.job_fname(DirQueue.DONE, job_id)):
+                DirQueue.remove(self.job_fname(DirQueue.CANCELLED, job_id))
+
+    def is_cancelled(self, job_id):
+        return os.path.exists(self.job_fname(DirQueue.CANCELLED, job_id))
+
+class DirQueueExecutor(Executor):
+    """Puts jobs into a DirQueue, which is drained by workers started separately (epa_worker.py), e.g. as
+       batch jobs on the compute nodes. All files the jobs use must be on a shared file system.
+       Jobs fail if no worker claims them within queue_timeout seconds (0 = wait forever), or if their
+       worker has not touched them for worker_timeout seconds (0 = never)."""
+    # interval for warnings about jobs, which have not been claimed by any worker yet
+    WARN_INTERVAL = 60.
+
+    def __init__(self, cfg, queue_dir, queue_timeout=None, worker_timeout=None):
+        Executor.__init__(self, cfg)
+        self.queue = DirQueue(queue_dir)
+        self.queue_timeout = queue_timeout if queue_timeout != None else cfg.cluster_queue_timeout
+        self.worker_timeout = worker_timeout if worker_timeout != None else cfg.cluster_worker_timeout
+        # job -> id in the queue
+        self.job_ids = {}
+        # job -> time since when it is waiting for a worker
+        self.pending_since = {}
+        # job -> (last heartbeat, time when it was seen); local clock is used for the timeout, since
+        # clocks of the workers and of the file server can differ
+        self.heartbeats = {}
+
+    def submit(self, name, call_str, threads=1, out_fname=None):
+        job = Job(name, call_str, threads, out_fname)
+        data = {"name": name, "call_str": call_str, "threads": threads, "out_fname": out_fname, "cwd": os.getcwd()}
+        self.job_ids[job] = self.queue.put(data)
+        self.pending_since[job] = time.time()
+        return job
+
+    def wait(self, jobs):
+        jobs = [job for job in jobs if not job.is_done()]
+        last_warning = time.time()
+        while jobs:
+            now = time.time()
+            for job in list(jobs):
+                job_id = self.job_ids[job]
+                result = self.queue.get_result(job_id)
+                if result != None:
+                    self.queue.discard(job_id)
+                    self.forget_job(job)
+                    if result.get("error"):
+                        job.error = OSError(result["error"])
+                    job.start_time = result.get("start_time")
+                    Executor.finish_job(job, result["state"], result.get("returncode"))
+                    jobs.remove(job)
+                else:
+                    self.check_job(job, now)
+                    if job.is_done():
+                        jobs.remove(job)
+            pending_count = len([job for job in jobs if job.state == Job.PENDING])
+            if pending_count > 0 and now - last_warning >= DirQueueExecutor.WARN_INTERVAL:
+                self.cfg.log.warning("WARNING: %d job(s) are still waiting for a worker in %s, please make sure that epa_worker.py is running\n",
+                                     pending_count, self.queue.queue_dir)
+                last_warning = now
+            if jobs:
+                time.sleep(DirQueue.POLL_INTERVAL)
+
+    def check_job(self, job, now):
+        """Updates state of a job, which has not finished yet, and fails it if it has timed out"""
+        heartbeat = self.queue.get_heartbeat(self.job_ids[job])
+        if heartbeat == None:
+            # not claimed yet, or put back into the queue by a terminated worker
+            job.state = Job.PENDING
+            self.heartbeats.pop(job, None)
+            pending_since = self.pending_since.setdefault(job, now)
+            if self.queue_timeout > 0 and now - pending_since > self.queue_timeout:
+                self.fail_job(job, Job.TIMEOUT, "Job %s has not been claimed by any worker within %g s (queue: %s)" %
+                              (job.name, self.queue_timeout, self.queue.queue_dir))
+        else:
+            job.state = Job.RUNNING
+            self.pending_since.pop(job, None)
+            last = self.heartbeats.get(job)
+            if not last or last[0] != heartbeat:
+                self.heartbeats[job] = (heartbeat, now)
+            elif self.worker_timeout > 0 and now - last[1] > self.worker_timeout:
+                self.fail_job(job, Job.FAILED, "Worker running job %s has not responded for %g s (queue: %s)" %
+                              (job.name, self.worker_timeout, self.queue.queue_dir))
+
+    def fail_job(self, job, state, msg):
+        # if the worker comes back, it terminates the job and discards the results
+        self.queue.cancel(self.job_ids[job])
+        self.forget_job(job)
+        job.error = OSError(msg)
+        Executor.finish_job(job, state)
+
+    def forget_job(self, job):
+        del self.job_ids[job]
+        self.pending_since.pop(job, None)
+        self.heartbeats.pop(job, None)
+
+    def cancel(self, jobs):
+        for job in jobs:
+            if not job.is_done():
+                self.queue.cancel(self.job_ids[job])
+                self.forget_job(job)
+                Executor.finish_job(job, Job.CANCELLED)
+
+class DirQueueWorker:
+    """Drains a DirQueue: claims pending jobs as long as there are free threads, and runs them with a
+       JobScheduler. Jobs which are still running when the worker stops (e.g. killed by the batch system)
+       are put back into the queue, so that another worker can pick them up."""
+    def __init__(self, queue_dir, max_threads=1, log=None):
+        self.queue = DirQueue(queue_dir)
+        self.scheduler = JobScheduler(max_threads, log=log)
+        self.log = log
+        self.stopped = False
+        # job id -> scheduler Job
+        self.running = {}
+
+    def stop(self):
+        self.stopped = True
+
+    def run(self, exit_when_empty=False):
+        """Processes jobs until stop() is called or, if exit_when_empty is set, until the queue is empty"""
+        try:
+            while not self.stopped:
+                self.check_jobs()
+                claimed = self.claim_jobs()
+                if exit_when_empty and not claimed and not self.running:
+                    break
+                time.sleep(DirQueue.POLL_INTERVAL)
+        finally:
+            # jobs which have finished are reported, all others are given back to the queue
+            self.scheduler.cancel(self.running.values())
+            for job_id, job in self.running.iteritems():
+                if job.state == Job.FINISHED and not self.scheduler.terminated:
+                    self.complete_job(job_id, job)
+                else:
+                    self.queue.release(job_id)
+            self.running = {}
+
+    def get_free_threads(self):
+        used = sum(min(job.threads, self.scheduler.max_threads) for job in self.running.itervalues())
+        return self.scheduler.max_threads - used
+
+    def claim_jobs(self):
+        count = 0
+        while self.get_free_threads() > 0:
+            item = self.queue.claim()
+            if not item:
+                break
+            job_id, data = item
+            if self.log:
+                self.log.info("Starting job %s: %s\n", data["name"], " ".join(data["call_str"]))
+            self.running[job_id] = self.scheduler.submit(data["name"], data["call_str"], data["threads"],
+                                                         data["out_fname"], cwd=data["cwd"])
+            count += 1
+        return count
+
+    def check_jobs(self):
+        for job_id, job in self.running.items():
+            if job.is_done():
+                del self.running[job_id]
+                self.complete_job(job_id, job)
+            elif self.queue.is_cancelled(job_id):
+                self.scheduler.cancel(job)
+            else:
+                self.queue.touch(job_id)
+
+    def complete_job(self, job_id, job):
+        if self.log:
+            self.log.info("Job %s %s (exit code: %s)\n", job.name, job.state, job.returncode)
+        result = {"state": job.state, "returncode": job.returncode, "host": socket.gethostname(),
+                  "start_time": job.start_time, "end_time": job.end_time}
+        if job.error:
+            result["error"] = str(job.error)
+        self.queue.complete(job_id, result)
@@ -4,23 +4,37 @@ import os
 import json
 import operator
 import base64
+import re
+import mmap
+import struct
 from subprocess import call
 from ete2 import Tree, SeqGroup
 from taxonomy_util import TaxCode
+from classify_util import BranchRankIndex
+from compress_util import CompressedIO
+from seqpack_util import PackedAlignment
 
 class EpaJsonParser:
-    """This class parses the RAxML-EPA json output file"""
+    """This class parses the RAxML-EPA json output file (plain or compressed)"""
     def __init__(self, jsonfin):
-        self.jdata = json.load(open(jsonfin))
+        with CompressedIO.open(jsonfin) as fin:
+            self.jdata = json.load(fin)
     
     def get_placement(self):
         return self.jdata["placements"]
+
+    def iter_placements(self):
+        return iter(self.jdata["placements"])
+
+    def get_header(self):
+        """Returns all fields except placements"""
+        return dict((k, v) for k, v in self.jdata.iteritems() if k != "placements")
         
     def get_tree(self):
         return self.jdata["tree"]
         
     def get_std_newick_tree(self):
-        tree = self.jdata["tree"]
+        tree = self.get_tree()
         tree = tree.replace("{", "[&&NHX:B=")
         tree = tree.replace("}", "]")
         return tree
@@ -31,15 +45,453 @@ class EpaJsonParser:
     def get_raxml_invocation(self):
         return self.jdata["metadata"]["invocation"]
 
+class JsonStreamReader:
+    """Minimal incremental JSON reader: decodes values one at a time from a file,
+       keeping only a small buffer in memory"""
+    WHITESPACE = " \t\n\r"
+    SKIP_RE = re.compile(r'[\[\]{}"]')
+
+    def __init__(self, fin, bufsize=65536):
+        self.fin = fin
+        self.bufsize = bufsize
+        self.buf = ""
+        self.pos = 0
+        self.offset = fin.tell()
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def fill(self, size=None):
+        if self.eof:
+            return False
+        chunk = self.fin.read(size or self.bufsize)
+        if not chunk:
+            self.eof = True
+            return False
+        drop = min(self.pos, len(self.buf))
+        self.buf = self.buf[drop:] + chunk
+        self.offset += drop
+        self.pos -= drop
+        return True
+        
+    def tell(self):
+        return self.offset + self.pos
+        
+    def skip_ws(self):
+        while True:
+            buf = self.buf
+            pos = self.pos
+            while pos < len(buf) and buf[pos] in JsonStreamReader.WHITESPACE:
+                pos += 1
+            self.pos = pos
+            if pos < len(buf) or not self.fill():
+                return
+                
+    def peek(self):
+        self.skip_ws()
+        if self.pos < len(self.buf):
+            return self.buf[self.pos]
+        else:
+            return None
+
+    def next_char(self):
+        c = self.peek()
+        if c is None:
+            raise ValueError("Unexpected end of JSON input at position %d" % self.tell())
+        self.pos += 1
+        return c
+
+    def expect(self, chars):
+        c = self.next_char()
+        if c not in chars:
+            raise ValueError("Expecting one of '%s' at position %d, found: '%s'" % (chars, self.tell() - 1, c))
+        return c
+
+    def read_value(self):
+        self.skip_ws()
+        while True:
+            try:
+                val, end = self.decoder.raw_decode(self.buf, self.pos)
+                # value can be truncated at buffer end (e.g. number) -> make sure it is complete
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return val
+            except ValueError:
+                if self.eof:
+                    raise
+            # grow read size geometrically to avoid quadratic behavior on large values
+            self.fill(max(self.bufsize, len(self.buf)))
+
+    def skip_value(self):
+        c = self.peek()
+        if c not in ["[", "{", '"']:
+            self.read_value()
+            return
+        depth = 0
+        in_str = False
+        while True:
+            buf = self.buf
+            if in_str:
+                # str.find is much faster than regex search on long strings (e.g. sequences)
+                end = buf.find('"', self.pos)
+                esc = buf.find("\\", self.pos, end if end >= 0 else len(buf))
+                if esc >= 0:
+                    # skip escaped char, which might be in the next chunk
+                    self.pos = esc + 2
+                elif end >= 0:
+                    self.pos = end + 1
+                    in_str = False
+                    if depth == 0:
+                        return
+                else:
+                    self.pos = max(self.pos, len(buf))
+                    if not self.fill():
+                        raise ValueError("Unexpected end of JSON input at position %d" % self.tell())
+                continue
+            m = JsonStreamReader.SKIP_RE.search(buf, self.pos)
+            if not m:
+                self.pos = max(self.pos, len(buf))
+                if not self.fill():
+                    raise ValueError("Unexpected end of JSON input at position %d" % self.tell())
+                continue
+            c = m.group()
+            self.pos = m.end()
+            if c == '"':
+                in_str = True
+            elif c in "[{":
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return
+
+class EpaJsonStreamParser(EpaJsonParser):
+    """Incremental parser for RAxML-EPA json output file: placements are read from
+       the disk one by one, all other fields (tree, metadata etc.) are kept in memory"""
+    def __init__(self, jsonfin):
+        self.jsonfin = jsonfin
+        self.jdata = None
+        self.placements_offset = None
+
+    def load_header(self):
+        if self.jdata is not None:
+            return
+        self.jdata = {}
+        with CompressedIO.open(self.jsonfin) as fin:
+            reader = JsonStreamReader(fin)
+            reader.expect("{")
+            while reader.peek() != "}":
+                key = reader.read_value()
+                reader.expect(":")
+                if key == "placements":
+                    reader.skip_ws()
+                    self.placements_offset = reader.tell()
+                    reader.skip_value()
+                else:
+                    self.jdata[key] = reader.read_value()
+                if reader.expect(",}") == "}":
+                    break
+    
+    def get_placement(self):
+        return list(self.iter_placements())
+
+    def get_header(self):
+        self.load_header()
+        return dict(self.jdata)
+
+    def iter_placements(self):
+        self.load_header()
+        if self.placements_offset is None:
+            return
+        with CompressedIO.open(self.jsonfin) as fin:
+            fin.seek(self.placements_offset)
+            reader = JsonStreamReader(fin)
+            reader.expect("[")
+            if reader.peek() == "]":
+                return
+            while True:
+                yield reader.read_value()
+                if reader.expect(",]") == "]":
+                    break
+        
+    def get_tree(self):
+        self.load_header()
+        return self.jdata["tree"]
+        
+    def get_raxml_version(self):
+        self.load_header()
+        return EpaJsonParser.get_raxml_version(self)
+
+    def get_raxml_invocation(self):
+        self.load_header()
+        return EpaJsonParser.get_raxml_invocation(self)
+
+class EpaJsonMerger:
+    """Merges .jplace files with placements of disjoint query sets (e.g. from sharded EPA runs)
+       into a single file. Placements are streamed in the order of the input files, all other 
+       fields (tree, metadata etc.) are taken from the first file."""
+    @staticmethod
+    def merge(jplace_fnames, out_fname):
+        jp_list = [EpaJsonStreamParser(fname) for fname in jplace_fnames]
+        header = jp_list[0].get_header()
+        with CompressedIO.open(out_fname, "w") as fo:
+            fo.write("{\n")
+            if "tree" in header:
+                fo.write('\t"tree": %s,\n' % json.dumps(header.pop("tree")))
+            fo.write('\t"placements": [\n')
+            first = True
+            for jp in jp_list:
+                for place in jp.iter_placements():
+                    if not first:
+                        fo.write(",\n")
+                    fo.write("\t" + json.dumps(place, separators=(",", ":")))
+                    first = False
+            fo.write("\n\t]")
+            for key in sorted(header.keys()):
+                fo.write(',\n\t"%s": %s' % (key, json.dumps(header[key])))
+            fo.write("\n}\n")
+        return EpaJsonStreamParser(out_fname)
+
+class LazyFieldMap:
+    """Base class for read-only, dict-like views of the reference fields which are decoded
+       on first access only. self.sections maps field names to their JSON text; subclasses
+       store field locations there instead, and override get_raw() (and decode_field() for 
+       other encodings)"""
+    def __init__(self):
+        self.sections = {}
+        self.cache = {}
+
+    def get_raw(self, fname):
+        return self.sections[fname]
+
+    def decode_field(self, fname):
+        return json.loads(self.get_raw(fname))
+
+    def get_type(self, fname):
+        """Returns the type of the field without decoding it (None if unknown)"""
+        return None
+
+    def __contains__(self, fname):
+        return fname in self.sections
+
+    def __iter__(self):
+        return iter(self.sections)
+
+    def __len__(self):
+        return len(self.sections)
+
+    def keys(self):
+        return self.sections.keys()
+        
+    def iteritems(self):
+        for fname in self.sections:
+            yield fname, self[fname]
+
+    def get(self, fname, default=None):
+        if fname in self.sections:
+            return self[fname]
+        else:
+            return default
+
+    def __getitem__(self, fname):
+        if fname not in self.cache:
+            if fname not in self.sections:
+                raise KeyError(fname)
+            self.cache[fname] = self.decode_field(fname)
+        return self.cache[fname]
+
+class LazyJsonFields(LazyFieldMap):
+    """Lazy view of a top-level JSON object: a single pass over the file records the byte 
+       range of every field, the values are decoded on first access. Compressed files do not 
+       allow cheap random access, so their fields are decoded during the (single) scan."""
+    FIRST_CHAR_TYPES = {"{": dict, "[": list, '"': unicode, "t": bool, "f": bool, "n": type(None)}
+
+    def __init__(self, jsonfin):
+        LazyFieldMap.__init__(self)
+        self.jsonfin = jsonfin
+        self.types = {}
+        eager = CompressedIO.is_compressed(jsonfin)
+        with CompressedIO.open(jsonfin) as fin:
+            reader = JsonStreamReader(fin)
+            reader.expect("{")
+            while reader.peek() != "}":
+                key = reader.read_value()
+                if not isinstance(key, basestring):
+                    raise ValueError("Expecting field name at position %d" % reader.tell())
+                reader.expect(":")
+                self.types[key] = LazyJsonFields.FIRST_CHAR_TYPES.get(reader.peek())
+                start = reader.tell()
+                if eager:
+                    self.cache[key] = reader.read_value()
+                else:
+                    reader.skip_value()
+                self.sections[key] = (start, reader.tell())
+                if reader.expect(",}") == "}":
+                    break
+
+    def get_type(self, fname):
+        return self.types[fname]
+
+    def get_raw(self, fname):
+        start, end = self.sections[fname]
+        with open(self.jsonfin) as fin:
+            fin.seek(start)
+            return fin.read(end - start)
+
+class RefBinFormat:
+    """Binary sectioned container for the reference data. The file starts with a fixed header
+       (magic + TOC length), followed by a small JSON table of contents and the raw sections:
+
+           MAGIC | <Q toc_len | toc | section_1 | section_2 | ...
+
+       Every section stores one refjson field. Offsets in the TOC are relative to the end of TOC,
+       so that each section can be addressed (and mmap'ed) independently."""
+    MAGIC = "SATREF\x00\x01"
+    HEADER = struct.Struct("<Q")
+    FORMAT_VERSION = 1
+
+    @staticmethod
+    def is_refbin(fname):
+        try:
+            with open(fname, "rb") as fin:
+                return fin.read(len(RefBinFormat.MAGIC)) == RefBinFormat.MAGIC
+        except IOError:
+            return False
+
+    @staticmethod
+    def split_lines(s):
+        lines = s.split("\n")
+        res = [l + "\n" for l in lines[:-1]]
+        if lines[-1]:
+            res.append(lines[-1])
+        return res
+
+class RefBinWriter:
+    """Writes a refjson dictionary into the binary sectioned container (see RefBinFormat)"""
+    def __init__(self, jdata):
+        self.jdata = jdata
+
+    def encode_field(self, fname, value):
+        """Returns (encoding, type, bytes) for a single field. Bulky fields get a raw encoding
+           which can be consumed directly from the mapped file, everything else is stored as 
+           compact json."""
+        if isinstance(value, basestring):
+            if fname == "binary_model":
+                return "base64", "unicode", base64.b64decode(value)
+            else:
+                return "text", "unicode", value.encode("utf-8")
+        elif isinstance(value, list) and fname == "hmm_profile":
+            if all(isinstance(l, basestring) for l in value):
+                raw = "".join(value)
+                if RefBinFormat.split_lines(raw) == value:
+                    return "lines", "list", raw.encode("utf-8")
+        elif isinstance(value, list) and fname == "sequences" and value:
+            # entries are [name, seq] or [name, seq, comments] as returned by SeqGroup.get_entries()
+            width = len(value[0])
+            if all(len(e) == width and "\t" not in e[0] + e[1] and "\n" not in e[0] + e[1] for e in value) \
+               and (width == 2 or (width == 3 and not any(e[2] for e in value))):
+                raw = "".join("%s\t%s\n" % (e[0], e[1]) for e in value)
+                return "seqs" if width == 2 else "seqs_c", "list", raw.encode("utf-8")
+
+        return "json", type(value).__name__, json.dumps(value, separators=(",", ":"), sort_keys=True)
+
+    def write(self, out_fname):
+        toc = []
+        blobs = []
+        offset = 0
+        for fname in sorted(self.jdata.keys()):
+            enc, ftype, blob = self.encode_field(fname, self.jdata[fname])
+            toc.append([fname, enc, ftype, offset, len(blob)])
+            blobs.append(blob)
+            offset += len(blob)
+            
+        toc_str = json.dumps({"format_version": RefBinFormat.FORMAT_VERSION, "sections": toc}, 
+                             separators=(",", ":"))
+        with open(out_fname, "wb") as fo:
+            fo.write(RefBinFormat.MAGIC)
+            fo.write(RefBinFormat.HEADER.pack(len(toc_str)))
+            fo.write(toc_str)
+            for blob in blobs:
+                fo.write(blob)
+
+class RefBinReader(LazyFieldMap):
+    """Read-only, dict-like view of the binary reference container. The file is mapped into 
+       memory, and sections are decoded on first access only."""
+    TYPES = {"unicode": unicode, "str": unicode, "list": list, "dict": dict, "float": float,
+             "int": int, "long": long, "bool": bool, "NoneType": type(None)}
+
+    def __init__(self, fname):
+        LazyFieldMap.__init__(self)
+        self.fname = fname
+        with open(fname, "rb") as fin:
+            self.mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        
+        hlen = len(RefBinFormat.MAGIC)
+        if self.mm[:hlen] != RefBinFormat.MAGIC:
+            raise ValueError("Not a binary reference file: %s" % fname)
+        toc_len = RefBinFormat.HEADER.unpack_from(self.mm, hlen)[0]
+        toc_start = hlen + RefBinFormat.HEADER.size
+        toc = json.loads(self.mm[toc_start:toc_start+toc_len])
+        if toc["format_version"] > RefBinFormat.FORMAT_VERSION:
+            raise ValueError("Unsupported binary reference format version: %d" % toc["format_version"])
+
+        data_start = toc_start + toc_len
+        for fname, enc, ftype, offset, length in toc["sections"]:
+            self.sections[fname] = (enc, ftype, data_start + offset, length)
+        
+    def close(self):
+        self.cache = {}
+        self.mm.close()
+
+    def get_encoding(self, fname):
+        return self.sections[fname][0]
+
+    def get_type(self, fname):
+        return RefBinReader.TYPES.get(self.sections[fname][1])
+
+    def get_buffer(self, fname):
+        """Returns a zero-copy read-only buffer over the raw section"""
+        enc, ftype, offset, length = self.sections[fname]
+        return buffer(self.mm, offset, length)
+
+    def get_raw(self, fname):
+        enc, ftype, offset, length = self.sections[fname]
+        return self.mm[offset:offset+length]
+
+    def decode_field(self, fname):
+        enc = self.get_encoding(fname)
+        if enc == "json":
+            return LazyFieldMap.decode_field(self, fname)
+        raw = self.get_raw(fname)
+        if enc == "text":
+            return raw.decode("utf-8")
+        elif enc == "base64":
+            return unicode(base64.b64encode(raw))
+        elif enc == "lines":
+            return RefBinFormat.split_lines(raw.decode("utf-8"))
+        elif enc in ["seqs", "seqs_c"]:
+            entries = [l.rstrip("\n").split("\t") for l in RefBinFormat.split_lines(raw.decode("utf-8"))]
+            if enc == "seqs_c":
+                for e in entries:
+                    e.append([])
+            return entries
+        else:
+            raise ValueError("Unknown section encoding: %s" % enc)
+
 class RefJsonChecker:
     def __init__(self, jsonfin= None, jdata = None):
         if jsonfin!=None:
-            self.jdata = json.load(open(jsonfin))
+            with CompressedIO.open(jsonfin) as fin:
+                self.jdata = json.load(fin)
         else:
             self.jdata = jdata
     
     def check_field(self, fname, ftype, fvals=None, fopt=False):
         if fname in self.jdata:
+            # binary container can report field types without decoding them
+            if not fvals and hasattr(self.jdata, "get_type"):
+                field = self.jdata.get_type(fname)
+                if field and issubclass(field, ftype):
+                    return True
             field = self.jdata[fname]
             if isinstance(field, ftype):
                 if not fvals or field in fvals:
@@ -62,14 +514,16 @@ class RefJsonChecker:
         
         self.error = None
 
+        # since v1.7, sequences can be stored either as list or in packed form (see PackedAlignment)
         valid = self.check_field("tree", unicode) \
                 and self.check_field("raxmltree", unicode) \
                 and self.check_field("rate", float) \
                 and self.check_field("node_height", dict) \
                 and self.check_field("origin_taxonomy", dict) \
-                and self.check_field("sequences", list) \
+                and self.check_field("sequences", list if nver < 1.7 else (list, dict)) \
                 and self.check_field("binary_model", unicode) \
-                and self.check_field("hmm_profile", list, fopt=True) 
+                and self.check_field("hmm_profile", list, fopt=True) \
+                and self.check_field("branch_rank_index", dict, fopt=True) 
                 
         # check v1.1 fields, if needed
         if nver >= 1.1:
@@ -107,19 +561,89 @@ class RefJsonChecker:
 
         return (valid, self.error)
 
+class RefNameIndex:
+    """Name-resolution tables of the reference: set of reference sequence names, corrected <-> 
+       original sequence ID maps and corrected -> original rank names. It is built once per parser,
+       and bulk methods translate whole columns of IDs and lineages in one call. Every table is 
+       built on first use, so that e.g. translating ranks does not decode the sequences."""
+    def __init__(self, refjson):
+        self.refjson = refjson
+        self.seq_names = None
+        self.uncorr_seqid_map = None
+        self.corr_seqid_map = None
+        self.uncorr_ranks_map = None
+
+    def has_seq(self, seq_name):
+        if self.seq_names == None:
+            self.seq_names = self.refjson.get_sequences_names()
+        return seq_name in self.seq_names
+
+    def get_uncorr_seqid_map(self):
+        if self.uncorr_seqid_map == None:
+            self.uncorr_seqid_map = self.refjson.get_corr_seqid_map()
+        return self.uncorr_seqid_map
+
+    def get_corr_seqid_map(self):
+        if self.corr_seqid_map == None:
+            self.corr_seqid_map = dict((old, new) for new, old in self.get_uncorr_seqid_map().iteritems())
+        return self.corr_seqid_map
+
+    def get_uncorr_ranks_map(self):
+        if self.uncorr_ranks_map == None:
+            self.uncorr_ranks_map = self.refjson.get_corr_ranks_map()
+        return self.uncorr_ranks_map
+
+    def get_uncorr_seqids(self, seqids):
+        uncorr = self.get_uncorr_seqid_map().get
+        return [uncorr(sid, sid) for sid in seqids]
+
+    def get_corr_seqids(self, seqids):
+        corr = self.get_corr_seqid_map().get
+        return [corr(sid, sid) for sid in seqids]
+
+    def get_uncorr_ranks(self, ranks):
+        uncorr = self.get_uncorr_ranks_map().get
+        return [uncorr(rank, rank) for rank in ranks]
+
+    def get_uncorr_lineages(self, lineages):
+        uncorr = self.get_uncorr_ranks_map().get
+        return [[uncorr(rank, rank) for rank in ranks] for ranks in lineages]
+
 class RefJsonParser:
-    """This class parses the EPA Classifier reference json file"""
+    """This class parses the EPA Classifier reference json file. Binary reference containers
+       (see RefBinFormat) are detected automatically and can be used in the same way.
+       In both cases, fields are decoded lazily, i.e. only when they are first accessed."""
     def __init__(self, jsonfin):
-        self.jdata = json.load(open(jsonfin))
+        if RefBinFormat.is_refbin(jsonfin):
+            self.refbin = RefBinReader(jsonfin)
+            self.jdata = self.refbin
+        else:
+            self.refbin = None
+            self.jdata = LazyJsonFields(jsonfin)
         self.version = self.jdata["version"]
         self.nversion = float(self.version)
         self.corr_seqid = None
         self.corr_ranks = None
-        self.corr_seqid_reverse = None
+        self.branch_rank_index = None
+        self.seq_names = None
+        self.name_index = None
         
     def validate(self):
         jc = RefJsonChecker(jdata = self.jdata)
         return jc.validate(self.version)
+
+    def is_binary(self):
+        return self.refbin != None
+
+    def get_jdata(self):
+        """Returns all fields as a plain dictionary (decodes all remaining fields)"""
+        return dict(self.jdata.iteritems())
+
+    def get_section_buffer(self, fname, encoding):
+        if self.refbin and fname in self.refbin and self.refbin.get_encoding(fname) == encoding:
+            return self.refbin.get_buffer(fname)
+        else:
+            return None
     
     def get_version(self):
         return self.version
@@ -161,6 +685,20 @@ class RefJsonParser:
         else:
             return None
 
+    def get_branch_rank_index(self, bid_tax_map=None):
+        """Return precompiled branch -> lineage index (BranchRankIndex). Older refjsons
+           do not contain it, so in this case it is built from branch_tax_map (or from the 
+           map provided by caller, if any) and cached."""
+        if self.branch_rank_index is None:
+            if "branch_rank_index" in self.jdata:
+                self.branch_rank_index = BranchRankIndex.from_json(self.jdata["branch_rank_index"])
+            else:
+                if not bid_tax_map:
+                    bid_tax_map = self.get_branch_tax_map()
+                if bid_tax_map:
+                    self.branch_rank_index = BranchRankIndex(bid_tax_map)
+        return self.branch_rank_index
+
     def get_taxonomy(self):
         if self.nversion < 1.6:
             return self.jdata["taxonomy"]
@@ -170,37 +708,74 @@ class RefJsonParser:
     def get_origin_taxonomy(self):
         return self.jdata["origin_taxonomy"]
     
+    def get_packed_alignment(self):
+        """Returns PackedAlignment view (refjson v1.7+), or None if sequences are stored as plain list"""
+        seqs = self.jdata["sequences"]
+        if PackedAlignment.is_packed(seqs):
+            return PackedAlignment(seqs)
+        else:
+            return None
+
+    def iter_alignment(self):
+        """Iterates over (name, seq) pairs regardless of the sequence encoding"""
+        packed = self.get_packed_alignment()
+        if packed != None:
+            for name, seq in packed.iter_seqs():
+                yield name, seq
+        else:
+            for entr in self.jdata["sequences"]:
+                yield entr[0], entr[1]
+
     def get_alignment(self, fout):
-        entries = self.jdata["sequences"]
+        if self.refbin and self.refbin.get_encoding("sequences") in ["seqs", "seqs_c"]:
+            # "name\tseq\n" records can be converted to FASTA without decoding the section
+            with open(fout, "w") as fo:
+                for line in self.refbin.get_raw("sequences").splitlines(True):
+                    fo.write(">" + line.replace("\t", "\n", 1))
+            return fout
+
         with open(fout, "w") as fo:
-            for entr in entries:
-                fo.write(">%s\n%s\n" % (entr[0], entr[1]))
+            for name, seq in self.iter_alignment():
+                fo.write(">%s\n%s\n" % (name, seq))
 
         return fout
     
     def get_ref_alignment(self):
-        entries = self.jdata["sequences"]
         alignment = SeqGroup()
-        for entr in entries:
-            alignment.set_seq(entr[0], entr[1])
+        for name, seq in self.iter_alignment():
+            alignment.set_seq(name, seq)
         return alignment
     
     def get_alignment_list(self):
-        return self.jdata["sequences"]
+        packed = self.get_packed_alignment()
+        if packed != None:
+            return packed.to_list()
+        else:
+            return self.jdata["sequences"]
     
     def get_sequences_names(self):
-        nameset = set()
-        entries = self.jdata["sequences"]
-        for entr in entries:
-            nameset.add(entr[0])
-        return nameset
+        if self.seq_names == None:
+            packed = self.get_packed_alignment()
+            if packed != None:
+                self.seq_names = set(packed.get_names())
+            else:
+                self.seq_names = set(entr[0] for entr in self.jdata["sequences"])
+        return self.seq_names
     
     def get_alignment_length(self):
-        entries = self.jdata["sequences"]
-        return len(entries[0][1])
+        packed = self.get_packed_alignment()
+        if packed != None:
+            return packed.get_width()
+        else:
+            return len(self.jdata["sequences"][0][1])
     
     def get_hmm_profile(self, fout):
-        if "hmm_profile" in self.jdata:        
+        buf = self.get_section_buffer("hmm_profile", "lines")
+        if buf:
+            with open(fout, "wb") as fo:
+                fo.write(buf)
+            return fout
+        elif "hmm_profile" in self.jdata:        
             lines = self.jdata["hmm_profile"]
             with open(fout, "w") as fo:
                 for line in lines:
@@ -210,6 +785,11 @@ class RefJsonParser:
             return None
 
     def get_binary_model(self, fout):
+        buf = self.get_section_buffer("binary_model", "base64")
+        if buf:
+            with open(fout, "wb") as fo:
+                fo.write(buf)
+            return
         model_str = self.jdata["binary_model"]
         with open(fout, "wb") as fo:
             fo.write(base64.b64decode(model_str))
@@ -256,98 +836,231 @@ class RefJsonParser:
         else:
             return None
             
+    def get_name_index(self):
+        if self.name_index == None:
+            self.name_index = RefNameIndex(self)
+        return self.name_index
+
     def get_uncorr_seqid(self, new_seqid):
-        if not self.corr_seqid:
-            self.get_corr_seqid_map()
-        return self.corr_seqid.get(new_seqid, new_seqid)
+        return self.get_name_index().get_uncorr_seqid_map().get(new_seqid, new_seqid)
         
     def get_corr_seqid(self, old_seqid):
-        if not self.corr_seqid_reverse:
-            if not self.corr_seqid:
-                self.get_corr_seqid_map()
-            self.corr_seqid_reverse = dict((reversed(item) for item in self.corr_seqid.items()))
-        return self.corr_seqid_reverse.get(old_seqid, old_seqid)
+        return self.get_name_index().get_corr_seqid_map().get(old_seqid, old_seqid)
 
     def get_uncorr_ranks(self, ranks):
-        if not self.corr_ranks:
-            self.get_corr_ranks_map()
-        uncorr_ranks = list(ranks)
-        for i in range(len(ranks)):
-            uncorr_ranks[i] = self.corr_ranks.get(ranks[i], ranks[i])
-        return uncorr_ranks        
-                
+        return self.get_name_index().get_uncorr_ranks(ranks)
+
+    def get_uncorr_seqids(self, seqids):
+        return self.get_name_index().get_uncorr_seqids(seqids)
+
+    def get_corr_seqids(self, seqids):
+        return self.get_name_index().get_corr_seqids(seqids)
+
+    def get_uncorr_lineages(self, lineages):
+        return self.get_name_index().get_uncorr_lineages(lineages)
+
 class RefJsonBuilder:
     """This class builds the EPA Classifier reference json file"""
+    VERSION = "1.7"
+
     def __init__(self, old_json=None):
         if old_json:
-            self.jdata = old_json.jdata
+            self.jdata = old_json.get_jdata()
         else:
             self.jdata = {}
-            self.jdata["version"] = "1.6"
+            self.jdata["version"] = RefJsonBuilder.VERSION
 #            self.jdata["author"] = "Jiajie Zhang"
         
+    def set_field(self, fname, value):
+        self.jdata[fname] = value
+
     def set_branch_tax_map(self, bid_ranks_map):
-        self.jdata["branch_tax_map"] = bid_ranks_map
+        self.set_field("branch_tax_map", bid_ranks_map)
+
+    def set_branch_rank_index(self, rank_index):
+        self.set_field("branch_rank_index", rank_index.to_json())
 
     def set_origin_taxonomy(self, orig_tax_map):
-        self.jdata["origin_taxonomy"] = orig_tax_map
+        self.set_field("origin_taxonomy", orig_tax_map)
 
     def set_tax_tree(self, tr):
-        self.jdata["tax_tree"] = tr.write(format=8)
+        self.set_field("tax_tree", tr.write(format=8))
 
     def set_tree(self, tr):
-        self.jdata["tree"] = tr
-        self.jdata["raxmltree"] = Tree(tr, format=1).write(format=5)
+        self.set_field("tree", tr)
+        self.set_field("raxmltree", Tree(tr, format=1).write(format=5))
         
     def set_outgroup(self, outgr):
-        self.jdata["outgroup"] = outgr.write(format=9)
+        self.set_field("outgroup", outgr.write(format=9))
 
-    def set_sequences(self, seqs):    
-        self.jdata["sequences"] = seqs
+    def set_sequences(self, seqs, packed=True):
+        """seqs is a list of (name, seq, comments) entries; unless packed=False, they are stored
+           in a compact encoding (see PackedAlignment), which requires refjson v1.7"""
+        if packed:
+            self.set_field("sequences", PackedAlignment.pack(seqs))
+            if float(self.jdata.get("version", 0)) < 1.7:
+                self.set_field("version", RefJsonBuilder.VERSION)
+        else:
+            self.set_field("sequences", seqs)
         
     def set_hmm_profile(self, fprofile):    
         with open(fprofile) as fp:
             lines = fp.readlines()
-        self.jdata["hmm_profile"] = lines
+        self.set_field("hmm_profile", lines)
        
     def set_rate(self, rate):    
-        self.jdata["rate"] = rate
+        self.set_field("rate", rate)
         
     def set_nodes_height(self, height):    
-        self.jdata["node_height"] = height
+        self.set_field("node_height", height)
 
     def set_binary_model(self, model_fname):  
         with open(model_fname, "rb") as fin:
             model_str = base64.b64encode(fin.read())
-        self.jdata["binary_model"] = model_str
+        self.set_field("binary_model", model_str)
 
     def set_ratehet_model(self, model):
-        self.jdata["ratehet_model"] = model
+        self.set_field("ratehet_model", model)
 
     def set_pattern_compression(self, value):
-        self.jdata["pattern_compression"] = value
+        self.set_field("pattern_compression", value)
 
     def set_taxcode(self, value):
-        self.jdata["taxcode"] = value
+        self.set_field("taxcode", value)
 
     def set_corr_seqid_map(self, seqid_map):
-        self.jdata["corr_seqid_map"] = seqid_map
+        self.set_field("corr_seqid_map", seqid_map)
 
     def set_corr_ranks_map(self, ranks_map):
-        self.jdata["corr_ranks_map"] = ranks_map
+        self.set_field("corr_ranks_map", ranks_map)
 
     def set_merged_ranks_map(self, merged_ranks_map):
-        self.jdata["merged_ranks_map"] = merged_ranks_map
+        self.set_field("merged_ranks_map", merged_ranks_map)
 
     def set_metadata(self, metadata):    
-        self.jdata["metadata"] = metadata
+        self.set_field("metadata", metadata)
 
     def dump(self, out_fname):
+        """Write reference json, compressed if out_fname ends with .gz, .bz2 or .xz"""
         self.jdata.pop("fields", 0)
         self.jdata["fields"] = self.jdata.keys()
-        with open(out_fname, "w") as fo:
+        with CompressedIO.open(out_fname, "w") as fo:
             json.dump(self.jdata, fo, indent=4, sort_keys=True)                
 
+    def dump_binary(self, out_fname):
+        """Write reference in the binary sectioned format (see RefBinFormat)"""
+        self.jdata.pop("fields", 0)
+        self.jdata["fields"] = self.jdata.keys()
+        RefBinWriter(self.jdata).write(out_fname)
+
+
+class RefJsonStreamBuilder(RefJsonBuilder):
+    """Builds the reference json file on the fly: every field is written to the disk as soon as 
+       it is set, so that the bulky fields (sequences, binary model, HMM profile) never have to be
+       kept in memory in full. Output is written to a temporary file which is renamed to out_fname
+       by dump(), so that an incomplete reference will never be picked up by a restarted job."""
+    B64_CHUNK_SIZE = 3 * 64 * 1024
+
+    def __init__(self, out_fname, compact=False):
+        RefJsonBuilder.__init__(self)
+        self.out_fname = out_fname
+        self.part_fname = out_fname + ".part"
+        self.compact = compact
+        self.fields = []
+        self.fout = CompressedIO.open(self.part_fname, "w", CompressedIO.format_from_ext(out_fname))
+        self.fout.write("{")
+        self.set_field("version", self.jdata["version"])
+
+    def to_json(self, value, level):
+        if self.compact:
+            return json.dumps(value, separators=(",", ":"), sort_keys=True)
+        else:
+            return json.dumps(value, indent=4, sort_keys=True).replace("\n", "\n" + " " * (4 * level))
+
+    def start_field(self, fname):
+        if fname in self.fields:
+            raise ValueError("Field has been already written: %s" % fname)
+        if self.fields:
+            self.fout.write(",")
+        self.fields.append(fname)
+        if self.compact:
+            self.fout.write('"%s":' % fname)
+        else:
+            self.fout.write('\n    "%s": ' % fname)
+
+    def write_list(self, fname, items):
+        self.start_field(fname)
+        self.fout.write("[")
+        first = True
+        for item in items:
+            if not first:
+                self.fout.write(",")
+            if not self.compact:
+                self.fout.write("\n" + " " * 8)
+            self.fout.write(self.to_json(item, 2))
+            first = False
+        if not self.compact and not first:
+            self.fout.write("\n    ")
+        self.fout.write("]")
+
+    def set_field(self, fname, value):
+        self.start_field(fname)
+        self.fout.write(self.to_json(value, 1))
+
+    def set_sequences(self, seqs, packed=True):
+        """seqs can be any iterable of (name, seq, comments) entries"""
+        if not packed:
+            self.write_list("sequences", (list(e) for e in seqs))
+            return
+
+        # packed alignment is written out sequence by sequence, names and width are added in the end
+        self.start_field("sequences")
+        self.fout.write('{"encoding": "%s", "data": [' % PackedAlignment.ENCODING)
+        names = []
+        width = 0
+        for e in seqs:
+            if names:
+                self.fout.write(",")
+            if not self.compact:
+                self.fout.write("\n" + " " * 8)
+            self.fout.write('"%s"' % PackedAlignment.pack_seq(e[1]))
+            names.append(e[0])
+            width = max(width, len(e[1]))
+        self.fout.write('], "names": %s, "width": %d}' % (json.dumps(names), width))
+
+    def set_hmm_profile(self, fprofile):
+        with open(fprofile) as fp:
+            self.write_list("hmm_profile", fp)
+
+    def set_binary_model(self, model_fname):
+        self.start_field("binary_model")
+        self.fout.write('"')
+        with open(model_fname, "rb") as fin:
+            # chunk size is a multiple of 3, so no base64 padding in between
+            while True:
+                chunk = fin.read(RefJsonStreamBuilder.B64_CHUNK_SIZE)
+                if not chunk:
+                    break
+                self.fout.write(base64.b64encode(chunk))
+        self.fout.write('"')
+
+    def dump(self, out_fname=None):
+        """Finalize the reference file (out_fname, if given, must be the same as in constructor)"""
+        if out_fname and out_fname != self.out_fname:
+            raise ValueError("Streaming builder can only write to %s" % self.out_fname)
+        self.set_field("fields", list(self.fields))
+        self.fout.write("\n}" if not self.compact else "}")
+        self.fout.close()
+        os.rename(self.part_fname, self.out_fname)
+
+    def dump_binary(self, out_fname=None):
+        """Finalize the reference file and convert it into the binary format (see RefBinFormat), like
+           epa_refconv.py does. By default, json file is replaced by the binary one."""
+        self.dump()
+        out_fname = out_fname or self.out_fname
+        bin_part_fname = out_fname + ".part"
+        RefJsonBuilder(RefJsonParser(self.out_fname)).dump_binary(bin_part_fname)
+        os.rename(bin_part_fname, out_fname)
 
 if __name__ == "__main__":
     if len(sys.argv) < 2: 
@@ -6,7 +6,6 @@ import operator
 import time
 from ete2 import Tree, SeqGroup
 from config import EpacConfig
-from subprocess import call
 
 class hmmer:
     def __init__(self, config, refalign = None, query = None, refprofile = None, discard = None, seqs = None, minp = 0.9):
@@ -52,7 +51,7 @@ class hmmer:
         call_str = [self.hmmbuildpath, "--symfrac", "0.0", "--informat", informat, self.refprofile, self.refalign]
         if self.cfg.verbose:
             print "\n" + ' '.join(call_str) + "\n"
-        call(call_str) #, stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT)
+        self.cfg.get_scheduler().run("hmmbuild", call_str) #, stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT)
         return self.refprofile
 
     def hmm_align(self):
@@ -60,7 +59,7 @@ class hmmer:
         call_str = [self.hmmalignpath,"-o", self.stockname, self.refprofile, self.query]
         if self.cfg.verbose:
             print "\n" + ' '.join(call_str) + "\n"
-        call(call_str) #, stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT)
+        self.cfg.get_scheduler().run("hmmalign", call_str) #, stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT)
         return self.stockname
     
     def get_hmm_refalignment(self):
@@ -185,7 +184,7 @@ class muscle:
         call_str = [self.musclepath,"-profile", "-in1", aln1, "-in2", aln2, "-out", self.outname]
         if self.cfg.debug:
             print "\n" + ' '.join(call_str) + "\n"
-        call(call_str)
+        self.cfg.get_scheduler().run("muscle", call_str)
         return self.outname
 
 
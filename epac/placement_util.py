@@ -0,0 +1,174 @@
+#! /usr/bin/env python
+import sys
+import json
+import mmap
+import struct
+from array import array
+
+from json_util import EpaJsonParser, EpaJsonStreamParser
+
+class PlacementStore:
+    """Columnar binary store for EPA placements, which can be re-classified without parsing
+       the .jplace file again. Placements are kept in CSR layout: edge fields are stored in
+       separate columns, and query i owns the rows offsets[i]..offsets[i+1]-1 of each column.
+
+           MAGIC | <QQQ query_count edge_count header_len | header | offsets | edge_num |
+                   likelihood | like_weight_ratio | distal_length | pendant_length
+
+       Header is a json object with all .jplace fields except placements (tree, metadata etc.)
+       plus the query names. offsets are uint64, edge_num is int32, all other columns are float64
+       (little-endian). Every column starts at a multiple of 8 bytes."""
+    MAGIC = "SATPLC\x00\x01"
+    HEADER = struct.Struct("<QQQ")
+    FIELDS = ["edge_num", "likelihood", "like_weight_ratio", "distal_length", "pendant_length"]
+    # struct codes of the offsets column and of the edge field columns
+    OFFSET_TYPE = "Q"
+    FIELD_TYPES = ["i", "d", "d", "d", "d"]
+    NAMES_KEY = "query_names"
+    SUFFIX = ".plstore"
+
+    @staticmethod
+    def is_store(fname):
+        try:
+            with open(fname, "rb") as fin:
+                return fin.read(len(PlacementStore.MAGIC)) == PlacementStore.MAGIC
+        except IOError:
+            return False
+
+    @staticmethod
+    def open(fname):
+        """Returns a placement parser for fname, which can be either a placement store or .jplace file"""
+        if PlacementStore.is_store(fname):
+            return PlacementStoreParser(fname)
+        else:
+            return EpaJsonStreamParser(fname)
+
+    @staticmethod
+    def padding(length):
+        return (8 - length % 8) % 8
+
+    @staticmethod
+    def column_sizes(query_count, edge_count):
+        sizes = [struct.calcsize("<" + PlacementStore.OFFSET_TYPE) * (query_count + 1)]
+        for ftype in PlacementStore.FIELD_TYPES:
+            sizes.append(struct.calcsize("<" + ftype) * edge_count)
+        return sizes
+
+class PlacementStoreWriter:
+    """Collects placements into columns (e.g. while they are being classified), and writes them
+       into a placement store. Edges are expected in RAxML field order (s. PlacementStore.FIELDS)."""
+    def __init__(self):
+        self.names = []
+        self.offsets = [0]
+        self.columns = [array(ftype) for ftype in PlacementStore.FIELD_TYPES]
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, place):
+        self.names.append(place["n"])
+        for edge in place["p"]:
+            for col, value in zip(self.columns, edge):
+                col.append(value)
+        self.offsets.append(len(self.columns[0]))
+
+    def add_all(self, placements):
+        for place in placements:
+            self.add(place)
+
+    def tee(self, placements):
+        """Yields placements unchanged, adding each of them to the store"""
+        for place in placements:
+            self.add(place)
+            yield place
+
+    def write(self, fname, jp=None):
+        """Writes the store into fname; other .jplace fields (tree, metadata) are taken from jp"""
+        header = jp.get_header() if jp else {}
+        header["fields"] = PlacementStore.FIELDS
+        header[PlacementStore.NAMES_KEY] = self.names
+        header_str = json.dumps(header, separators=(",", ":"))
+        offset = len(PlacementStore.MAGIC) + PlacementStore.HEADER.size + len(header_str)
+
+        blobs = [struct.pack("<%d%s" % (len(self.offsets), PlacementStore.OFFSET_TYPE), *self.offsets)]
+        for col in self.columns:
+            if sys.byteorder != "little":
+                col = array(col.typecode, col)
+                col.byteswap()
+            blobs.append(col.tostring())
+
+        with open(fname, "wb") as fo:
+            fo.write(PlacementStore.MAGIC)
+            fo.write(PlacementStore.HEADER.pack(len(self.names), len(self.columns[0]), len(header_str)))
+            fo.write(header_str)
+            for blob in blobs:
+                pad = PlacementStore.padding(offset)
+                fo.write("\x00" * pad)
+                fo.write(blob)
+                offset += pad + len(blob)
+
+class PlacementStoreParser(EpaJsonParser):
+    """Reads placements from a placement store. The file is mapped into memory, and edges of
+       each query are unpacked from the columns only when the query is accessed."""
+    def __init__(self, fname):
+        self.fname = fname
+        with open(fname, "rb") as fin:
+            self.mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+
+        hlen = len(PlacementStore.MAGIC)
+        if self.mm[:hlen] != PlacementStore.MAGIC:
+            raise ValueError("Not a placement store file: %s" % fname)
+        self.query_count, self.edge_count, header_len = PlacementStore.HEADER.unpack_from(self.mm, hlen)
+        header_start = hlen + PlacementStore.HEADER.size
+        self.jdata = json.loads(self.mm[header_start:header_start+header_len])
+        self.names = self.jdata.pop(PlacementStore.NAMES_KEY)
+
+        offset = header_start + header_len
+        self.col_offsets = []
+        for size in PlacementStore.column_sizes(self.query_count, self.edge_count):
+            offset += PlacementStore.padding(offset)
+            self.col_offsets.append(offset)
+            offset += size
+        if offset > len(self.mm):
+            raise ValueError("Placement store file is truncated: %s" % fname)
+
+        self.offsets = struct.unpack_from("<%d%s" % (self.query_count + 1, PlacementStore.OFFSET_TYPE),
+                                          self.mm, self.col_offsets[0])
+        self.field_sizes = [struct.calcsize("<" + ftype) for ftype in PlacementStore.FIELD_TYPES]
+        # struct objects for unpacking n consecutive values from each column, by n
+        self.unpackers = {}
+
+    def close(self):
+        self.mm.close()
+
+    def __len__(self):
+        return self.query_count
+
+    def get_header(self):
+        header = dict(self.jdata)
+        header.pop("fields", None)
+        return header
+
+    def get_unpackers(self, n):
+        unpackers = self.unpackers.get(n)
+        if unpackers == None:
+            unpackers = [struct.Struct("<%d%s" % (n, ftype)) for ftype in PlacementStore.FIELD_TYPES]
+            self.unpackers[n] = unpackers
+        return unpackers
+
+    def get_edges(self, qid):
+        """Returns edges of the qid-th query as [edge_num, likelihood, lw, distal, pendant] lists"""
+        start = self.offsets[qid]
+        n = self.offsets[qid+1] - start
+        if n == 0:
+            return []
+        cols = [unpacker.unpack_from(self.mm, col_offset + start * fsize) for unpacker, col_offset, fsize
+                in zip(self.get_unpackers(n), self.col_offsets[1:], self.field_sizes)]
+        return map(list, zip(*cols))
+
+    def get_placement(self):
+        return list(self.iter_placements())
+
+    def iter_placements(self):
+        for qid in xrange(self.query_count):
+            yield {"n": self.names[qid], "p": self.get_edges(qid)}
@@ -7,8 +7,8 @@ import shutil
 import datetime
 import random
 import re
-from subprocess import call,STDOUT
-from json_util import EpaJsonParser
+from json_util import EpaJsonParser, EpaJsonStreamParser
+from compress_util import CompressedIO
 
 class FileUtils:
 
@@ -30,6 +30,8 @@ class FileUtils:
         return fname.replace(old_basedir, new_basedir)    
 
 class RaxmlWrapper:
+    # PTHREADS version of RAxML (shipped with SATIVA) always runs at least 2 threads
+    MIN_THREADS = 2
 
     def __init__(self, config): 
         self.cfg = config
@@ -70,13 +72,17 @@ class RaxmlWrapper:
             else:
                 return align_fname
 
-    def run_epa(self, job_name, align_fname, reftree_fname, optmod_fname="", silent=True, mode="epa", subtree_fname=None,\
-    lhw_acc_threshold=0.999):
+    def get_epa_params(self, align_fname, reftree_fname, optmod_fname="", mode="epa", subtree_fname=None, lhw_acc_threshold=0.999,
+    tip_range=None):
+        """Returns RAxML parameters for the EPA run and the stem of the result file names. In l1o_seq mode, 
+           the test can be restricted to a range of tips (tip_range=(first, last), 1-based, as in alignment)."""
         raxml_params = ["-s", align_fname, "-t", reftree_fname]
         # assume that by the time we call EPA reference has been cleaned already (e.g. with previous reduce_alignment call)
         raxml_params += ["--no-seq-check"]
         if mode == "l1o_seq":
             raxml_params += ["-f", "O"]
+            if tip_range:
+                raxml_params += ["--l1out-start", str(tip_range[0]), "--l1out-end", str(tip_range[1])]
             result_file_stem = "leaveOneOutResults"
         elif mode == "l1o_subtree":
             raxml_params += ["-f", "P", "-z", subtree_fname]
@@ -104,9 +110,21 @@ class RaxmlWrapper:
             else:
                 self.cfg.log.info("WARNING: Binary model file not found: %s" % optmod_fname)
                 self.cfg.log.info("WARNING: Model parameters will be estimated by RAxML")
-                
+
+        return raxml_params, result_file_stem
+
+    def run_epa(self, job_name, align_fname, reftree_fname, optmod_fname="", silent=True, mode="epa", subtree_fname=None,\
+    lhw_acc_threshold=0.999, stream=False, tip_range=None):
+        raxml_params, result_file_stem = self.get_epa_params(align_fname, reftree_fname, optmod_fname, mode, 
+                                                             subtree_fname, lhw_acc_threshold, tip_range)
         self.run(job_name, raxml_params, silent)
         
+        # in streaming mode, placements will be read from the .jplace file on demand
+        if stream:
+            jp_class = EpaJsonStreamParser
+        else:
+            jp_class = EpaJsonParser
+        
         jp = None
         failed = False
         if mode == "l1o_subtree":
@@ -116,13 +134,13 @@ class RaxmlWrapper:
                 jp_fname = self.make_raxml_fname(result_file_stem, job_name) + ".%d.jplace" % (i+1)
                 if not os.path.isfile(jp_fname):
                     break
-                jp.append(EpaJsonParser(jp_fname))
+                jp.append(jp_class(jp_fname))
                 i += 1
             failed = i == 0    
         else:
             jp_fname = self.make_raxml_fname(result_file_stem, job_name) + ".jplace"
             if os.path.isfile(jp_fname):
-                jp = EpaJsonParser(jp_fname)
+                jp = jp_class(jp_fname)
             else:
                 failed = True
             
@@ -133,6 +151,32 @@ class RaxmlWrapper:
         else:        
             return jp
 
+    def run_epa_concurrent(self, job_names, align_fnames, reftree_fname, optmod_fname="", num_threads=None, mode="epa",
+    tip_ranges=None):
+        """Runs EPA on several alignments (or tip ranges, s. get_epa_params) at the same time, each in a separate 
+           RAxML process with num_threads threads. Returns the names of the resulting .jplace files (in the same order)."""
+        if not tip_ranges:
+            tip_ranges = [None] * len(job_names)
+        jobs = []
+        try:
+            for job_name, align_fname, tip_range in zip(job_names, align_fnames, tip_ranges):
+                raxml_params, result_file_stem = self.get_epa_params(align_fname, reftree_fname, optmod_fname, mode,
+                                                                     tip_range=tip_range)
+                jobs.append(self.submit(job_name, raxml_params, num_threads=num_threads))
+            self.cfg.get_executor().wait(jobs)
+        finally:
+            self.cfg.get_executor().cancel(jobs)
+
+        jp_fnames = []
+        for job_name in job_names:
+            jp_fname = self.make_raxml_fname(result_file_stem, job_name) + ".jplace"
+            if not os.path.isfile(jp_fname):
+                errmsg = "RAxML EPA run failed, please examine the log for details:\n %s" \
+                        % self.make_raxml_fname("output", job_name)
+                self.cfg.exit_fatal_error(errmsg)
+            jp_fnames.append(jp_fname)
+        return jp_fnames
+
     def get_std_raxml_options(self, job_name):
         params = ["-m", self.cfg.raxml_model, "-n", job_name]
         
@@ -147,7 +191,7 @@ class RaxmlWrapper:
         
         return params
     
-    def run(self, job_name, params, silent=True, chkpoint_fname=None):
+    def prepare_params(self, job_name, params, chkpoint_fname=None):
         if self.cfg.raxml_model == "AUTO":
             errmsg = "ERROR: you should have called EpacConfig.resolve_auto_settings() in your script!\n"
             self.cfg.exit_fatal_error(errmsg)
@@ -165,24 +209,50 @@ class RaxmlWrapper:
         if chkpoint_fname:
             lparams += ["-Z", chkpoint_fname]
 
-        if self.cfg.run_on_cluster:
-            self.run_cluster(lparams)
-            return;        
+        return lparams
 
-        if self.cfg.raxml_remote_call:
-            call_str = ["ssh", self.cfg.raxml_remote_host]
-        else:
-            call_str = []
-        call_str += self.cfg.raxml_cmd + lparams
+    def get_raxml_cmd(self, num_threads=None):
+        """RAxML command line; if num_threads is given, it overrides the number of threads from config"""
+        raxml_cmd = list(self.cfg.raxml_cmd)
+        if num_threads != None:
+            if "-T" in raxml_cmd:
+                i = raxml_cmd.index("-T")
+                del raxml_cmd[i:i+2]
+            raxml_cmd += ["-T", str(self.get_job_threads(num_threads))]
+        return raxml_cmd
+
+    def get_call_str(self, lparams, num_threads=None):
+        return self.get_raxml_cmd(num_threads) + lparams
+
+    def run(self, job_name, params, silent=True, chkpoint_fname=None, num_threads=None):
+        lparams = self.prepare_params(job_name, params, chkpoint_fname)
+        call_str = self.get_call_str(lparams, num_threads)
         if silent:        
             self.cfg.log.debug(' '.join(call_str) + "\n")
             out_fname = self.make_raxml_fname("output", job_name)
-            with open(out_fname, "w") as fout:
-                call(call_str, stdout=fout, stderr=STDOUT)
         else:        
-            call(call_str)
+            out_fname = None
+        self.cfg.get_executor().run(job_name, call_str, self.get_job_threads(num_threads), out_fname)
 
         return ' '.join(call_str)
+
+    def submit(self, job_name, params, chkpoint_fname=None, num_threads=None):
+        """Same as run(), but returns immediately: RAxML job is submitted to the executor (s. EpacConfig.get_executor) 
+           with output redirected to a file, and scheduler Job is returned"""
+        lparams = self.prepare_params(job_name, params, chkpoint_fname)
+        call_str = self.get_call_str(lparams, num_threads)
+        self.cfg.log.debug(' '.join(call_str) + "\n")
+        out_fname = self.make_raxml_fname("output", job_name)
+        return self.cfg.get_executor().submit(job_name, call_str, self.get_job_threads(num_threads), out_fname)
+
+    def get_job_threads(self, num_threads=None):
+        num_threads = num_threads if num_threads != None else self.cfg.num_threads
+        return max(RaxmlWrapper.MIN_THREADS, num_threads)
+
+    def get_split_threads(self, count):
+        """Threads per RAxML process, if count processes share the threads. Processes never get fewer
+           than MIN_THREADS threads: if there are not enough, the scheduler runs fewer of them at a time."""
+        return self.get_job_threads(self.cfg.num_threads // count)
         
     def restart_from_checkpoint(self, job_name, params, silent=True):
         old_chkpoint_fname = self.checkpoint_fname(job_name)
@@ -199,7 +269,13 @@ class RaxmlWrapper:
             
         return self.run(job_name, params, silent, chkpoint_fname)
         
-    def run_multiple(self, job_name, params, repnum, silent=True):    
+    def run_multiple(self, job_name, params, repnum, silent=True, concurrent=1, ratehet="GAMMA"):    
+        """Runs repnum independent RAxML searches, and copies the result files of the search with
+           the best logLH to job_name. If concurrent > 1, up to concurrent searches run at the same 
+           time, and threads are split evenly between them."""
+        if concurrent > 1 and repnum > 1:
+            return self.run_concurrent(job_name, params, repnum, min(concurrent, repnum), ratehet)
+
         best_lh = float("-inf")
         best_jobname = None
         check_old_jobs = self.cfg.restart
@@ -235,12 +311,79 @@ class RaxmlWrapper:
                   
             if call_raxml:
                 invoc_str = self.run(rep_jobname, params, silent, chkpoint_fname)
-            lh = self.get_tree_lh(rep_jobname, "GAMMA")
+            lh = self.get_tree_lh(rep_jobname, ratehet)
             if lh > best_lh:
                 best_lh = lh
                 best_jobname = rep_jobname
-            self.cfg.log.debug("Tree %d GAMMA-based logLH: %s\n" % (i, str(lh)))
+            self.cfg.log.debug("Tree %d %s-based logLH: %s\n" % (i, ratehet, str(lh)))
+        
+        self.copy_best_replicate(best_jobname, job_name)
         
+        return invoc_str
+
+    def run_concurrent(self, job_name, params, repnum, concurrent, ratehet="GAMMA"):
+        """Concurrent version of run_multiple(). In resume mode, searches which have already 
+           finished are skipped, and interrupted ones are resumed from their own checkpoints."""
+        num_threads = self.get_split_threads(concurrent)
+        concurrent = max(1, min(concurrent, self.cfg.num_threads // num_threads))
+        self.cfg.log.debug("Running %d RAxML searches, %d at a time with %d thread(s) each\n", repnum, concurrent, num_threads)
+
+        rep_jobnames = ["%s.%d" % (job_name, i) for i in range(repnum)]
+        executor = self.cfg.get_executor()
+        jobs = []
+        try:
+            # job name -> checkpoint to resume from
+            resumed = {}
+            for rep_jobname in rep_jobnames:
+                if self.cfg.restart and self.get_tree_lh(rep_jobname, ratehet) != None:
+                    self.cfg.log.debug("Using finished RAxML search from previous run: %s\n", rep_jobname)
+                    continue
+                chkpoint_fname = self.get_resume_checkpoint(rep_jobname) if self.cfg.restart else None
+                if chkpoint_fname:
+                    resumed[rep_jobname] = chkpoint_fname
+                jobs.append(self.submit(rep_jobname, params, chkpoint_fname, num_threads))
+            executor.wait(jobs)
+
+            for rep_jobname in resumed:
+                if self.get_tree_lh(rep_jobname, ratehet) == None:
+                    # checkpoint could be incomplete or incompatible -> start this search anew
+                    self.cfg.log.debug("Resuming from checkpoint failed, restarting RAxML search: %s\n", rep_jobname)
+                    jobs.append(self.submit(rep_jobname, params, None, num_threads))
+            executor.wait(jobs)
+        finally:
+            executor.cancel(jobs)
+
+        best_lh = float("-inf")
+        best_jobname = None
+        for i, rep_jobname in enumerate(rep_jobnames):
+            lh = self.get_tree_lh(rep_jobname, ratehet)
+            self.cfg.log.debug("Tree %d %s-based logLH: %s\n" % (i, ratehet, str(lh)))
+            if lh != None and lh > best_lh:
+                best_lh = lh
+                best_jobname = rep_jobname
+
+        if not best_jobname:
+            errmsg = "RAxML run failed, please examine the log for details:\n %s" \
+                    % self.make_raxml_fname("output", rep_jobnames[0])
+            self.cfg.exit_fatal_error(errmsg)
+
+        self.copy_best_replicate(best_jobname, job_name)
+
+        return self.get_invocation_str(best_jobname)
+
+    def get_resume_checkpoint(self, job_name):
+        """Returns checkpoint file of an interrupted RAxML run (if any), renamed so that it
+           survives cleanup() before the job is restarted"""
+        old_chkpoint_fname = self.checkpoint_fname(job_name)
+        if not os.path.isfile(old_chkpoint_fname):
+            old_chkpoint_fname = self.bkup_checkpoint_fname(job_name)
+            if not os.path.isfile(old_chkpoint_fname):
+                return None
+        chkpoint_fname = self.checkpoint_fname(job_name) + ".resume"
+        shutil.move(old_chkpoint_fname, chkpoint_fname)
+        return chkpoint_fname
+
+    def copy_best_replicate(self, best_jobname, job_name):
         best_fname = self.info_fname(best_jobname)
         dst_fname = self.info_fname(job_name)
         shutil.copy(best_fname, dst_fname)
@@ -248,43 +391,17 @@ class RaxmlWrapper:
         best_fname = self.result_fname(best_jobname)
         dst_fname = self.result_fname(job_name)
         shutil.copy(best_fname, dst_fname)
+
+        # single searches produce best tree and model files as well (except for -f e)
+        for stem in ["bestTree", "binaryModelParameters"]:
+            best_fname = self.make_raxml_fname(stem, best_jobname)
+            if os.path.isfile(best_fname):
+                shutil.copy(best_fname, self.make_raxml_fname(stem, job_name))
         
-        return invoc_str
-        
-    def run_cluster(self, params):
-        if self.cfg.raxml_remote_call:
-            qsub_call_str = ["ssh", self.cfg.raxml_remote_host]
-        else:
-            qsub_call_str = []
-        
-        raxml_call_cmd = self.cfg.raxml_cmd + params        
-        for i in range(len(raxml_call_cmd)):
-            if isinstance(raxml_call_cmd[i], basestring):
-                raxml_call_cmd[i] = FileUtils.rebase(raxml_call_cmd[i], self.cfg.epac_home, self.cfg.cluster_epac_home)
-        raxml_call_str = ' '.join(raxml_call_cmd)
-                
-        script_fname = self.cfg.tmp_fname("%NAME%_sub.sh")
-        FileUtils.remove_if_exists(script_fname)
-        shutil.copy(self.cfg.cluster_qsub_script, script_fname)
-        qsub_job_name = "epa"        
-        with open(script_fname, "a") as fout:
-            fout.write("#$ -N %s\n" % qsub_job_name)
-            fout.write("\n")            
-            fout.write(raxml_call_str + "\n")
-
-        cluster_script_fname = FileUtils.rebase(script_fname, self.cfg.epac_home, self.cfg.cluster_epac_home)
-        qsub_call_str += ["qsub", "-sync", "y", cluster_script_fname]
-
-        print raxml_call_str + "\n"
-        print ' '.join(qsub_call_str) + "\n"
-#        sys.exit()
-
-        call(qsub_call_str)
-        if not self.cfg.debug:
-            FileUtils.remove_if_exists(script_fname)
-            
     def get_tree_lh(self, job_name, ratehet="GAMMA"):
         info_fname = self.info_fname(job_name)
+        if not os.path.isfile(info_fname):
+            return None
         with open(info_fname, "r") as info_file:
             info_str = info_file.read()
         
@@ -377,7 +494,5 @@ class RaxmlWrapper:
         else:
             return
         src_fname = self.make_raxml_fname(result_file_stem, job_name) + ".jplace"
-        if move:
-            shutil.move(src_fname, dst_fname)
-        else:
-            shutil.copy(src_fname, dst_fname)
+        # jplace will be compressed on the fly if dst_fname ends with .gz, .bz2 or .xz
+        CompressedIO.copy(src_fname, dst_fname, move)
@@ -0,0 +1,275 @@
+#! /usr/bin/env python
+import os
+import time
+import atexit
+import signal
+import threading
+import collections
+from subprocess import Popen, STDOUT
+
+class Job:
+    """External command (RAxML, HMMER etc.) submitted to JobScheduler"""
+    PENDING = "pending"
+    RUNNING = "running"
+    FINISHED = "finished"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+    TIMEOUT = "timeout"
+
+    def __init__(self, name, call_str, threads=1, out_fname=None, timeout=None, cwd=None):
+        self.name = name
+        self.call_str = call_str
+        self.threads = threads
+        self.out_fname = out_fname
+        self.timeout = timeout
+        self.cwd = cwd
+        self.state = Job.PENDING
+        self.proc = None
+        self.fout = None
+        self.returncode = None
+        self.error = None
+        self.start_time = None
+        self.end_time = None
+        self.cancel_requested = False
+        self.kill_time = None
+        self.done_event = threading.Event()
+
+    def __str__(self):
+        return "%s [%s]" % (self.name, self.state)
+
+    def is_done(self):
+        return self.done_event.is_set()
+
+    def succeeded(self):
+        return self.state == Job.FINISHED and self.returncode == 0
+
+    def get_elapsed_time(self):
+        if self.start_time == None:
+            return 0.
+        end_time = self.end_time if self.end_time != None else time.time()
+        return end_time - self.start_time
+
+class JobScheduler:
+    """Runs external commands in the background. Jobs are started in the order of submission, as long
+       as the number of running jobs does not exceed max_jobs and their threads do not exceed the
+       shared budget of max_threads (a job which needs more threads than that runs alone). Processes
+       are started and polled by a dispatcher thread, so the caller can submit, wait for or cancel
+       jobs at any time. Every job runs in its own process group, which is signalled as a whole:
+       commands are often wrapper scripts (e.g. run_raxml.sh), which would leave orphans otherwise."""
+    POLL_INTERVAL = 0.2
+    # time between SIGTERM and SIGKILL for jobs which are cancelled or timed out
+    KILL_TIMEOUT = 10.
+
+    def __init__(self, max_threads=1, max_jobs=None, log=None):
+        self.max_threads = max(1, max_threads)
+        self.max_jobs = max_jobs
+        self.log = log
+        self.pending = collections.deque()
+        self.running = []
+        self.cond = threading.Condition(threading.RLock())
+        self.dispatcher = None
+        self.closed = False
+        self.terminated = False
+        atexit.register(self.cleanup)
+
+    def submit(self, name, call_str, threads=1, out_fname=None, timeout=None, cwd=None):
+        """Queues a command and returns its Job. Output goes to out_fname, if given (otherwise
+           to the console). timeout is the max running time in seconds."""
+        job = Job(name, call_str, threads, out_fname, timeout, cwd)
+        with self.cond:
+            if self.closed:
+                raise RuntimeError("Job scheduler has been shut down")
+            self.pending.append(job)
+            if not self.dispatcher:
+                self.dispatcher = threading.Thread(target=self.dispatch, name="JobScheduler")
+                self.dispatcher.daemon = True
+                self.dispatcher.start()
+            self.cond.notify_all()
+        return job
+
+    def run(self, name, call_str, threads=1, out_fname=None, timeout=None, cwd=None):
+        """Blocking version of submit(): returns the Job once it is done. Like subprocess.call(),
+           raises OSError if the command could not be started."""
+        job = self.submit(name, call_str, threads, out_fname, timeout, cwd)
+        try:
+            self.wait(job)
+        except BaseException:
+            self.cancel(job)
+            raise
+        if job.error:
+            raise job.error
+        return job
+
+    def wait(self, jobs, timeout=None):
+        """Waits for a job or a list of jobs; returns False if timeout has expired before they finished"""
+        if isinstance(jobs, Job):
+            jobs = [jobs]
+        deadline = time.time() + timeout if timeout != None else None
+        for job in jobs:
+            # wait in short intervals: waiting without timeout would block signal handlers
+            while not job.done_event.wait(JobScheduler.POLL_INTERVAL):
+                if deadline != None and time.time() > deadline:
+                    return False
+        return True
+
+    def cancel(self, jobs):
+        """Cancels jobs: pending jobs are discarded, running ones are terminated. Returns once
+           all of them are done."""
+        if isinstance(jobs, Job):
+            jobs = [jobs]
+        with self.cond:
+            for job in jobs:
+                if job.state == Job.PENDING and job in self.pending:
+                    self.pending.remove(job)
+                    self.finish_job(job, Job.CANCELLED)
+                elif job.state == Job.RUNNING:
+                    job.cancel_requested = True
+            self.cond.notify_all()
+        self.wait(jobs)
+
+    def shutdown(self, cancel=False):
+        """Stops accepting new jobs, and waits for submitted jobs (or cancels them)"""
+        with self.cond:
+            self.closed = True
+            jobs = list(self.pending) + self.running
+        if cancel:
+            self.cancel(jobs)
+        else:
+            self.wait(jobs)
+
+    def terminate_all(self):
+        """Terminates running jobs and discards pending ones. The lock is not acquired, since this
+           is called from the signal handler (which could interrupt the thread holding the lock)."""
+        self.closed = True
+        self.terminated = True
+        while self.pending:
+            job = self.pending.popleft()
+            job.state = Job.CANCELLED
+            job.done_event.set()
+        # jobs started by the dispatcher from now on are killed by itself (s. start_job)
+        procs = [job.proc for job in list(self.running) if job.proc]
+        for proc in procs:
+            JobScheduler.send_signal(proc, signal.SIGTERM)
+        deadline = time.time() + JobScheduler.KILL_TIMEOUT
+        for proc in procs:
+            while proc.poll() == None and time.time() < deadline:
+                time.sleep(0.1)
+            # wrapper script could have exited already, but not the processes it has started
+            JobScheduler.send_signal(proc, signal.SIGKILL)
+        return len(procs)
+
+    def cleanup(self):
+        """Terminates jobs which are still running at exit (e.g. after a fatal error), and waits for
+           the dispatcher thread, which would otherwise be killed during interpreter shutdown"""
+        if self.running or self.pending:
+            self.terminate_all()
+        self.closed = True
+        dispatcher = self.dispatcher
+        if dispatcher:
+            dispatcher.join(JobScheduler.KILL_TIMEOUT)
+
+    def install_signal_handler(self, signums=(signal.SIGTERM, signal.SIGINT)):
+        """Makes the process terminate running jobs and exit on signals (e.g. SIGTERM sent by the
+           cluster batch system once job time limit has expired). Temp files are kept, so that the
+           run can be resumed later (-R). Must be called from the main thread."""
+        def handler(signum, frame):
+            if self.log:
+                self.log.info("\nReceived signal %d, terminating running jobs...\n", signum)
+            self.terminate_all()
+            raise SystemExit(128 + signum)
+        for signum in signums:
+            signal.signal(signum, handler)
+
+    @staticmethod
+    def send_signal(proc, signum):
+        try:
+            os.killpg(proc.pid, signum)
+        except OSError:
+            # process group is gone already
+            pass
+
+    def get_used_threads(self):
+        return sum(min(job.threads, self.max_threads) for job in self.running)
+
+    def dispatch(self):
+        """Dispatcher thread: exits once there are no jobs left, and is re-started by submit()"""
+        with self.cond:
+            while True:
+                self.check_jobs()
+                self.start_jobs()
+                if not self.running and not self.pending:
+                    self.dispatcher = None
+                    break
+                self.cond.wait(JobScheduler.POLL_INTERVAL)
+
+    def start_jobs(self):
+        # pending queue can be emptied by terminate_all() at any time
+        while not self.terminated:
+            try:
+                job = self.pending[0]
+            except IndexError:
+                break
+            if self.running:
+                if self.max_jobs and len(self.running) >= self.max_jobs:
+                    break
+                if self.get_used_threads() + min(job.threads, self.max_threads) > self.max_threads:
+                    break
+            try:
+                self.pending.remove(job)
+            except ValueError:
+                break
+            self.start_job(job)
+
+    def start_job(self, job):
+        job.start_time = time.time()
+        job.state = Job.RUNNING
+        # job is added to the running list first, so that terminate_all() can't miss it
+        self.running.append(job)
+        try:
+            if job.out_fname:
+                job.fout = open(job.out_fname, "w")
+                job.proc = Popen(job.call_str, stdout=job.fout, stderr=STDOUT, cwd=job.cwd, preexec_fn=os.setpgrp)
+            else:
+                job.proc = Popen(job.call_str, cwd=job.cwd, preexec_fn=os.setpgrp)
+        except (OSError, IOError), e:
+            self.running.remove(job)
+            job.error = e
+            self.finish_job(job, Job.FAILED)
+            return
+        if self.terminated:
+            JobScheduler.send_signal(job.proc, signal.SIGKILL)
+
+    def check_jobs(self):
+        now = time.time()
+        for job in list(self.running):
+            job.returncode = job.proc.poll()
+            if job.returncode != None:
+                self.running.remove(job)
+                if job.kill_time:
+                    # make sure that no process of the terminated job has survived
+                    JobScheduler.send_signal(job.proc, signal.SIGKILL)
+                self.finish_job(job, Job.FINISHED if job.state == Job.RUNNING else job.state)
+            elif job.kill_time:
+                if now > job.kill_time:
+                    JobScheduler.send_signal(job.proc, signal.SIGKILL)
+            elif job.cancel_requested:
+                self.terminate_job(job, Job.CANCELLED)
+            elif job.timeout and now - job.start_time > job.timeout:
+                if self.log:
+                    self.log.info("Job %s has exceeded the time limit of %d seconds, terminating it...\n",
+                                  job.name, job.timeout)
+                self.terminate_job(job, Job.TIMEOUT)
+
+    def terminate_job(self, job, state):
+        job.state = state
+        job.kill_time = time.time() + JobScheduler.KILL_TIMEOUT
+        JobScheduler.send_signal(job.proc, signal.SIGTERM)
+
+    def finish_job(self, job, state):
+        job.state = state
+        job.end_time = time.time()
+        if job.fout:
+            job.fout.close()
+            job.fout = None
+        job.done_event.set()
+        self.cond.notify_all()
@@ -0,0 +1,161 @@
+#! /usr/bin/env python
+import re
+import base64
+import binascii
+from string import maketrans
+
+class PackedAlignment:
+    """Compact representation of the reference alignment (refjson v1.7+). Every sequence is stored
+       as a base64-encoded blob, which consists of a one-byte format flag followed by the payload:
+
+           FMT_NT4RLE: alphabet_size | alphabet | [varint residue_count | residues | varint gap_count]*
+           FMT_RAW:    sequence as utf-8 text (fallback for sequences with >16 distinct characters)
+
+       Alphabet is the list of characters occurring in the sequence (gap is always the first one),
+       which allows to store IUPAC codes, undetermined characters etc. with 4 bits per residue.
+       Runs of gaps shorter than MIN_GAP_RUN are stored as residues. 4-bit codes are decoded with 
+       hexlify + translate, i.e. without per-character python loops."""
+    ENCODING = "nt4rle"
+    MAX_ALPHABET_SIZE = 16
+    HEX_DIGITS = "0123456789abcdef"
+    FMT_NT4RLE = "\x00"
+    FMT_RAW = "\x01"
+    MIN_GAP_RUN = 4
+    GAP_RUN_RE = re.compile("-{%d,}" % MIN_GAP_RUN)
+
+    @staticmethod
+    def write_varint(value, out):
+        while value >= 0x80:
+            out.append(chr((value & 0x7F) | 0x80))
+            value >>= 7
+        out.append(chr(value))
+
+    @staticmethod
+    def read_varint(data, pos):
+        value = 0
+        shift = 0
+        while True:
+            b = ord(data[pos])
+            pos += 1
+            value |= (b & 0x7F) << shift
+            if b < 0x80:
+                return value, pos
+            shift += 7
+
+    @staticmethod
+    def get_alphabet(seq):
+        """Returns the alphabet for 4-bit encoding of seq, or None if seq cannot be encoded"""
+        try:
+            seq = str(seq)
+        except UnicodeEncodeError:
+            return None
+        alphabet = "-" + "".join(sorted(set(seq) - set("-")))
+        return alphabet if len(alphabet) <= PackedAlignment.MAX_ALPHABET_SIZE else None
+
+    @staticmethod
+    def is_packable(seq):
+        return PackedAlignment.get_alphabet(seq) != None
+
+    @staticmethod
+    def pack_seq(seq):
+        alphabet = PackedAlignment.get_alphabet(seq)
+        if not alphabet:
+            return base64.b64encode(PackedAlignment.FMT_RAW + unicode(seq).encode("utf-8"))
+
+        seq = str(seq)
+        trantab = maketrans(alphabet, PackedAlignment.HEX_DIGITS[:len(alphabet)])
+        out = [PackedAlignment.FMT_NT4RLE, chr(len(alphabet)), alphabet]
+        start = 0
+        for m in PackedAlignment.GAP_RUN_RE.finditer(seq):
+            PackedAlignment.pack_run(seq[start:m.start()], m.end() - m.start(), trantab, out)
+            start = m.end()
+        if start < len(seq):
+            PackedAlignment.pack_run(seq[start:], 0, trantab, out)
+        return base64.b64encode("".join(out))
+
+    @staticmethod
+    def pack_run(residues, gap_count, trantab, out):
+        PackedAlignment.write_varint(len(residues), out)
+        if residues:
+            hex_str = residues.translate(trantab)
+            if len(hex_str) % 2:
+                hex_str += "0"
+            out.append(binascii.unhexlify(hex_str))
+        PackedAlignment.write_varint(gap_count, out)
+
+    @staticmethod
+    def unpack_seq(packed):
+        data = base64.b64decode(packed)
+        if data[0] == PackedAlignment.FMT_RAW:
+            return data[1:].decode("utf-8")
+
+        alphabet_size = ord(data[1])
+        alphabet = data[2:2+alphabet_size]
+        trantab = maketrans(PackedAlignment.HEX_DIGITS[:alphabet_size], alphabet)
+        chunks = []
+        pos = 2 + alphabet_size
+        end = len(data)
+        while pos < end:
+            res_count, pos = PackedAlignment.read_varint(data, pos)
+            if res_count:
+                res_bytes = (res_count + 1) // 2
+                hex_str = binascii.hexlify(data[pos:pos+res_bytes])
+                chunks.append(hex_str[:res_count].translate(trantab))
+                pos += res_bytes
+            gap_count, pos = PackedAlignment.read_varint(data, pos)
+            if gap_count:
+                chunks.append("-" * gap_count)
+        return "".join(chunks)
+
+    @staticmethod
+    def pack(entries):
+        """Returns json-serializable packed representation of the alignment. entries are
+           (name, seq) or (name, seq, comments) tuples; comments are not preserved."""
+        names = []
+        data = []
+        width = 0
+        for e in entries:
+            names.append(e[0])
+            data.append(PackedAlignment.pack_seq(e[1]))
+            width = max(width, len(e[1]))
+        return {"encoding": PackedAlignment.ENCODING, "width": width, "names": names, "data": data}
+
+    @staticmethod
+    def is_packed(value):
+        return isinstance(value, dict) and value.get("encoding") == PackedAlignment.ENCODING
+
+    def __init__(self, jdict):
+        if not PackedAlignment.is_packed(jdict):
+            raise ValueError("Unknown alignment encoding: %s" % jdict.get("encoding"))
+        self.names = jdict["names"]
+        self.data = jdict["data"]
+        self.width = jdict["width"]
+        self.name2id = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def get_names(self):
+        return self.names
+
+    def get_width(self):
+        return self.width
+
+    def has_seq(self, name):
+        return self.get_seqid(name) != None
+
+    def get_seqid(self, name):
+        if self.name2id == None:
+            self.name2id = dict((n, i) for i, n in enumerate(self.names))
+        return self.name2id.get(name)
+
+    def get_seq(self, name):
+        return PackedAlignment.unpack_seq(self.data[self.get_seqid(name)])
+
+    def iter_seqs(self):
+        for name, packed in zip(self.names, self.data):
+            yield name, PackedAlignment.unpack_seq(packed)
+
+    def to_list(self):
+        """Returns alignment in the plain refjson format (list of [name, seq, comments])"""
+        return [[name, seq, []] for name, seq in self.iter_seqs()]
@@ -4,6 +4,8 @@ import sys
 import os
 import time
 import glob
+import re
+import itertools
 import multiprocessing
 from operator import itemgetter
 from subprocess import call
@@ -12,9 +14,11 @@ from epac.ete2 import Tree, SeqGroup
 from epac.argparse import ArgumentParser,RawDescriptionHelpFormatter
 from epac.config import SativaConfig,EpacConfig
 from epac.raxml_util import RaxmlWrapper, FileUtils
-from epac.json_util import RefJsonParser, RefJsonChecker, EpaJsonParser
+from epac.json_util import RefJsonParser, RefJsonChecker, EpaJsonParser, EpaJsonStreamParser, EpaJsonMerger
 from epac.taxonomy_util import TaxCode, Taxonomy
 from epac.classify_util import TaxTreeHelper,TaxClassifyHelper
+from epac.cache_util import RefArtifactCache
+from epac.placement_util import PlacementStore, PlacementStoreWriter
 import epa_trainer
 
 DISCLAIMER="""WARNING: The revised taxon name suggested here is not necessarily the one that has priority in nomenclature. 
@@ -28,6 +32,7 @@ class LeaveOneTest:
         self.mis_fname = self.cfg.out_fname("%NAME%.mis")
         self.premis_fname = self.cfg.out_fname("%NAME%.premis")
         self.misrank_fname = self.cfg.out_fname("%NAME%.misrank")
+        self.sweep_fname = self.cfg.out_fname("%NAME%.sweep.txt")
         self.stats_fname = self.cfg.out_fname("%NAME%.stats")
         
         if os.path.isfile(self.mis_fname):
@@ -75,25 +80,37 @@ class LeaveOneTest:
         if not valid:
             self.cfg.log.error("ERROR: Parsing reference JSON file failed:\n%s", err)
             self.cfg.exit_user_error()
+
+        # only user-supplied references are worth caching, not the ones we've just built
+        if self.cfg.ref_cache_dir and self.cfg.load_refjson:
+            self.ref_cache = RefArtifactCache(self.cfg, refjson_fname, self.refjson)
+            snapshot = self.ref_cache.get_snapshot()
+        else:
+            self.ref_cache = None
+            snapshot = None
         
-        self.rate = self.refjson.get_rate()
-        self.node_height = self.refjson.get_node_height()
-        self.origin_taxonomy = self.refjson.get_origin_taxonomy()
-        self.tax_tree = self.refjson.get_tax_tree()
+        # parsed trees and maps are loaded from snapshot, if available
+        refdata = snapshot if snapshot else self.refjson
+        self.rate = refdata.get_rate()
+        self.node_height = refdata.get_node_height()
+        self.origin_taxonomy = refdata.get_origin_taxonomy()
+        self.tax_tree = refdata.get_tax_tree()
         self.cfg.compress_patterns = self.refjson.get_pattern_compression()
 
-        self.bid_taxonomy_map = self.refjson.get_branch_tax_map()
+        self.bid_taxonomy_map = refdata.get_branch_tax_map()
         if not self.bid_taxonomy_map:
             # old file format (before 1.6), need to rebuild this map from scratch
             th = TaxTreeHelper(self.cfg, self.origin_taxonomy)
             th.set_mf_rooted_tree(self.tax_tree)
-            th.set_bf_unrooted_tree(self.refjson.get_reftree())
+            th.set_bf_unrooted_tree(refdata.get_reftree())
             self.bid_taxonomy_map = th.get_bid_taxonomy_map()
             
         self.write_bid_tax_map(self.bid_taxonomy_map, final=False)
 
-        reftree_str = self.refjson.get_raxml_readable_tree()
-        self.reftree = Tree(reftree_str)
+        if snapshot:
+            self.reftree = snapshot.get_raxml_reftree()
+        else:
+            self.reftree = Tree(self.refjson.get_raxml_readable_tree())
         self.reftree_size = len(self.reftree.get_leaves())
 
         # IMPORTANT: set EPA heuristic rate based on tree size!                
@@ -102,7 +119,8 @@ class LeaveOneTest:
         if self.cfg.epa_load_optmod:
             self.cfg.raxml_model = self.refjson.get_ratehet_model()
 
-        self.classify_helper = TaxClassifyHelper(self.cfg, self.bid_taxonomy_map, self.rate, self.node_height)
+        rank_index = refdata.get_branch_rank_index(self.bid_taxonomy_map)
+        self.classify_helper = TaxClassifyHelper(self.cfg, self.bid_taxonomy_map, self.rate, self.node_height, rank_index)
         self.taxtree_helper = TaxTreeHelper(self.cfg, self.origin_taxonomy, self.tax_tree)
         
         tax_code_name = self.refjson.get_taxcode()
@@ -219,25 +237,37 @@ class LeaveOneTest:
         return output
 
     def mis_rec_to_string(self, mis_rec):
-        lvl = mis_rec['orig_level']
-        uncorr_name = EpacConfig.strip_ref_prefix(self.refjson.get_uncorr_seqid(mis_rec['name']))
-        uncorr_orig_ranks = self.refjson.get_uncorr_ranks(mis_rec['orig_ranks'])
-        uncorr_ranks = self.refjson.get_uncorr_ranks(mis_rec['ranks'])
-        output = uncorr_name + "\t"
-      
-        if lvl >= 0:
-            output += "%s\t%s\t%s\t%.3f\t" % (mis_rec['level_name'], 
-                uncorr_orig_ranks[lvl], uncorr_ranks[lvl], mis_rec['lws'][lvl])
-        else:
-            output += "%s\t%s\t%s\t%.3f\t" % (mis_rec['level_name'], 
-                "NA", "NA", mis_rec['lws'][0])
-        
-        output += Taxonomy.lineage_str(uncorr_orig_ranks) + "\t"
-        output += Taxonomy.lineage_str(uncorr_ranks) + "\t"
-        output += ";".join(["%.3f" % conf for conf in mis_rec['lws']])
-        if 'rank_conf' in mis_rec:
-            output += "\t%.3f" % mis_rec['rank_conf']
-        return output
+        return self.mis_recs_to_strings([mis_rec])[0]
+
+    def mis_recs_to_strings(self, mis_recs):
+        """Format mislabel records as output lines; sequence IDs and lineages are translated
+        back to the original (uncorrected) names for all records at once"""
+        name_index = self.refjson.get_name_index()
+        uncorr_names = name_index.get_uncorr_seqids([mis_rec['name'] for mis_rec in mis_recs])
+        uncorr_orig_lineages = name_index.get_uncorr_lineages([mis_rec['orig_ranks'] for mis_rec in mis_recs])
+        uncorr_lineages = name_index.get_uncorr_lineages([mis_rec['ranks'] for mis_rec in mis_recs])
+
+        lines = []
+        for i, mis_rec in enumerate(mis_recs):
+            lvl = mis_rec['orig_level']
+            uncorr_orig_ranks = uncorr_orig_lineages[i]
+            uncorr_ranks = uncorr_lineages[i]
+            output = EpacConfig.strip_ref_prefix(uncorr_names[i]) + "\t"
+          
+            if lvl >= 0:
+                output += "%s\t%s\t%s\t%.3f\t" % (mis_rec['level_name'], 
+                    uncorr_orig_ranks[lvl], uncorr_ranks[lvl], mis_rec['lws'][lvl])
+            else:
+                output += "%s\t%s\t%s\t%.3f\t" % (mis_rec['level_name'], 
+                    "NA", "NA", mis_rec['lws'][0])
+            
+            output += Taxonomy.lineage_str(uncorr_orig_ranks) + "\t"
+            output += Taxonomy.lineage_str(uncorr_ranks) + "\t"
+            output += ";".join(["%.3f" % conf for conf in mis_rec['lws']])
+            if 'rank_conf' in mis_rec:
+                output += "\t%.3f" % mis_rec['rank_conf']
+            lines.append(output)
+        return lines
 
     def sort_mislabels(self):
         self.mislabels = sorted(self.mislabels, key=itemgetter('inv_level', 'conf', 'name'), reverse=True)
@@ -300,12 +330,52 @@ class LeaveOneTest:
             fields = ["RankID", "MislabeledLevel", "OriginalLabel", "ProposedLabel", "Confidence", "OriginalTaxonomyPath", 
                       "ProposedTaxonomyPath", "PerRankConfidence"]
             self.write_mislabels_header(fo_all, final, fields)
-            for mis_rec in self.rank_mislabels:
-                output = self.mis_rec_to_string(mis_rec) + "\n"
+            for line in self.mis_recs_to_strings(self.rank_mislabels):
+                output = line + "\n"
                 fo_all.write(output)
                 if self.cfg.verbose:
                     print(output) 
 
+    def get_mislabels_fields(self):
+        fields = ["SeqID", "MislabeledLevel", "OriginalLabel", "ProposedLabel", "Confidence", "OriginalTaxonomyPath", 
+                  "ProposedTaxonomyPath", "PerRankConfidence"]
+        if self.cfg.ranktest:
+            fields += ["HigherRankMisplacedConfidence"]
+        return fields
+
+    def write_mislabels_sweep(self):
+        """Apply each of confidence cut-offs from -sweep list to the (unfiltered) mislabels
+        and write results to a separate file per cut-off, plus summary table with mislabel 
+        counts by rank"""
+        if not self.cfg.conf_sweep:
+            return
+            
+        fields = self.get_mislabels_fields()
+        summary = []
+        for cutoff in self.cfg.conf_sweep:
+            mislabels = [mis_rec for mis_rec in self.mislabels if mis_rec['conf'] >= cutoff]
+            mislabels = sorted(mislabels, key=itemgetter('inv_level', 'conf', 'name'), reverse=True)
+            out_fname = self.cfg.out_fname("%NAME%" + ".C%g.mis" % cutoff)
+            with open(out_fname, "w") as fo:
+                self.write_mislabels_header(fo, False, fields)
+                for line in self.mis_recs_to_strings(mislabels):
+                    fo.write(line + "\n")
+
+            level_cnt = [0] * TaxCode.UNI_TAX_LEVELS
+            for mis_rec in mislabels:
+                level_cnt[mis_rec["real_level"]] += 1
+            summary.append((cutoff, len(mislabels), level_cnt))
+
+        level_names = ["[NotIngroup]"] + [self.tax_code.rank_level_name(i)[0] for i in range(1, TaxCode.UNI_TAX_LEVELS)]
+        with open(self.sweep_fname, "w") as fo:
+            fo.write("\t".join(["Cutoff", "Total"] + level_names) + "\n")
+            for cutoff, total, level_cnt in summary:
+                fo.write("\t".join(["%g" % cutoff, str(total)] + [str(c) for c in level_cnt]) + "\n")
+
+        self.cfg.log.info("Mislabels for %d confidence cut-offs were saved to: %s", len(self.cfg.conf_sweep), 
+            os.path.abspath(self.cfg.out_fname("%NAME%.C<Cutoff>.mis")))
+        self.cfg.log.info("Cut-off sweep summary was saved to: %s\n", os.path.abspath(self.sweep_fname))
+
     def write_mislabels(self, final=True):
         if final:
             out_fname = self.mis_fname
@@ -313,13 +383,10 @@ class LeaveOneTest:
             out_fname = self.premis_fname
         
         with open(out_fname, "w") as fo_all:
-            fields = ["SeqID", "MislabeledLevel", "OriginalLabel", "ProposedLabel", "Confidence", "OriginalTaxonomyPath", 
-                      "ProposedTaxonomyPath", "PerRankConfidence"]
-            if self.cfg.ranktest:
-                fields += ["HigherRankMisplacedConfidence"]
+            fields = self.get_mislabels_fields()
             self.write_mislabels_header(fo_all, final, fields)
-            for mis_rec in self.mislabels:
-                output = self.mis_rec_to_string(mis_rec)  + "\n"
+            for line in self.mis_recs_to_strings(self.mislabels):
+                output = line + "\n"
                 fo_all.write(output)
                 if self.cfg.verbose and final:
                     print(output) 
@@ -356,6 +423,34 @@ class LeaveOneTest:
             
         return rank_parent, rank_tips
 
+    @staticmethod
+    def get_shard_sort_key(fname):
+        """Sort key for placement files: shards are ordered by their number (shard2 before shard10)"""
+        dirname, basename = os.path.split(fname)
+        m = re.search(r"\.shard(\d+)\.", basename)
+        if m:
+            return (dirname, basename[:m.start()] + basename[m.end()-1:], int(m.group(1)))
+        else:
+            return (dirname, basename, 0)
+
+    def load_placements(self, jplace_fname):
+        """Returns placement parsers for a .jplace file or placement store, or for all such files in a directory"""
+        if os.path.isdir(jplace_fname):
+            fnames = glob.glob(os.path.join(jplace_fname, '*.jplace')) + \
+                     glob.glob(os.path.join(jplace_fname, '*' + PlacementStore.SUFFIX))
+        else:
+            fnames = glob.glob(jplace_fname)
+        # sort to get the same placement order in every run (e.g. for shards of the leave-one-out test)
+        fnames.sort(key=LeaveOneTest.get_shard_sort_key)
+        config.log.debug("Loading placements from %d file(s): %s\n", len(fnames), jplace_fname)
+        return [PlacementStore.open(fname) for fname in fnames]
+
+    def write_placement_store(self, store, jp_list, fname_mask):
+        if store != None:
+            out_fname = self.cfg.out_fname(fname_mask)
+            store.write(out_fname, jp_list[0] if jp_list else None)
+            config.log.debug("EPA placements were saved to: %s\n", out_fname)
+
     def run_leave_subtree_out_test(self):
         job_name = self.cfg.subst_name("l1out_rank_%NAME%")
 #        if self.jplace_fname:
@@ -398,39 +493,79 @@ class LeaveOneTest:
 
         return subtree_count    
         
+    def get_l1o_tip_ranges(self):
+        """Splits reference sequences (RAxML tips 1..N, in alignment order) into contiguous ranges,
+           one for each shard of the leave-one-out test"""
+        shard_count = max(1, min(self.cfg.l1o_shards, self.reftree_size))
+        chunk_size, rest = divmod(self.reftree_size, shard_count)
+        tip_ranges = []
+        first = 1
+        for i in range(shard_count):
+            last = first + chunk_size - 1 + (1 if i < rest else 0)
+            tip_ranges.append((first, last))
+            first = last + 1
+        return tip_ranges
+
+    def run_leave_seq_out_shard(self):
+        """Runs leave-one-out test for a single shard (-l1o-shard) and returns the name of the resulting 
+           .jplace file. Placements of all shards are classified by a separate run (-j)."""
+        self.prepare_ref_files()
+        shard = self.cfg.l1o_shard
+        tip_range = self.get_l1o_tip_ranges()[shard-1]
+        job_name = self.cfg.subst_name("l1out_seq_%NAME%") + ".shard%d" % shard
+        config.log.info("Running the leave-one-sequence-out test for shard %d/%d (sequences %d-%d)...\n", 
+                        shard, self.cfg.l1o_shards, tip_range[0], tip_range[1])
+        self.raxml.run_epa(job_name, self.refalign_fname, self.reftree_fname, self.optmod_fname, mode="l1o_seq", 
+                           stream=True, tip_range=tip_range)
+        out_jplace_fname = self.cfg.out_fname("%NAME%.l1out_seq.shard" + str(shard) + ".jplace")
+        self.raxml.copy_epa_jplace(job_name, out_jplace_fname, move=True, mode="l1o_seq")
+        return out_jplace_fname
+
+    def run_leave_seq_out_epa(self, job_name):
+        tip_ranges = self.get_l1o_tip_ranges()
+        out_jplace_fname = self.cfg.out_fname("%NAME%.l1out_seq.jplace")
+        if len(tip_ranges) == 1:
+            jp = self.raxml.run_epa(job_name, self.refalign_fname, self.reftree_fname, self.optmod_fname, mode="l1o_seq", stream=True)
+            if self.cfg.output_interim_files:
+                self.raxml.copy_epa_jplace(job_name, out_jplace_fname, move=True, mode="l1o_seq")
+                jp = EpaJsonStreamParser(out_jplace_fname)
+            return [jp]
+
+        # shards are independent RAxML jobs, which share the threads
+        shard_count = len(tip_ranges)
+        shard_threads = self.raxml.get_split_threads(shard_count)
+        config.log.debug("Leave-one-out test: running %d shards with %d thread(s) each\n", shard_count, shard_threads)
+        job_names = ["%s.shard%d" % (job_name, i+1) for i in range(shard_count)]
+        jp_fnames = self.raxml.run_epa_concurrent(job_names, [self.refalign_fname] * shard_count, self.reftree_fname, 
+                        self.optmod_fname, shard_threads, mode="l1o_seq", tip_ranges=tip_ranges)
+        if self.cfg.output_interim_files:
+            return [EpaJsonMerger.merge(jp_fnames, out_jplace_fname)]
+        else:
+            return [EpaJsonStreamParser(fname) for fname in jp_fnames]
+
     def run_leave_seq_out_test(self):
         job_name = self.cfg.subst_name("l1out_seq_%NAME%")
-        placements = []
         if self.cfg.jplace_fname:
-            if os.path.isdir(self.cfg.jplace_fname):
-                jplace_fmask = os.path.join(self.cfg.jplace_fname, '*.jplace')
-            else:
-                jplace_fmask = self.cfg.jplace_fname
-
-            jplace_fname_list = glob.glob(jplace_fmask)
-            for jplace_fname in jplace_fname_list:
-                jp = EpaJsonParser(jplace_fname)
-                placements += jp.get_placement()
-                
-            config.log.debug("Loaded %d placements from %s\n", len(placements), jplace_fmask)
+            jp_list = self.load_placements(self.cfg.jplace_fname)
         else:        
-            jp = self.raxml.run_epa(job_name, self.refalign_fname, self.reftree_fname, self.optmod_fname, mode="l1o_seq")
-            placements = jp.get_placement()
-            if self.cfg.output_interim_files:
-                out_jplace_fname = self.cfg.out_fname("%NAME%.l1out_seq.jplace")
-                self.raxml.copy_epa_jplace(job_name, out_jplace_fname, move=True, mode="l1o_seq")
+            jp_list = self.run_leave_seq_out_epa(job_name)
         
+        # placements are read and classified one by one, so that we never keep all of them in memory
+        placements = itertools.chain.from_iterable(jp.iter_placements() for jp in jp_list)
+        store = PlacementStoreWriter() if self.cfg.save_placements else None
+        if store != None:
+            placements = store.tee(placements)
+        assignments = self.classify_helper.iter_classify(placements, num_procs=self.cfg.num_threads)
+
         seq_count = 0
         l1out_ass = {}
-        for place in placements:
+        for place, ranks, lws in assignments:
             seq_name = place["n"][0]
             
             # get original taxonomic label
 #            orig_ranks = self.get_orig_ranks(seq_name)
             orig_ranks =  self.taxtree_helper.get_seq_ranks_from_tree(seq_name)
 
-            # get EPA tax label
-            ranks, lws = self.classify_seq(place)
             l1out_ass[seq_name] = (ranks, lws)
             
             # check if they match
@@ -445,6 +580,10 @@ class LeaveOneTest:
                 mis_rec['rank_conf'] = rank_conf
             seq_count += 1
 
+        config.log.debug("Processed %d leave-one-out placements\n", seq_count)
+
+        self.write_placement_store(store, jp_list, "%NAME%.l1out_seq" + PlacementStore.SUFFIX)
+
         self.write_assignments(l1out_ass, final=False)
             
         return seq_count    
@@ -483,24 +622,19 @@ class LeaveOneTest:
          
         reftree_epalbl_str = None    
         if self.cfg.final_jplace_fname:
-            if os.path.isdir(self.cfg.final_jplace_fname):
-                jplace_fmask = os.path.join(self.cfg.final_jplace_fname, '*.jplace')
-            else:
-                jplace_fmask = self.cfg.final_jplace_fname
-
-            jplace_fname_list = glob.glob(jplace_fmask)
-            placements = []
-            for jplace_fname in jplace_fname_list:
-                jp = EpaJsonParser(jplace_fname)
-                placements += jp.get_placement()
+            jp_list = self.load_placements(self.cfg.final_jplace_fname)
+            for jp in jp_list:
                 if not reftree_epalbl_str:
                   reftree_epalbl_str = jp.get_std_newick_tree()        
-                
-            config.log.debug("Loaded %d final epa placements from %s\n", len(placements), jplace_fmask)
         else:
             epa_result = self.run_epa_once(pruned_reftree)
             reftree_epalbl_str = epa_result.get_std_newick_tree()        
-            placements = epa_result.get_placement()
+            jp_list = [epa_result]
+
+        placements = itertools.chain.from_iterable(jp.iter_placements() for jp in jp_list)
+        store = PlacementStoreWriter() if self.cfg.save_placements else None
+        if store != None:
+            placements = store.tee(placements)
         
         # update branchid-taxonomy mapping to account for possible changes in branch numbering
         reftree_tax = Tree(reftree_epalbl_str)
@@ -514,8 +648,10 @@ class LeaveOneTest:
 #        newtax_fname = self.cfg.subst_name("newtax_%NAME%.tre")
 #        th.get_tax_tree().write(outfile=newtax_fname, format=3)
 
+        assignments = cl.iter_classify(placements, num_procs=self.cfg.num_threads)
+
         final_ass = {}
-        for place in placements:
+        for place, ranks, lws in assignments:
             seq_name = place["n"][0]
 
             # get original taxonomic label
@@ -531,8 +667,6 @@ class LeaveOneTest:
 #            orig_ranks = th.strip_missing_ranks(orig_ranks)
 #            print orig_ranks
 
-            # get EPA tax label
-            ranks, lws = cl.classify_seq(place["p"])
             final_ass[seq_name] = (ranks, lws)
 
             #print seq_name, ": ", orig_ranks, "--->", ranks
@@ -540,6 +674,7 @@ class LeaveOneTest:
             # check if they match
             mis_rec = self.check_seq_tax_labels(seq_name, orig_ranks, ranks, lws)
 
+        self.write_placement_store(store, jp_list, "%NAME%.final_epa" + PlacementStore.SUFFIX)
         self.write_assignments(final_ass, final=True)
 
     def run_epa_once(self, reftree):
@@ -550,22 +685,31 @@ class LeaveOneTest:
 
         # IMPORTANT: don't load the model, since it's invalid for the pruned true !!! 
         optmod_fname=""
-        epa_result = self.raxml.run_epa(job_name, self.refalign_fname, reftree_fname, optmod_fname)
+        epa_result = self.raxml.run_epa(job_name, self.refalign_fname, reftree_fname, optmod_fname, stream=True)
 
         if self.cfg.output_interim_files:
             out_jplace_fname = self.cfg.out_fname("%NAME%.final_epa.jplace")
             self.raxml.copy_epa_jplace(job_name, out_jplace_fname, move=True)
+            epa_result = EpaJsonStreamParser(out_jplace_fname)
 
         return epa_result
 
-    def run_test(self):
+    def prepare_ref_files(self):
         self.raxml = RaxmlWrapper(self.cfg)
 
+        if self.ref_cache:
+            self.reftree_fname = self.ref_cache.get_reftree()
+            self.refalign_fname = self.ref_cache.get_alignment()
+            self.optmod_fname = self.ref_cache.get_binary_model()
+        else:
+            self.refjson.get_raxml_readable_tree(self.reftree_fname)
+            self.refalign_fname = self.refjson.get_alignment(self.tmp_refaln)        
+            self.refjson.get_binary_model(self.optmod_fname)
+
+    def run_test(self):
 #        config.log.info("Number of sequences in the reference: %d\n", self.reftree_size)
 
-        self.refjson.get_raxml_readable_tree(self.reftree_fname)
-        self.refalign_fname = self.refjson.get_alignment(self.tmp_refaln)        
-        self.refjson.get_binary_model(self.optmod_fname)
+        self.prepare_ref_files()
         
         if self.cfg.ranktest:
             config.log.info("Running the leave-one-rank-out test...\n")
@@ -580,6 +724,7 @@ class LeaveOneTest:
                 self.write_mislabels(final=False)
             self.run_final_epa_test()
 
+        self.write_mislabels_sweep()
         self.filter_mislabels()
         self.sort_mislabels()
         self.write_mislabels()
@@ -605,6 +750,10 @@ def parse_args():
             help="""Specify the number of CPUs (default: %d)""" % multiprocessing.cpu_count())
     parser.add_argument("-N", dest="rep_num", type=int, default=1, 
             help="""Number of RAxML tree searches (with distinct random seeds) to resolve multifurcation. Default: 1""")
+    parser.add_argument("-Np", dest="rep_parallel", type=int, default=1, 
+            help="""Number of RAxML tree searches (-N) to run concurrently as separate processes; threads (-T)
+            are split evenly between them, but every process gets at least 2 threads (so at most T/2 searches
+            run at a time). Default: 1 (all searches are performed by a single RAxML process)""")
     parser.add_argument("-v", dest="verbose", action="store_true",
             help="""Print additional info messages to the console.""")
     parser.add_argument("-R", dest="restart", action="store_true",
@@ -615,15 +764,30 @@ Run name of the previous (terminated) job must be specified via -n option.""")
     parser.add_argument("-r", dest="ref_fname",
             help="""Specify the reference alignment and taxonomy in refjson format.""")
     parser.add_argument("-j", dest="jplace_fname", default=None,
-            help="""Do not call RAxML to perform EPA leave-one-out test, use existing .jplace file as input instead. 
-            This could be also a directory with *.jplace files.""")
+            help="""Do not call RAxML to perform EPA leave-one-out test, use existing .jplace file (or placement store, 
+            s. -save-placements) as input instead. This could be also a directory with *.jplace / *.plstore files.""")
     parser.add_argument("-J", dest="final_jplace_fname", default=None,
-            help="""Do not call RAxML to perform final EPA classification, use existing .jplace file as input instead. 
-            This could be also a directory with *.jplace files.""")
+            help="""Do not call RAxML to perform final EPA classification, use existing .jplace file (or placement store,
+            s. -save-placements) as input instead. This could be also a directory with *.jplace / *.plstore files.""")
+    parser.add_argument("-save-placements", dest="save_placements", action="store_true",
+            help="""Save leave-one-out and final EPA placements to compact binary placement stores 
+            (NAME.l1out_seq.plstore, NAME.final_epa.plstore), which can be re-analyzed faster than .jplace with -j / -J.""")
+    parser.add_argument("-l1o-shards", dest="l1o_shards", type=int, default=1,
+            help="""Split the leave-one-out test into this many shards (by reference sequences), which are 
+            run as independent RAxML jobs. Default: 1""")
+    parser.add_argument("-l1o-shard", dest="l1o_shard", type=int, default=None,
+            help="""Run the leave-one-out test only for the given shard (1..L1O_SHARDS, s. -l1o-shards) and save 
+            the placements to NAME.l1out_seq.shard<N>.jplace. This allows to distribute the test among multiple 
+            hosts: once all shards are finished, put their .jplace files into a directory and pass it via -j. 
+            Requires -r.""")
     parser.add_argument("-p", dest="rand_seed", type=int, default=12345,
             help="""Random seed to be used with RAxML. Default: 12345""")
     parser.add_argument("-C", dest="conf_cutoff", type=float, default=0.,
             help="""Confidence cut-off between 0 and 1. Default: 0\n""")
+    parser.add_argument("-sweep", dest="conf_sweep", type=EpacConfig.parse_thresholds, default=None,
+            help="""Comma-separated list of confidence cut-offs (e.g. 0.1,0.5,0.9): mislabels for each of them 
+            are written to a separate file (NAME.C<cut-off>.mis), plus a summary table (NAME.sweep.txt).
+            The search itself is performed only once.\n""")
     parser.add_argument("-P", dest="brlen_pv", type=float, default=0.,
             help="""P-value for branch length Erlang test. Default: 0=off\n""")
     parser.add_argument("-l", dest="min_lhw", type=float, default=0.,
@@ -647,6 +811,9 @@ Run name of the previous (terminated) job must be specified via -n option.""")
             help="""Test for misplaced higher ranks.""")
     parser.add_argument("-tmpdir", dest="temp_dir", default=None,
             help="""Directory for temporary files.""")
+    parser.add_argument("-refcache", dest="ref_cache_dir", default=None,
+            help="""Directory for caching files extracted from the reference (tree, model, alignment),
+            which can be shared by concurrent jobs. Only used with -r. Default: off""")
 
     args = parser.parse_args()
     if len(sys.argv) == 1: 
@@ -691,6 +858,18 @@ def check_args(args, parser):
         print("EPA placement file does not exists: %s" % args.jplace_fname)
         sys.exit()
 
+    if args.l1o_shards < 1:
+        print("ERROR: Number of leave-one-out shards must be positive: %d" % args.l1o_shards)
+        sys.exit()
+
+    if args.l1o_shard != None:
+        if not args.ref_fname:
+            print("ERROR: -l1o-shard requires a reference in JSON format (-r), so that all shards use the same tree!")
+            sys.exit()
+        if args.l1o_shard < 1 or args.l1o_shard > args.l1o_shards:
+            print("ERROR: Leave-one-out shard number must be between 1 and %d: %d" % (args.l1o_shards, args.l1o_shard))
+            sys.exit()
+
     if args.synonym_fname and not os.path.isfile(args.synonym_fname):
         print("Synonym list file file does not exists: %s" % args.synonym_fname)
         sys.exit()
@@ -745,6 +924,8 @@ def print_run_info(config):
 if __name__ == "__main__":
     args = parse_args()
     config = SativaConfig(args)
+    # terminate RAxML & co. if we are killed (e.g. job time limit on a cluster)
+    config.get_scheduler().install_signal_handler()
     
     start_time = time.time()
     trainer_time = 0
@@ -764,13 +945,17 @@ if __name__ == "__main__":
     
     l1out_start_time = time.time()
     
-    t.run_test()
+    if config.l1o_shard:
+        out_fname = t.run_leave_seq_out_shard()
+    else:
+        t.run_test()
+        out_fname = t.mis_fname
     
     config.clean_tempdir()
         
     l1out_time = time.time() - l1out_start_time
 
-    config.log.info("\nResults were saved to: %s", os.path.abspath(t.mis_fname))
+    config.log.info("\nResults were saved to: %s", os.path.abspath(out_fname))
     config.log.info("Execution log was saved to: %s\n", os.path.abspath(config.log_fname))
 
     elapsed_time = time.time() - start_time
@@ -0,0 +1,86 @@
+#! /usr/bin/env python
+"""Compare load times of plain and compressed reference/jplace files.
+
+usage: python tests/bench_compression.py [num_sequences] [num_placements]
+"""
+import os
+import sys
+import time
+import json
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from epac.json_util import RefJsonParser, RefJsonBuilder, EpaJsonParser, EpaJsonStreamParser
+from epac.compress_util import CompressedIO, lzma
+
+def make_refjson(testfile_dir, out_fname, num_seqs):
+    parser = RefJsonParser(os.path.join(testfile_dir, "test.refjson.v1.6"))
+    jw = RefJsonBuilder(old_json=parser)
+    seq = parser.get_alignment_list()[0][1]
+    jw.set_sequences([["seq%d" % i, seq] for i in range(num_seqs)])
+    jw.dump(out_fname)
+
+def make_jplace(testfile_dir, out_fname, num_places):
+    with open(os.path.join(testfile_dir, "test.jplace")) as fin:
+        jdata = json.load(fin)
+    pl = jdata["placements"]
+    jdata["placements"] = [{"p": pl[i % len(pl)]["p"], "n": ["query%d" % i]} for i in range(num_places)]
+    with open(out_fname, "w") as fout:
+        json.dump(jdata, fout, indent=4)
+
+def compress(fname, ext):
+    out_fname = fname + ext
+    start = time.time()
+    CompressedIO.copy(fname, out_fname)
+    return out_fname, time.time() - start
+
+def time_load(load_func, fname, repeats=3):
+    best = None
+    for i in range(repeats):
+        start = time.time()
+        load_func(fname)
+        elapsed = time.time() - start
+        best = min(best, elapsed) if best else elapsed
+    return best
+
+def load_refjson(fname):
+    parser = RefJsonParser(fname)
+    parser.validate()
+    parser.get_branch_tax_map()
+    parser.get_alignment_list()
+
+def load_jplace(fname):
+    EpaJsonParser(fname).get_placement()
+
+def stream_jplace(fname):
+    for place in EpaJsonStreamParser(fname).iter_placements():
+        pass
+
+if __name__ == "__main__":
+    num_seqs = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    num_places = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    testfile_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "testfiles")
+    exts = [".gz", ".bz2"] + ([".xz"] if lzma else [])
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        ref_fname = os.path.join(tmp_dir, "bench.refjson")
+        jplace_fname = os.path.join(tmp_dir, "bench.jplace")
+        make_refjson(testfile_dir, ref_fname, num_seqs)
+        make_jplace(testfile_dir, jplace_fname, num_places)
+
+        print("%-24s %6s %12s %10s %10s" % ("test", "format", "size (KB)", "compress", "load (s)"))
+        for fname, tests in [(ref_fname, [("refjson", load_refjson)]),
+                             (jplace_fname, [("jplace", load_jplace), ("jplace (stream)", stream_jplace)])]:
+            files = [(fname, "plain", 0.)]
+            for ext in exts:
+                cfname, ctime = compress(fname, ext)
+                files.append((cfname, ext.strip("."), ctime))
+            for test_name, load_func in tests:
+                for cfname, fmt, ctime in files:
+                    size = os.path.getsize(cfname) / 1024
+                    print("%-24s %6s %12d %10.2f %10.3f" % (test_name, fmt, size, ctime, time_load(load_func, cfname)))
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -2,6 +2,9 @@
 import os
 import sys
 import unittest
+import tempfile
+import shutil
+from argparse import Namespace
 
 lib_path = os.path.abspath('..')
 sys.path.append(lib_path)
@@ -11,6 +14,8 @@ from epac.config import EpacConfig, EpacClassifierConfig
 from epac.ete2 import Tree
 from epac.classify_util import TaxTreeHelper, TaxClassifyHelper
 from epac.json_util import EpaJsonParser
+from epac.erlang import erlang
+from epa_classifier import EpaClassifier
 
 class TaxTreeHelperTests(unittest.TestCase):
 
@@ -90,6 +95,181 @@ class TaxClassifyHelperTests(unittest.TestCase):
 #            for e in edges: print self.bid_tax_map[str(e[0])], e[2]
 #            print sid, "\t", ";".join(ranks) #, conf
             self.assertEqual(ranks, expected_assign_map[sid])
+
+    def test_classify_many(self):
+        jplace_fname = os.path.join(self.testfile_dir, "test.jplace")
+        parser = EpaJsonParser(jplace_fname)
+        placements = parser.get_placement()
+        # explicit thresholds (incl. 0) override the config value
+        self.classify_helper.cfg.min_lhw = 0.9
+        for minlw in [0., 0.3, 0.5, 0.9]:
+            results = self.classify_helper.classify_many(placements, minlw)
+            self.assertEqual(len(results), len(placements))
+            for p, (ranks, conf) in zip(placements, results):
+                e_ranks, e_conf = self.classify_helper.assign_taxonomy_maxsum(p["p"], minlw)
+                self.assertEqual(ranks, e_ranks)
+                self.assertEqual(conf, e_conf)
+        self.assertEqual(self.classify_helper.classify_many(placements), self.classify_helper.classify_many(placements, 0.9))
+        self.assertNotEqual(self.classify_helper.classify_many(placements), self.classify_helper.classify_many(placements, 0.))
+
+    def test_classify_multi(self):
+        jplace_fname = os.path.join(self.testfile_dir, "test.jplace")
+        parser = EpaJsonParser(jplace_fname)
+        placements = parser.get_placement()
+        thresholds = [0., 0.3, 0.5, 0.9]
+        results = list(self.classify_helper.iter_classify_multi(placements, thresholds))
+        self.assertEqual(len(results), len(placements))
+        for p, res in results:
+            self.assertEqual(len(res), len(thresholds))
+            for minlw, (ranks, conf) in zip(thresholds, res):
+                e_ranks, e_conf = self.classify_helper.assign_taxonomy_maxsum(p["p"], minlw)
+                self.assertEqual(ranks, e_ranks)
+                self.assertEqual(conf, e_conf)
+
+    def test_iter_classify_mp(self):
+        jplace_fname = os.path.join(self.testfile_dir, "test.jplace")
+        parser = EpaJsonParser(jplace_fname)
+        placements = parser.get_placement()
+        expected = self.classify_helper.classify_many(placements)
+        results = list(self.classify_helper.iter_classify(iter(placements), num_procs=2, chunk_size=2))
+        self.assertEqual([p for p, ranks, lws in results], placements)
+        self.assertEqual([(ranks, lws) for p, ranks, lws in results], expected)
+
+    def test_assign_taxonomy_maxlh(self):
+        bid_tax_map = {"0": ("B@@Bf@@-", 0, 0.1), "1": ("B@@Bf@@Bs1", 0, 0.1), "2": ("B@@Bf@@Bs2", 0, 0.1), 
+                       "3": ("A@@Af@@As", 0, 0.1)}
+        cl = TaxClassifyHelper(EpacClassifierConfig(), bid_tax_map)
+        edges = [[0, -10., 0.4, 0., 0.], [3, -11., 0.3, 0., 0.], [2, -12., 0.2, 0., 0.], [1, -13., 0.1, 0., 0.]]
+        ranks, lws = cl.assign_taxonomy_maxlh(edges)
+        # undefined ML rank is taken from the last alternative placement with the same parent rank
+        self.assertEqual(ranks, ["B", "Bf", "Bs1"])
+        self.assertEqual(lws, [0.4 + 0.2 + 0.1, 0.4 + 0.2 + 0.1, 0.1])
+
+    def test_maxsum_early_exit(self):
+        bids = sorted(self.bid_tax_map.keys())
+        edges = [[int(bids[0]), -10., 0.9, 0., 0.]] + [[int(bid), -20., 0.01, 0., 0.] for bid in bids[1:11]]
+        for minlw in [0., 0.5, 0.95]:
+            e_ranks, e_conf = self.classify_helper.assign_taxonomy_maxsum(edges, minlw)
+            ranks, conf = self.classify_helper.assign_taxonomy_maxsum_fast(edges, minlw)
+            self.assertEqual(ranks, e_ranks)
+            self.assertEqual(conf, e_conf)
+        self.assertTrue(self.classify_helper.skipped_edges > 0)
+
+    def test_classify_cache(self):
+        jplace_fname = os.path.join(self.testfile_dir, "test.jplace")
+        parser = EpaJsonParser(jplace_fname)
+        placements = parser.get_placement()
+        expected = [self.classify_helper.classify_edges(p["p"], 0.) for p in placements] 
+        # cache is off by default
+        self.assertEqual(self.classify_helper.cache_size, 0)
+        self.classify_helper.cache_size = 100000
+        for i in range(3):
+            results = self.classify_helper.classify_many(placements)
+            self.assertEqual(results, expected)
+        self.assertEqual(self.classify_helper.cache_misses, len(placements))
+        self.assertEqual(self.classify_helper.cache_hits, 2 * len(placements))
+
+        # LRU eviction
+        self.classify_helper.cache_size = 2
+        self.classify_helper.cache.clear()
+        self.classify_helper.classify_many(placements)
+        self.assertEqual(len(self.classify_helper.cache), 2)
+        self.assertEqual(self.classify_helper.classify_many(placements), expected)
+
+        # cache is keyed on exact likelihood weights
+        self.classify_helper.cache.clear()
+        edges = [[int(bid), -10., 0.5, 0., 0.] for bid in sorted(self.bid_tax_map.keys())[:2]]
+        close_edges = [[edges[0][0], -10., 0.5 + 1e-9, 0., 0.], [edges[1][0], -10., 0.5 - 1e-9, 0., 0.]]
+        self.classify_helper.classify_seq(edges)
+        self.classify_helper.classify_seq(close_edges)
+        self.assertEqual(len(self.classify_helper.cache), 2)
+
+    def test_erlang_filter_copy(self):
+        jplace_fname = os.path.join(self.testfile_dir, "test.jplace")
+        placements = EpaJsonParser(jplace_fname).get_placement()
+        node_height = dict((bid, 1) for bid in self.bid_tax_map.iterkeys())
+        cfg = EpacClassifierConfig()
+        cfg.brlen_pv = 0.02
+        cl = TaxClassifyHelper(cfg, self.bid_tax_map, 10., node_height)
+        cl.cache_size = 100
+        for i in range(2):
+            for p in placements:
+                orig_edges = [list(edge) for edge in p["p"]]
+                cl.classify_seq(p["p"])
+                # likelihood weights are adjusted on a copy of the edges, both with and without cache hit
+                self.assertEqual(p["p"], orig_edges)
+        self.assertEqual(cl.cache_hits, len(placements))
+
+    def test_erlang_many(self):
+        el = erlang()
+        ks = [0, 1, 5, 3, 12, 5, 1, 30]
+        xs = [0.1, 0.221977, 0.05, 0.05, 0.7, 0.05, 0.0, 1.5]
+        for rate in [17., 3.5]:
+            # run twice to make sure cached values are correct as well 
+            for i in range(2):
+                pvs = el.one_tail_test_many(rate, ks, xs)
+                self.assertEqual(len(pvs), len(ks))
+                for k, x, pv in zip(ks, xs, pvs):
+                    self.assertEqual(pv, el.one_tail_test(rate, k, x))
                 
+class EpaClassifierTests(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = os.path.dirname(os.path.abspath(__file__))
+        self.testfile_dir = os.path.join(self.test_dir, "testfiles")
+        ns = Namespace()
+        ns.verbose = False
+        ns.debug = False
+        ns.restart = False
+        ns.ref_fname = os.path.join(self.testfile_dir, "test.refjson.v1.6")
+        ns.rand_seed = None
+        ns.output_name = "test_novelty"
+        ns.output_dir = self.testfile_dir
+        self.tmp_dir = tempfile.mkdtemp()
+        ns.temp_dir = self.tmp_dir
+        ns.config_fname = None
+        ns.num_threads = None
+        ns.taxassign_method = None
+        ns.min_lhw = None
+        ns.brlen_pv = None
+        ns.min_lhw_sweep = None
+        ns.save_placements = None
+        ns.epa_shards = None
+        ns.epa_shard_threads = None
+        ns.ref_cache_dir = None
+        ns.jplace_fname = None
+        ns.ignore_refalign = True
+        self.cfg = EpacClassifierConfig(ns)
+        self.classifier = EpaClassifier(self.cfg, ns)
+
+    def tearDown(self):
+        os.remove(self.cfg.log_fname)
+        shutil.rmtree(self.tmp_dir)
+
+    def novelty_check_per_branch(self, place_edge, lowrank):
+        """novelty check as it was done before build_novelty_index(): walk all leaves below the placement node"""
+        placenode = self.classifier.reftree.search_nodes(B=place_edge)[0]
+        if placenode.is_leaf():
+            return False
+        for leaf in placenode.get_leaves():
+            branks = Taxonomy.split_rank_uid(self.classifier.bid_taxonomy_map[leaf.B][0])
+            if lowrank >= len(branks) or branks[lowrank] == Taxonomy.EMPTY_RANK:
+                return False
+        return True
+
+    def test_novelty_check(self):
+        rank_count = 7
+        lws = [1.] * rank_count
+        novel_count = 0
+        for bid in self.classifier.bid_taxonomy_map.iterkeys():
+            for lowrank in range(rank_count):
+                ranks = ["r%d" % i for i in range(lowrank)] + [Taxonomy.EMPTY_RANK] * (rank_count - lowrank)
+                isnovo = self.classifier.novelty_check(place_edge=bid, ranks=ranks, lws=lws)
+                self.assertEqual(isnovo, self.novelty_check_per_branch(bid, lowrank))
+                if isnovo:
+                    novel_count += 1
+        self.assertTrue(novel_count > 0)
+        self.assertEqual(len(self.classifier.bid_node_map), len(self.classifier.bid_taxonomy_map))
+
 if __name__ == '__main__':
     unittest.main()
@@ -43,6 +43,7 @@ class ConfigTests(unittest.TestCase):
         ns.mfresolv_method = None
         ns.taxcode_name = None
         ns.rep_num = None
+        ns.rep_parallel = None
         ns.synonym_fname = None
         return ns
         
@@ -51,6 +52,11 @@ class ConfigTests(unittest.TestCase):
         ns.taxassign_method = None
         ns.min_lhw = None
         ns.brlen_pv = None
+        ns.min_lhw_sweep = None
+        ns.save_placements = None
+        ns.epa_shards = None
+        ns.epa_shard_threads = None
+        ns.ref_cache_dir = None
         return ns
 
     def get_sativa_namespace(self):
@@ -61,7 +67,12 @@ class ConfigTests(unittest.TestCase):
         ns.ranktest = None
         ns.jplace_fname = None
         ns.final_jplace_fname = None
+        ns.save_placements = None
+        ns.l1o_shards = None
+        ns.l1o_shard = None
         ns.conf_cutoff = None
+        ns.conf_sweep = None
+        ns.ref_cache_dir = None
         ns.save_memory = None
         return ns
 
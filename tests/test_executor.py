@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+import os
+import sys
+import unittest
+import tempfile
+import shutil
+import time
+import threading
+import subprocess
+
+lib_path = os.path.abspath('..')
+sys.path.append(lib_path)
+
+from epac.config import EpacConfig
+from epac.scheduler import Job
+from epac.executor import DirQueue, DirQueueExecutor, DirQueueWorker, SshExecutor, SlurmExecutor, SgeExecutor
+
+# ssh replacement, which runs the command in a new session (like sshd on a remote host, i.e. it is not
+# affected by signals sent to the client); with a pseudo-terminal (-tt), session is hung up once the
+# client is terminated
+SSH_STUB = """#!/bin/sh
+while [ "${1#-}" != "$1" ]; do
+    [ "$1" = "-tt" ] && tty=1
+    [ "$1" = "-o" ] && shift
+    shift
+done
+setsid sh -c "$2" &
+pid=$!
+trap '[ -n "$tty" ] && kill -HUP -$pid; exit 143' TERM HUP
+wait $pid
+"""
+
+class ExecutorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.queue_dir = os.path.join(self.tmp_dir, "queue")
+        self.cfg = EpacConfig()
+        self.poll_interval = DirQueue.POLL_INTERVAL
+        DirQueue.POLL_INTERVAL = 0.1
+
+    def tearDown(self):
+        DirQueue.POLL_INTERVAL = self.poll_interval
+        shutil.rmtree(self.tmp_dir)
+
+    @staticmethod
+    def is_running(pid):
+        try:
+            with open("/proc/%d/stat" % pid) as fin:
+                # zombie processes are not reaped in some containers
+                return fin.read().split(")")[-1].split()[0] != "Z"
+        except IOError:
+            return False
+
+    def start_worker(self, queue_dir, max_threads=2):
+        worker = DirQueueWorker(queue_dir, max_threads)
+        thread = threading.Thread(target=worker.run, kwargs={"exit_when_empty": True})
+        thread.start()
+        return thread
+
+    def test_dirqueue(self):
+        executor = DirQueueExecutor(self.cfg, self.queue_dir)
+        out_fnames = [os.path.join(self.tmp_dir, "echo%d.out" % i) for i in range(3)]
+        jobs = [executor.submit("echo%d" % i, ["echo", "hello %d" % i], 1, out_fname) for i, out_fname in enumerate(out_fnames)]
+        jobs.append(executor.submit("false", ["false"]))
+        missing = executor.submit("missing", [os.path.join(self.tmp_dir, "no_such_binary")])
+        self.assertEquals(len(os.listdir(os.path.join(self.queue_dir, DirQueue.PENDING))), 5)
+
+        # jobs are drained by two workers
+        threads = [self.start_worker(self.queue_dir), self.start_worker(self.queue_dir)]
+        executor.wait(jobs + [missing])
+        for thread in threads:
+            thread.join()
+
+        for i, out_fname in enumerate(out_fnames):
+            self.assertTrue(jobs[i].succeeded())
+            with open(out_fname) as fin:
+                self.assertEquals(fin.read(), "hello %d\n" % i)
+        self.assertEquals(jobs[3].state, Job.FINISHED)
+        self.assertEquals(jobs[3].returncode, 1)
+        self.assertEquals(missing.state, Job.FAILED)
+        self.assertTrue(isinstance(missing.error, OSError))
+        for state in DirQueue.STATES:
+            self.assertEquals(os.listdir(os.path.join(self.queue_dir, state)), [])
+
+    def test_dirqueue_cancel(self):
+        queue = DirQueue(self.queue_dir)
+        job_ids = [queue.put({"name": "job%d" % i}) for i in range(3)]
+        # jobs are claimed in the order of submission, and can be put back
+        job_id, data = queue.claim()
+        self.assertEquals(job_id, job_ids[0])
+        self.assertEquals(data["name"], "job0")
+        queue.release(job_id)
+        self.assertEquals(queue.claim()[0], job_ids[0])
+        queue.cancel(job_ids[1])
+        self.assertEquals(queue.claim()[0], job_ids[2])
+        self.assertEquals(queue.claim(), None)
+
+        executor = DirQueueExecutor(self.cfg, os.path.join(self.tmp_dir, "queue2"))
+        out_fname = os.path.join(self.tmp_dir, "cancelled.out")
+        cancelled = executor.submit("cancelled", ["touch", out_fname])
+        job = executor.submit("true", ["true"])
+        executor.cancel([cancelled])
+        self.assertEquals(cancelled.state, Job.CANCELLED)
+        self.start_worker(executor.queue.queue_dir).join()
+        executor.wait([job])
+        self.assertTrue(job.succeeded())
+        self.assertFalse(os.path.exists(out_fname))
+
+    def test_dirqueue_timeout(self):
+        # no worker at all
+        executor = DirQueueExecutor(self.cfg, self.queue_dir, queue_timeout=0.3)
+        job = executor.submit("unclaimed", ["true"])
+        executor.wait([job])
+        self.assertEquals(job.state, Job.TIMEOUT)
+        self.assertTrue(isinstance(job.error, OSError))
+        self.assertEquals(os.listdir(os.path.join(self.queue_dir, DirQueue.PENDING)), [])
+
+        # worker dies after claiming the job
+        executor = DirQueueExecutor(self.cfg, self.queue_dir, worker_timeout=0.5)
+        job = executor.submit("stale", ["true"])
+        job_id = executor.queue.claim()[0]
+        executor.wait([job])
+        self.assertEquals(job.state, Job.FAILED)
+        self.assertTrue(isinstance(job.error, OSError))
+        # worker would terminate the job if it came back
+        self.assertTrue(executor.queue.is_cancelled(job_id))
+
+        # live worker keeps its jobs alive
+        executor = DirQueueExecutor(self.cfg, self.queue_dir, queue_timeout=5, worker_timeout=0.5)
+        job = executor.submit("sleep", ["sleep", "1.5"])
+        thread = self.start_worker(self.queue_dir)
+        executor.wait([job])
+        thread.join()
+        self.assertTrue(job.succeeded())
+
+    def test_ssh(self):
+        stub_dir = os.path.join(self.tmp_dir, "bin")
+        os.mkdir(stub_dir)
+        with open(os.path.join(stub_dir, "ssh"), "w") as fout:
+            fout.write(SSH_STUB)
+        os.chmod(os.path.join(stub_dir, "ssh"), 0755)
+        path = os.environ["PATH"]
+        os.environ["PATH"] = stub_dir + os.pathsep + path
+        try:
+            executor = SshExecutor(self.cfg, ["node1:2", "node2:2"])
+            out_fname = os.path.join(self.tmp_dir, "echo.out")
+            job = executor.run("echo", ["echo", "hello world"], out_fname=out_fname)
+            self.assertTrue(job.succeeded())
+            with open(out_fname) as fin:
+                self.assertEquals(fin.read(), "hello world\n")
+
+            # remote process must not survive cancellation
+            pid_fname = os.path.join(self.tmp_dir, "remote.pid")
+            job = executor.submit("sleep", ["sh", "-c", "echo $$ > %s; exec sleep 30" % pid_fname])
+            for i in range(50):
+                if os.path.getsize(pid_fname) if os.path.exists(pid_fname) else 0:
+                    break
+                time.sleep(0.1)
+            with open(pid_fname) as fin:
+                pid = int(fin.read())
+            self.assertTrue(ExecutorTests.is_running(pid))
+            executor.cancel([job])
+            self.assertEquals(job.state, Job.CANCELLED)
+            for i in range(50):
+                if not ExecutorTests.is_running(pid):
+                    break
+                time.sleep(0.1)
+            self.assertFalse(ExecutorTests.is_running(pid))
+        finally:
+            os.environ["PATH"] = path
+
+    def test_array_script(self):
+        executor = SlurmExecutor(self.cfg, work_dir=self.tmp_dir, header_fname="")
+        out_fnames = [os.path.join(self.tmp_dir, "task%d.out" % i) for i in range(2)]
+        jobs = [executor.submit("task%d" % i, ["echo", "task %d" % i], 2, out_fname) for i, out_fname in enumerate(out_fnames)]
+        jobs.append(executor.submit("false", ["false"]))
+        script_fname = executor.write_scripts(jobs)
+        with open(script_fname) as fin:
+            script = fin.read()
+        self.assertTrue("#SBATCH --array=1-3\n" in script)
+        self.assertTrue("#SBATCH --cpus-per-task=2\n" in script)
+
+        # run array tasks as the batch system would do
+        for i in range(len(jobs)):
+            env = dict(os.environ, SLURM_ARRAY_TASK_ID=str(i+1))
+            self.assertEquals(subprocess.call(["sh", script_fname], env=env), 0)
+        for i, out_fname in enumerate(out_fnames):
+            with open(out_fname) as fin:
+                self.assertEquals(fin.read(), "task %d\n" % i)
+        with open(script_fname[:-len(".sh")] + ".3.rc") as fin:
+            self.assertEquals(int(fin.read()), 1)
+
+        self.assertEquals(executor.get_cancel_cmd("Submitted batch job 4242\n"), ["scancel", "4242"])
+        sge = SgeExecutor(self.cfg, work_dir=self.tmp_dir, header_fname="")
+        self.assertEquals(sge.get_cancel_cmd('Your job-array 77.1-3:1 ("epa_task0") has been submitted\n'), ["qdel", "77"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,6 +2,9 @@
 import os
 import sys
 import unittest
+import tempfile
+import json
+import shutil
 
 lib_path = os.path.abspath('..')
 sys.path.append(lib_path)
@@ -9,7 +12,12 @@ sys.path.append(lib_path)
 from epac.ete2 import SeqGroup
 from epac.taxonomy_util import Taxonomy, TaxCode
 from epac.config import EpacConfig
-from epac.json_util import EpaJsonParser, RefJsonParser, RefJsonBuilder
+from epac.json_util import EpaJsonParser, EpaJsonStreamParser, EpaJsonMerger, RefJsonParser, RefJsonBuilder, RefJsonStreamBuilder
+from epac.compress_util import CompressedIO
+from epac.cache_util import RefArtifactCache, RefSnapshot
+from epac.seqpack_util import PackedAlignment
+from epac.classify_util import BranchRankIndex
+from epac.placement_util import PlacementStore, PlacementStoreWriter, PlacementStoreParser
 from epac.ete2 import Tree
 
 class JsonTests(unittest.TestCase):
@@ -36,6 +44,81 @@ class JsonTests(unittest.TestCase):
                 self.assertTrue(branch >= 0 and branch < (t_len * 2 - 3)) 
                 self.assertTrue(lhw >= 0.0 and lhw <= 1.0) 
         
+    def test_jplace_stream_read(self):
+        jplace_fname = os.path.join(self.testfile_dir, "test.jplace")
+        parser = EpaJsonParser(jplace_fname)
+        stream_parser = EpaJsonStreamParser(jplace_fname)
+        self.assertEquals(stream_parser.get_raxml_version(), parser.get_raxml_version())
+        self.assertEquals(stream_parser.get_tree(), parser.get_tree())
+        self.assertEquals(list(stream_parser.iter_placements()), parser.get_placement())
+        
+        # leave-one-out jplace: placements come first, no tree; tricky strings
+        jdata = {"placements": [{"p": [[1, -1.5e+3, 0.5, 0.1, 0.2]], "n": ["a\\\"]}{["]}] * 3,
+                 "metadata": {"invocation": "raxml -f O"}, "version": 3}
+        jplace_fname = tempfile.mkstemp(suffix=".jplace")[1]
+        try:
+            with open(jplace_fname, "w") as fout:
+                fout.write('{"placements": %s, "metadata": %s, "version": 3}' % 
+                    (json.dumps(jdata["placements"]), json.dumps(jdata["metadata"])))
+            stream_parser = EpaJsonStreamParser(jplace_fname)
+            self.assertEquals(stream_parser.get_raxml_invocation(), "raxml -f O")
+            self.assertEquals(stream_parser.get_placement(), jdata["placements"])
+        finally:
+            os.remove(jplace_fname)
+
+    def test_placement_store(self):
+        jplace_fname = os.path.join(self.testfile_dir, "test.jplace")
+        parser = EpaJsonParser(jplace_fname)
+        placements = parser.get_placement()
+        # query without placements (e.g. all edges filtered out)
+        placements.append({"n": ["q_empty"], "p": []})
+        store = PlacementStoreWriter()
+        self.assertEquals(list(store.tee(placements)), placements)
+        self.assertEquals(len(store), 7)
+        
+        store_fname = tempfile.mkstemp(suffix=PlacementStore.SUFFIX)[1]
+        try:
+            store.write(store_fname, parser)
+            self.assertTrue(PlacementStore.is_store(store_fname))
+            self.assertFalse(PlacementStore.is_store(jplace_fname))
+            self.assertTrue(isinstance(PlacementStore.open(jplace_fname), EpaJsonStreamParser))
+            store_parser = PlacementStore.open(store_fname)
+            self.assertTrue(isinstance(store_parser, PlacementStoreParser))
+            self.assertEquals(len(store_parser), 7)
+            self.assertEquals(store_parser.get_tree(), parser.get_tree())
+            self.assertEquals(store_parser.get_raxml_version(), parser.get_raxml_version())
+            self.assertEquals(store_parser.get_placement(), placements)
+            self.assertEquals(store_parser.get_edges(6), [])
+            self.assertEquals(store_parser.get_edges(0), placements[0]["p"])
+            store_parser.close()
+        finally:
+            os.remove(store_fname)
+
+    def test_jplace_merge(self):
+        jplace_fname = os.path.join(self.testfile_dir, "test.jplace")
+        with open(jplace_fname) as fin:
+            jdata = json.load(fin)
+        placements = jdata["placements"]
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            shard_fnames = []
+            for i, shard in enumerate([placements[:4], placements[4:]]):
+                shard_fname = os.path.join(tmp_dir, "shard%d.jplace" % i)
+                jdata["placements"] = shard
+                with open(shard_fname, "w") as fout:
+                    json.dump(jdata, fout)
+                shard_fnames.append(shard_fname)
+            merged_fname = os.path.join(tmp_dir, "merged.jplace")
+            parser = EpaJsonMerger.merge(shard_fnames, merged_fname)
+            self.assertTrue(isinstance(parser, EpaJsonStreamParser))
+            orig_parser = EpaJsonParser(jplace_fname)
+            self.assertEquals(parser.get_placement(), placements)
+            self.assertEquals(parser.get_tree(), orig_parser.get_tree())
+            self.assertEquals(parser.get_raxml_version(), orig_parser.get_raxml_version())
+            self.assertEquals(EpaJsonParser(merged_fname).get_placement(), placements)
+        finally:
+            shutil.rmtree(tmp_dir)
+
     def test_refjson_read(self):
         versions = ["1.4", "1.5", "1.6"]
         for ver in versions:
@@ -53,6 +136,333 @@ class JsonTests(unittest.TestCase):
         tax_fname = os.path.join(self.testfile_dir, "test.tax")
         with self.assertRaises(ValueError):
             parser = RefJsonParser(tax_fname)            
+
+    def test_refjson_lazy(self):
+        ref_fname = os.path.join(self.testfile_dir, "test.refjson.v1.6")
+        with open(ref_fname) as fin:
+            jdata = json.load(fin)
+        parser = RefJsonParser(ref_fname)
+        self.assertEquals(sorted(parser.jdata.keys()), sorted(jdata.keys()))
+        self.assertFalse("sequences" in parser.jdata.cache)
+        self.assertEquals(parser.get_branch_tax_map(), jdata["branch_tax_map"])
+        self.assertFalse("sequences" in parser.jdata.cache)
+        self.assertEquals(parser.get_alignment_list(), jdata["sequences"])
+        self.assertEquals(parser.get_jdata(), jdata)
+
+    def test_compressed_io(self):
+        ref_fname = os.path.join(self.testfile_dir, "test.refjson.v1.6")
+        jplace_fname = os.path.join(self.testfile_dir, "test.jplace")
+        plain_ref = RefJsonParser(ref_fname).get_jdata()
+        plain_ref.pop("fields")
+        plain_jplace = EpaJsonParser(jplace_fname)
+        for ext in [".gz", ".bz2"]:
+            out_fname = tempfile.mkstemp(suffix=".refjson" + ext)[1]
+            out_jplace = tempfile.mkstemp(suffix=".jplace" + ext)[1]
+            try:
+                RefJsonBuilder(old_json=RefJsonParser(ref_fname)).dump(out_fname)
+                self.assertTrue(CompressedIO.is_compressed(out_fname))
+                parser = RefJsonParser(out_fname)
+                valid, errors = parser.validate()
+                self.assertTrue(valid)
+                jdata = parser.get_jdata()
+                jdata.pop("fields")
+                self.assertEquals(jdata, plain_ref)
+                
+                CompressedIO.copy(jplace_fname, out_jplace)
+                self.assertTrue(CompressedIO.is_compressed(out_jplace))
+                self.assertEquals(EpaJsonParser(out_jplace).get_placement(), plain_jplace.get_placement())
+                stream_parser = EpaJsonStreamParser(out_jplace)
+                self.assertEquals(stream_parser.get_tree(), plain_jplace.get_tree())
+                self.assertEquals(list(stream_parser.iter_placements()), plain_jplace.get_placement())
+            finally:
+                os.remove(out_fname)
+                os.remove(out_jplace)
+
+    def test_ref_cache(self):
+        ref_fname = os.path.join(self.testfile_dir, "test.refjson.v1.6")
+        parser = RefJsonParser(ref_fname)
+        self.cfg.ref_cache_dir = tempfile.mkdtemp()
+        out_fname = tempfile.mkstemp()[1]
+        try:
+            cache = RefArtifactCache(self.cfg, ref_fname, parser)
+            self.assertEquals(cache.cache_dir, os.path.join(self.cfg.ref_cache_dir, RefArtifactCache.file_hash(ref_fname)))
+            reftree_fname = cache.get_reftree()
+            self.assertEquals(open(reftree_fname).read(), parser.get_raxml_readable_tree())
+            parser.get_binary_model(out_fname)
+            self.assertEquals(open(cache.get_binary_model(), "rb").read(), open(out_fname, "rb").read())
+            parser.get_alignment(out_fname)
+            self.assertEquals(open(cache.get_alignment()).read(), open(out_fname).read())
+            
+            # no profile in refjson and no way to build it
+            self.assertEquals(cache.get_hmm_profile(), None)
+            def build_profile(aln_fname, out_fname):
+                self.assertEquals(aln_fname, cache.get_alignment())
+                with open(out_fname, "w") as fout:
+                    fout.write("HMMER3/f\n")
+            hmm_fname = cache.get_hmm_profile(build_profile)
+            self.assertEquals(open(hmm_fname).read(), "HMMER3/f\n")
+            
+            # second job with the same reference re-uses existing files
+            parser2 = RefJsonParser(ref_fname)
+            cache2 = RefArtifactCache(self.cfg, ref_fname, parser2)
+            self.assertEquals(cache2.get_reftree(), reftree_fname)
+            self.assertEquals(cache2.get_alignment(), cache.get_alignment())
+            self.assertFalse("raxmltree" in parser2.jdata.cache)
+            self.assertFalse("sequences" in parser2.jdata.cache)
+            self.assertEquals(cache2.get_hmm_profile(), hmm_fname)
+        finally:
+            shutil.rmtree(self.cfg.ref_cache_dir)
+            os.remove(out_fname)
+
+    def test_ref_snapshot(self):
+        ref_fname = os.path.join(self.testfile_dir, "test.refjson.v1.6")
+        parser = RefJsonParser(ref_fname)
+        self.cfg.ref_cache_dir = tempfile.mkdtemp()
+        try:
+            snapshot = RefArtifactCache(self.cfg, ref_fname, parser).get_snapshot()
+            self.assertEquals(snapshot.get_rate(), parser.get_rate())
+            self.assertEquals(snapshot.get_origin_taxonomy(), parser.get_origin_taxonomy())
+            self.assertEquals(snapshot.get_branch_tax_map(), parser.get_branch_tax_map())
+            
+            # second job loads the snapshot without parsing the trees
+            parser2 = RefJsonParser(ref_fname)
+            cache2 = RefArtifactCache(self.cfg, ref_fname, parser2)
+            snapshot2 = cache2.get_snapshot()
+            self.assertFalse("tree" in parser2.jdata.cache)
+            self.assertFalse("tax_tree" in parser2.jdata.cache)
+            self.assertEquals(snapshot2.get_node_height(), parser.get_node_height())
+            self.assertEquals(len(snapshot2.get_branch_rank_index()), len(parser.get_branch_tax_map()))
+            self.assertEquals(snapshot2.get_branch_rank_index().to_json(), parser.get_branch_rank_index().to_json())
+            # snapshot is plain JSON, s. RefSnapshot
+            snap_fname = os.path.join(cache2.cache_dir, RefArtifactCache.SNAPSHOT)
+            with open(snap_fname) as fin:
+                self.assertEquals(json.load(fin)["version"], RefSnapshot.VERSION)
+
+            reftree = parser.get_reftree()
+            snap_reftree = snapshot2.get_reftree()
+            self.assertEquals(snap_reftree.write(format=1, features=["B"]), reftree.write(format=1, features=["B"]))
+            self.assertEquals(snap_reftree.get_leaves()[0].B, reftree.get_leaves()[0].B)
+            self.assertEquals(snapshot2.get_raxml_reftree().write(format=5), Tree(parser.get_raxml_readable_tree()).write(format=5))
+            self.assertEquals(snapshot2.get_tax_tree().write(format=8), parser.get_tax_tree().write(format=8))
+            
+            # trees can be modified as usual
+            leaf = snap_reftree.get_leaves()[0]
+            leaf.up.add_child(name="new_leaf", dist=0.1)
+            self.assertEquals(len(snap_reftree.get_leaves()), len(reftree.get_leaves()) + 1)
+            self.assertEquals(len(snapshot2.get_reftree().get_leaves()), len(reftree.get_leaves()))
+        finally:
+            shutil.rmtree(self.cfg.ref_cache_dir)
+
+    def test_refjson_stream_builder(self):
+        ref_fname = os.path.join(self.testfile_dir, "test.refjson.v1.6")
+        parser = RefJsonParser(ref_fname)
+        jdata = parser.get_jdata()
+        model_fname = tempfile.mkstemp()[1]
+        hmm_fname = tempfile.mkstemp()[1]
+        parser.get_binary_model(model_fname)
+        with open(hmm_fname, "w") as fout:
+            fout.write("HMMER3/f\nNAME  test\n//\n")
+        for compact in [False, True]:
+            out_fname = tempfile.mkstemp(suffix=".refjson.gz")[1]
+            try:
+                jw = RefJsonStreamBuilder(out_fname, compact)
+                for fname in jdata:
+                    if fname not in ["version", "fields", "sequences", "binary_model"]:
+                        jw.set_field(fname, jdata[fname])
+                jw.set_sequences(iter(jdata["sequences"]))
+                jw.set_binary_model(model_fname)
+                jw.set_hmm_profile(hmm_fname)
+                with self.assertRaises(ValueError):
+                    jw.set_binary_model(model_fname)
+                jw.dump()
+                
+                self.assertTrue(CompressedIO.is_compressed(out_fname))
+                stream_parser = RefJsonParser(out_fname)
+                valid, errors = stream_parser.validate()
+                self.assertTrue(valid)
+                stream_jdata = stream_parser.get_jdata()
+                self.assertEquals(stream_jdata["hmm_profile"], ["HMMER3/f\n", "NAME  test\n", "//\n"])
+                self.assertEquals(stream_parser.get_version(), RefJsonBuilder.VERSION)
+                self.assertEquals(stream_parser.get_alignment_list(), parser.get_alignment_list())
+                for fname in jdata:
+                    if fname not in ["fields", "version", "sequences"]:
+                        self.assertEquals(stream_jdata[fname], jdata[fname])
+                self.assertEquals(sorted(stream_jdata["fields"]), sorted(jdata["fields"] + ["hmm_profile"]))
+            finally:
+                os.remove(out_fname)
+
+        # binary output: streamed json is converted once it is finished
+        out_fname = tempfile.mkstemp(suffix=".refjson")[1]
+        bin_fname = out_fname + ".bin"
+        try:
+            jw = RefJsonStreamBuilder(out_fname)
+            for fname in jdata:
+                if fname not in ["version", "fields", "sequences"]:
+                    jw.set_field(fname, jdata[fname])
+            jw.set_sequences(iter(jdata["sequences"]))
+            jw.dump_binary(bin_fname)
+            bin_parser = RefJsonParser(bin_fname)
+            self.assertTrue(bin_parser.is_binary())
+            self.assertEquals(bin_parser.get_version(), RefJsonBuilder.VERSION)
+            bin_jdata = bin_parser.get_jdata()
+            stream_jdata = RefJsonParser(out_fname).get_jdata()
+            self.assertEquals(sorted(bin_jdata.pop("fields")), sorted(stream_jdata.pop("fields")))
+            self.assertEquals(bin_jdata, stream_jdata)
+        finally:
+            os.remove(out_fname)
+            if os.path.exists(bin_fname):
+                os.remove(bin_fname)
+        os.remove(model_fname)
+        os.remove(hmm_fname)
+
+    def test_packed_alignment(self):
+        seqs = ["ACGT", "----", "", "A-C--G---T----", "--RYSWKMBDHVN------ACGTTT-", "??ACGU", "acgt", "ARNDCQEGHILKMFPSTWYV"]
+        for seq in seqs:
+            self.assertEquals(PackedAlignment.unpack_seq(PackedAlignment.pack_seq(seq)), seq)
+        self.assertTrue(PackedAlignment.is_packable(seqs[4]))
+        self.assertTrue(PackedAlignment.is_packable(seqs[5]))
+        self.assertFalse(PackedAlignment.is_packable(seqs[7]))
+        self.assertFalse(PackedAlignment.is_packable(u"AC\u00c9"))
+        
+        long_seq = "-" * 1000 + "ACGTN" * 20 + "-" * 5000
+        self.assertTrue(len(PackedAlignment.pack_seq(long_seq)) < 100)
+        self.assertEquals(PackedAlignment.unpack_seq(PackedAlignment.pack_seq(long_seq)), long_seq)
+
+        ref_fname = os.path.join(self.testfile_dir, "test.refjson.v1.6")
+        parser = RefJsonParser(ref_fname)
+        jw = RefJsonBuilder(old_json=parser)
+        jw.set_sequences(parser.get_alignment_list())
+        out_fname = tempfile.mkstemp(suffix=".refjson")[1]
+        aln_fname = tempfile.mkstemp()[1]
+        aln_fname2 = tempfile.mkstemp()[1]
+        try:
+            jw.dump(out_fname)
+            self.assertTrue(os.path.getsize(out_fname) < os.path.getsize(ref_fname))
+            packed_parser = RefJsonParser(out_fname)
+            valid, errors = packed_parser.validate()
+            self.assertTrue(valid)
+            self.assertEquals(packed_parser.get_version(), "1.7")
+            self.assertTrue(packed_parser.get_packed_alignment() != None)
+            self.assertTrue(parser.get_packed_alignment() == None)
+            self.assertEquals(packed_parser.get_alignment_list(), parser.get_alignment_list())
+            self.assertEquals(packed_parser.get_sequences_names(), parser.get_sequences_names())
+            self.assertEquals(packed_parser.get_alignment_length(), parser.get_alignment_length())
+            packed_parser.get_alignment(aln_fname)
+            parser.get_alignment(aln_fname2)
+            self.assertEquals(open(aln_fname).read(), open(aln_fname2).read())
+            name, seq = parser.get_alignment_list()[3][:2]
+            self.assertEquals(packed_parser.get_ref_alignment().get_seq(name), seq)
+        finally:
+            os.remove(out_fname)
+            os.remove(aln_fname)
+            os.remove(aln_fname2)
+
+    def test_branch_rank_index(self):
+        ref_fname = os.path.join(self.testfile_dir, "test.refjson.v1.6")
+        parser = RefJsonParser(ref_fname)
+        bid_tax_map = parser.get_branch_tax_map()
+        # old file without precompiled index -> built on the fly
+        built_index = parser.get_branch_rank_index()
+        self.assertEquals(len(built_index), len(bid_tax_map))
+        self.assertTrue(parser.get_branch_rank_index() is built_index)
+        # empty index is not rebuilt either
+        parser.branch_rank_index = BranchRankIndex()
+        self.assertTrue(parser.get_branch_rank_index() is parser.branch_rank_index)
+        parser.branch_rank_index = built_index
+        
+        jw = RefJsonBuilder(old_json=parser)
+        jw.set_branch_rank_index(built_index)
+        out_fname = tempfile.mkstemp(suffix=".refjson")[1]
+        try:
+            jw.dump(out_fname)
+            parser = RefJsonParser(out_fname)
+            valid, errors = parser.validate()
+            self.assertTrue(valid)
+            loaded_index = parser.get_branch_rank_index()
+        finally:
+            os.remove(out_fname)
+        
+        self.assertEquals(len(loaded_index), len(bid_tax_map))
+        for br_id in bid_tax_map:
+            self.assertEquals(loaded_index.get_row(br_id), built_index.get_row(br_id))
+            self.assertEquals(loaded_index.get_branch_ranks(br_id), Taxonomy.split_rank_uid(bid_tax_map[br_id][0]))
+
+    def test_name_index(self):
+        ref_fname = os.path.join(self.testfile_dir, "test.refjson.v1.6")
+        # translating ranks must not decode sequences or ID map
+        parser = RefJsonParser(ref_fname)
+        parser.get_uncorr_ranks(["Bacteria"])
+        self.assertEquals(sorted(parser.jdata.cache), ["corr_ranks_map", "version"])
+
+        ref_seqs = sorted(parser.get_sequences_names())
+        corr_sid = ref_seqs[0]
+        # corrected -> original names, as stored by the trainer
+        jw = RefJsonBuilder(old_json=parser)
+        jw.set_corr_seqid_map({corr_sid: "r_orig|seq"})
+        jw.set_corr_ranks_map({"Rank_corr": "Rank (orig)"})
+        out_fname = tempfile.mkstemp(suffix=".refjson")[1]
+        try:
+            jw.dump(out_fname)
+            parser = RefJsonParser(out_fname)
+            name_index = parser.get_name_index()
+
+            self.assertTrue(parser.get_name_index() is name_index)
+            self.assertTrue(name_index.has_seq(corr_sid))
+            self.assertFalse(name_index.has_seq("r_orig|seq"))
+            self.assertEquals(parser.get_uncorr_seqids([corr_sid, ref_seqs[1]]), ["r_orig|seq", ref_seqs[1]])
+            self.assertEquals(parser.get_corr_seqids(["r_orig|seq", "r_unknown"]), [corr_sid, "r_unknown"])
+            self.assertEquals(parser.get_corr_seqid("r_orig|seq"), corr_sid)
+            self.assertEquals(parser.get_uncorr_seqid(corr_sid), "r_orig|seq")
+            lineages = [["Bacteria", "Rank_corr"], [], ["Rank_corr"]]
+            self.assertEquals(parser.get_uncorr_lineages(lineages), [["Bacteria", "Rank (orig)"], [], ["Rank (orig)"]])
+            self.assertEquals(parser.get_uncorr_ranks(lineages[0]), ["Bacteria", "Rank (orig)"])
+            self.assertEquals(lineages[0], ["Bacteria", "Rank_corr"])
+        finally:
+            os.remove(out_fname)
+
+    def test_refbin_convert(self):
+        ref_fname = os.path.join(self.testfile_dir, "test.refjson.v1.6")
+        json_parser = RefJsonParser(ref_fname)
+        jw = RefJsonBuilder(old_json=RefJsonParser(ref_fname))
+        jw.jdata["hmm_profile"] = ["HMMER3/f\n", "NAME  test\n", "//\n"]
+        bin_fname = tempfile.mkstemp(suffix=".refbin")[1]
+        json_fname = tempfile.mkstemp(suffix=".refjson")[1]
+        out_fname = tempfile.mkstemp()[1]
+        out_fname2 = tempfile.mkstemp()[1]
+        try:
+            jw.dump_binary(bin_fname)
+            bin_parser = RefJsonParser(bin_fname)
+            self.assertTrue(bin_parser.is_binary())
+            self.assertEquals(bin_parser.refbin.get_encoding("sequences"), "seqs_c")
+            valid, errors = bin_parser.validate()
+            self.assertTrue(valid)
+            self.assertEquals(bin_parser.get_version(), json_parser.get_version())
+            self.assertEquals(bin_parser.get_raxml_readable_tree(), json_parser.get_raxml_readable_tree())
+            self.assertEquals(bin_parser.get_branch_tax_map(), json_parser.get_branch_tax_map())
+            self.assertEquals(bin_parser.get_node_height(), json_parser.get_node_height())
+            self.assertEquals(bin_parser.get_rate(), json_parser.get_rate())
+            self.assertEquals(bin_parser.get_alignment_list(), json_parser.get_alignment_list())
+            
+            bin_parser.get_alignment(out_fname)
+            json_parser.get_alignment(out_fname2)
+            self.assertEquals(open(out_fname).read(), open(out_fname2).read())
+            bin_parser.get_binary_model(out_fname)
+            json_parser.get_binary_model(out_fname2)
+            self.assertEquals(open(out_fname, "rb").read(), open(out_fname2, "rb").read())
+            bin_parser.get_hmm_profile(out_fname)
+            self.assertEquals(open(out_fname).read(), "".join(jw.jdata["hmm_profile"]))
+            
+            # and back to json
+            RefJsonBuilder(old_json=bin_parser).dump(json_fname)
+            with open(json_fname) as fin:
+                jdata = json.load(fin)
+            for fname in jw.jdata:
+                if fname != "fields":
+                    self.assertEquals(jdata[fname], jw.jdata[fname])
+            self.assertEquals(sorted(jdata["fields"]), sorted(jw.jdata["fields"]))
+        finally:
+            for fname in [bin_fname, json_fname, out_fname, out_fname2]:
+                os.remove(fname)
         
         
 if __name__ == '__main__':
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+import unittest
+import tempfile
+import shutil
+
+lib_path = os.path.abspath('..')
+sys.path.append(lib_path)
+
+from epac.scheduler import Job, JobScheduler
+
+class SchedulerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.scheduler = JobScheduler(max_threads=2)
+
+    def tearDown(self):
+        self.scheduler.shutdown(cancel=True)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_run(self):
+        out_fname = os.path.join(self.tmp_dir, "echo.out")
+        job = self.scheduler.run("echo", ["echo", "hello"], out_fname=out_fname)
+        self.assertTrue(job.succeeded())
+        self.assertEquals(job.state, Job.FINISHED)
+        with open(out_fname) as fin:
+            self.assertEquals(fin.read(), "hello\n")
+
+        job = self.scheduler.run("false", ["false"])
+        self.assertEquals(job.state, Job.FINISHED)
+        self.assertFalse(job.succeeded())
+
+        self.assertRaises(OSError, self.scheduler.run, "missing", [os.path.join(self.tmp_dir, "no_such_binary")])
+
+    def test_thread_budget(self):
+        # two jobs with 1 thread each fit into the budget, job with 2 threads has to wait for them
+        jobs = [self.scheduler.submit("job%d" % i, ["sleep", "0.5"], threads) for i, threads in enumerate([1, 1, 2])]
+        self.assertTrue(self.scheduler.wait(jobs, timeout=10))
+        self.assertTrue(all(job.succeeded() for job in jobs))
+        self.assertTrue(jobs[1].start_time < jobs[0].end_time)
+        self.assertTrue(jobs[2].start_time >= max(jobs[0].end_time, jobs[1].end_time))
+
+        # jobs exceeding the budget are run alone
+        job = self.scheduler.run("big", ["true"], threads=8)
+        self.assertTrue(job.succeeded())
+
+    def test_timeout_cancel(self):
+        job = self.scheduler.run("timeout", ["sleep", "10"], timeout=0.5)
+        self.assertEquals(job.state, Job.TIMEOUT)
+        self.assertTrue(job.get_elapsed_time() < 5)
+
+        running = self.scheduler.submit("running", ["sleep", "10"], threads=2)
+        pending = self.scheduler.submit("pending", ["sleep", "10"])
+        time.sleep(0.5)
+        self.assertEquals(running.state, Job.RUNNING)
+        self.assertEquals(pending.state, Job.PENDING)
+        self.scheduler.cancel([running, pending])
+        self.assertEquals(running.state, Job.CANCELLED)
+        self.assertEquals(pending.state, Job.CANCELLED)
+        self.assertEquals(pending.proc, None)
+
+        self.scheduler.shutdown()
+        self.assertRaises(RuntimeError, self.scheduler.submit, "closed", ["true"])
+
+if __name__ == '__main__':
+    unittest.main()
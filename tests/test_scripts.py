@@ -3,6 +3,9 @@ import os
 import sys
 import unittest
 import shutil
+import glob
+import filecmp
+import multiprocessing
 from subprocess import call,check_output,STDOUT,CalledProcessError
 
 lib_path = os.path.abspath('..')
@@ -12,7 +15,9 @@ from epac.taxonomy_util import Taxonomy, TaxCode, TaxTreeBuilder
 from epac.config import EpacConfig, EpacClassifierConfig
 from epac.ete2 import Tree
 from epac.classify_util import TaxTreeHelper, TaxClassifyHelper
-from epac.json_util import EpaJsonParser
+from epac.json_util import EpaJsonParser, RefJsonParser
+from epac.raxml_util import RaxmlWrapper
+from sativa import LeaveOneTest
 
 class ScriptTests(unittest.TestCase):
 
@@ -69,6 +74,76 @@ class ScriptTests(unittest.TestCase):
 
         assign_fname = os.path.join(self.out_dir, "testcl.assignment.txt")
         self.assertTrue(os.path.isfile(assign_fname))
-                
+
+    def test_trainer_update(self):
+        exec_script = os.path.join(self.sativa_dir, "epa_trainer.py")
+        ali_fname = os.path.join(self.testfile_dir, "ref.phy")
+        tax_fname = os.path.join(self.testfile_dir, "ref.tax")
+        call_str = [exec_script, "-s", ali_fname, "-t", tax_fname, "-n", "testref", "-x", "BAC", "-o", self.out_dir, "-no-hmmer", "-T", "2"]
+        try:
+            out_str = check_output(call_str, stderr=STDOUT)
+        except CalledProcessError as ex:
+            print "\n\nCommand line: %s\n\nOutput:\n%s\n" % (ex.cmd, ex.output)
+            self.assertTrue(False, msg="Error running epa_trainer.py script")
+
+        refjson_fname = os.path.join(self.out_dir, "testref.refjson")
+        tax_fname = os.path.join(self.testfile_dir, "full.tax")
+        call_str = [exec_script, "-s", ali_fname, "-t", tax_fname, "-n", "testupd", "-x", "BAC", "-o", self.out_dir, "-no-hmmer", "-T", "2",
+                    "-update", refjson_fname]
+        try:
+            out_str = check_output(call_str, stderr=STDOUT)
+        except CalledProcessError as ex:
+            print "\n\nCommand line: %s\n\nOutput:\n%s\n" % (ex.cmd, ex.output)
+            self.assertTrue(False, msg="Error running epa_trainer.py script (update mode)")
+
+        upd_fname = os.path.join(self.out_dir, "testupd.refjson")
+        self.assertTrue(os.path.isfile(upd_fname))
+        refjson = RefJsonParser(upd_fname)
+        self.assertTrue(refjson.validate()[0])
+        ref_seqs = RefJsonParser(refjson_fname).get_sequences_names()
+        upd_seqs = refjson.get_sequences_names()
+        self.assertTrue(ref_seqs < upd_seqs)
+        self.assertEqual(len(upd_seqs), len(refjson.get_reftree().get_leaves()))
+        # likelihood of the updated tree is computed with the original model
+        self.assertTrue(refjson.get_metadata()["reftree_loglh"] < 0)
+
+    @unittest.skipIf(multiprocessing.cpu_count() < 4, "at least 4 CPU cores are needed to run 2 searches at a time")
+    def test_trainer_concurrent(self):
+        exec_script = os.path.join(self.sativa_dir, "epa_trainer.py")
+        ali_fname = os.path.join(self.testfile_dir, "ref.phy")
+        tax_fname = os.path.join(self.testfile_dir, "ref.tax")
+        # multifurcation resolution searches are run as separate RAxML processes, 2 threads each;
+        # temp dir is kept (-debug) to check the results of individual searches
+        call_str = [exec_script, "-s", ali_fname, "-t", tax_fname, "-n", "testconc", "-x", "BAC", "-o", self.out_dir, "-no-hmmer", "-T", "4",
+                    "-N", "2", "-Np", "2", "-debug", "-tmpdir", self.out_dir]
+        try:
+            out_str = check_output(call_str, stderr=STDOUT)
+        except CalledProcessError as ex:
+            print "\n\nCommand line: %s\n\nOutput:\n%s\n" % (ex.cmd, ex.output)
+            self.assertTrue(False, msg="Error running epa_trainer.py script (concurrent searches)")
+
+        refjson_fname = os.path.join(self.out_dir, "testconc.refjson")
+        self.assertTrue(os.path.isfile(refjson_fname))
+        self.assertTrue(RefJsonParser(refjson_fname).validate()[0])
+
+        cfg = EpacConfig()
+        cfg.rand_seed = None
+        cfg.raxml_outdir = glob.glob(os.path.join(self.out_dir, "testconc_*"))[0]
+        raxml = RaxmlWrapper(cfg)
+        job_name = "mfresolv_testconc"
+        rep_jobnames = ["%s.%d" % (job_name, i) for i in range(2)]
+        rep_lhs = []
+        for rep_jobname in rep_jobnames:
+            self.assertTrue(raxml.result_exists(rep_jobname))
+            rep_lhs.append(raxml.get_tree_lh(rep_jobname))
+        self.assertFalse(None in rep_lhs)
+        best_jobname = rep_jobnames[rep_lhs.index(max(rep_lhs))]
+        self.assertTrue(filecmp.cmp(raxml.result_fname(job_name), raxml.result_fname(best_jobname), shallow=False))
+        self.assertEqual(raxml.get_tree_lh(job_name), max(rep_lhs))
+
+    def test_l1o_shard_order(self):
+        fnames = [os.path.join(self.out_dir, "test.l1out_seq.shard%d.jplace" % i) for i in range(1, 13)]
+        self.assertEqual(sorted(reversed(fnames), key=LeaveOneTest.get_shard_sort_key), fnames)
+
 if __name__ == '__main__':
     unittest.main()